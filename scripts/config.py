@@ -182,3 +182,30 @@ PIPELINES = {
 
 # -------- Other parameters --------
 N_BINS = 5
+
+
+# -------- Performance parameters --------
+ARTIFACT_CHUNK_MB = 256  # max size of one block of epochs scanned by find_artifacts
+REJECTION_FROM_RAW = True  # check trial thresholds on views of the raw data, build epochs only for kept trials
+BATCH_N_WORKERS = 4  # worker processes for multi-subject preprocessing
+BATCH_WORKER_MEMORY_MB = 8000  # memory budget per worker process (None for no limit)
+STAGE_CACHE = True  # cache the outputs of the preprocessing stages (BIDS read -> reref) on disk
+STAGE_CACHE_DIR = None  # None -> output_mne/cache
+STAGE_CACHE_MAX_GB = 20  # least recently used entries are evicted above this size
+STAGE_CACHE_GRACE_SEC = 3600  # incomplete cache entries are only removed once older than this (another worker may be writing them)
+SHARED_FFT_FILTER = True  # filter all branches (ERP bandpass+notch, ICA bandpass) from one FFT of the signal
+FLOAT_DTYPE = 'float64'  # precision of the arrays derived from MNE objects (FFT filtering, trial data for ERPs/decoding); MNE Raw/Epochs buffers stay float64, so 'float32' halves only the derived arrays
+RESAMPLE_METHOD = 'fft'  # 'fft' (MNE default) or 'polyphase' (rational-ratio FIR, faster, see benchmark_down_sampling)
+ZAPLINE_SEGMENT_SEC = 60  # zapline on overlapping segments of this length (0 for the whole recording at once)
+ZAPLINE_OVERLAP_SEC = 2  # crossfaded overlap of consecutive zapline segments
+ZAPLINE_FIT_SEC = 300  # data used to estimate the shared zapline spatial filter
+ICA_DECIM = None  # fit ICA on every n-th sample of the trials (None for all samples)
+ICA_N_COMPONENTS = 0  # number of PCA components kept before ICA (0 for all)
+ICA_WARM_START = False  # refit ICA starting from the decomposition saved in output_mne/ICA_objects (the saved ICA is kept, see _fit_or_load_ica)
+INPLACE_PIPELINE = True  # preprocessing steps modify their input instead of a copy, intermediate recordings are released early
+MEMMAP_RAW = False  # load the full-rate recording into a memmap and downsample/filter/reref it chunk by chunk (bounded memory)
+MEMMAP_CHUNK_SEC = 120  # length of the chunks of the memmap mode (the filter length is added on both sides)
+SCRATCH_DIR = None  # directory of the memmap files (None -> output_mne/scratch), should be on disk, not on a tmpfs
+CLUSTER_N_WORKERS = 4  # worker processes of the cluster permutation test (1 to run in the calling process)
+CLUSTER_CHUNK_PERM = 256  # permutations evaluated per batched matrix product in the cluster permutation test
+BOOTSTRAP_MAX_MB = 64  # memory ceiling of one task (group of resampling blocks) of paired_bootstrap
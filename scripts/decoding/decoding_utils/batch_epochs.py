@@ -0,0 +1,411 @@
+import _thread
+import json
+import os
+import threading
+import time
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import mne
+import pandas as pd
+
+import config
+from pipeline.s04_ICA import get_iclabel_probabilities, iclabel_cache_path
+
+try:
+    from .epoch_io import (
+        EPOCHS_DIR, ICA_DIR_CANDIDATES, _get_ica_path, _get_ica_trials, _load_bids_raw, _preprocess_branches,
+        build_and_save_feedback_epochs, get_epochs_path,
+    )
+except ImportError:
+    from decoding.decoding_utils.epoch_io import (
+        EPOCHS_DIR, ICA_DIR_CANDIDATES, _get_ica_path, _get_ica_trials, _load_bids_raw, _preprocess_branches,
+        build_and_save_feedback_epochs, get_epochs_path,
+    )
+
+
+STATUS_COLUMNS = [
+    "subject_id", "pipeline", "status", "n_epochs", "duration_sec",
+    "started_at", "finished_at", "worker_pid", "save_path", "error",
+]
+
+
+def _get_status_dir(pipeline_name: str, root_dir: Path | None = None) -> Path:
+    '''
+    Directory holding one status file per subject for the given pipeline (next to the saved epochs).
+    '''
+    base_dir = EPOCHS_DIR if root_dir is None else Path(root_dir)
+    return base_dir / pipeline_name / "_batch_status"
+
+
+def _write_status(status_dir: Path, record: dict) -> None:
+    '''
+    Atomically write the status record of one subject, so a crash never leaves a half-written file.
+    '''
+    status_dir.mkdir(parents=True, exist_ok=True)
+    path = status_dir / f"sub-{record['subject_id']}.json"
+    tmp_path = path.with_suffix(".json.tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+def _read_status(status_dir: Path, subject_id: str) -> dict | None:
+    '''
+    Read the status record of one subject, None if the subject has never been started.
+    '''
+    path = status_dir / f"sub-{subject_id}.json"
+    if not path.exists():
+        return None
+    with path.open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# set by the RSS watchdog of the worker before it interrupts the main thread
+_BUDGET_EXCEEDED = threading.Event()
+
+
+def _watch_rss(limit_bytes: int, interval: float) -> None:
+    '''
+    Watchdog thread: interrupt the main thread of the worker once its resident memory exceeds limit_bytes.
+    '''
+    import psutil
+    process = psutil.Process(os.getpid())
+    while not _BUDGET_EXCEEDED.is_set():
+        if process.memory_info().rss > limit_bytes:
+            _BUDGET_EXCEEDED.set()
+            _thread.interrupt_main()
+            return
+        time.sleep(interval)
+
+
+def _limit_worker_memory(max_memory_mb: float | None, interval: float = 0.2) -> None:
+    '''
+    Pool initializer: watch the resident memory (RSS) of the worker process so that a runaway subject fails inside
+    its own worker instead of exhausting the node. Unlike an address-space limit (RLIMIT_AS), only resident pages
+    count against the budget: reserved but untouched memory (e.g. BLAS thread arenas) and the parts of memmapped
+    files (memmap mode) that are not paged in do not.
+
+    This is a soft limit: RSS is sampled every `interval` seconds and the interrupt is only handled once the running
+    numpy/MNE call returns, so the budget can be overshot briefly. Requires psutil.
+    '''
+    if max_memory_mb is None:
+        return
+    try:
+        import psutil  # noqa: F401
+    except ImportError:
+        warnings.warn("Per-worker memory budget needs psutil, running without a limit.")
+        return
+    limit = int(max_memory_mb * 1024 ** 2)
+    threading.Thread(target=_watch_rss, args=(limit, interval), daemon=True).start()
+
+
+def _run_subject(subject_id: str, pipeline_name: str, bids_root: str, root_dir: str | None,
+                 overwrite: bool, status_dir: str) -> dict:
+    '''
+    Worker task: preprocess one subject and save its feedback epochs. Never raises, failures are
+    returned (and written to the status file) as a 'failed' record.
+    '''
+    status_dir = Path(status_dir)
+    record = {
+        "subject_id": subject_id,
+        "pipeline": pipeline_name,
+        "status": "running",
+        "started_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "worker_pid": os.getpid(),
+    }
+    _write_status(status_dir, record)
+
+    t_start = time.perf_counter()
+    try:
+        raw = _load_bids_raw(subject_id, Path(bids_root), pipeline_name=pipeline_name)
+        epochs, save_path, _ = build_and_save_feedback_epochs(
+            raw=raw,
+            subject_id=subject_id,
+            pipeline_name=pipeline_name,
+            bids_root=Path(bids_root),
+            root_dir=None if root_dir is None else Path(root_dir),
+            overwrite=overwrite,
+        )
+        record.update(status="built", n_epochs=len(epochs), save_path=str(save_path))
+    except Exception as exc:
+        record.update(status="failed", error=f"{type(exc).__name__}: {exc}\n{traceback.format_exc()}")
+    except KeyboardInterrupt:
+        if not _BUDGET_EXCEEDED.is_set():
+            raise
+        record.update(status="failed", error="MemoryError: resident memory exceeded the per-worker budget.")
+
+    record["duration_sec"] = round(time.perf_counter() - t_start, 2)
+    record["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    _write_status(status_dir, record)
+    return record
+
+
+def _is_done(subject_id: str, pipeline_name: str, root_dir: Path | None, status_dir: Path) -> bool:
+    '''
+    A subject is done if its epochs file exists and it was not interrupted while being (re)built.
+    Epochs files without a status record (e.g. built by the notebook loop) count as done.
+    '''
+    if not get_epochs_path(subject_id, pipeline_name, "feedback", root_dir=root_dir).exists():
+        return False
+    status = _read_status(status_dir, subject_id)
+    return status is None or status["status"] == "built"
+
+
+def _resolve_n_workers(n_workers: int | None, max_memory_mb: float | None) -> int:
+    '''
+    Number of worker processes, capped by the CPU count and by how many memory budgets fit in the available RAM.
+    '''
+    if n_workers is None:
+        n_workers = config.BATCH_N_WORKERS
+    n_workers = max(1, min(int(n_workers), os.cpu_count() or 1))
+    if max_memory_mb is not None:
+        try:
+            import psutil
+            n_fit = int(psutil.virtual_memory().available // (max_memory_mb * 1024 ** 2))
+            n_workers = max(1, min(n_workers, n_fit))
+        except ImportError:
+            pass
+    return n_workers
+
+
+def _run_pool(subjects, n_workers, max_memory_mb, pipeline_name, bids_root, root_dir, overwrite, status_dir,
+              logger=None) -> list[str]:
+    '''
+    Run _run_subject for the given subjects in one process pool.
+
+    :return: subjects whose future failed because the pool broke (a worker was killed)
+    '''
+    # marked as pending until a worker starts them, to tell subjects that never started from those that were running
+    for subject_id in subjects:
+        _write_status(status_dir, {"subject_id": subject_id, "pipeline": pipeline_name, "status": "pending"})
+    crashed = []
+    with ProcessPoolExecutor(
+        max_workers=min(n_workers, len(subjects)),
+        initializer=_limit_worker_memory,
+        initargs=(max_memory_mb,),
+        max_tasks_per_child=1,
+    ) as executor:
+        futures = {
+            executor.submit(
+                _run_subject, subject_id, pipeline_name, str(bids_root),
+                None if root_dir is None else str(root_dir), overwrite, str(status_dir),
+            ): subject_id
+            for subject_id in subjects
+        }
+        for future in as_completed(futures):
+            subject_id = futures[future]
+            try:
+                record = future.result()
+            except BrokenProcessPool:
+                crashed.append(subject_id)
+                continue
+            if logger is not None:
+                logger.info(
+                    "sub-%s: %s in %.1f s", subject_id, record["status"], record["duration_sec"],
+                )
+    return crashed
+
+
+def run_feedback_epochs_batch(
+    subjects,
+    pipeline_name: str,
+    bids_root: Path,
+    root_dir: Path | None = None,
+    n_workers: int | None = None,
+    max_memory_mb: float | None = None,
+    only_missing: bool = True,
+    overwrite: bool = False,
+    logger=None,
+) -> pd.DataFrame:
+    '''
+    Build and save the feedback-locked epochs of many subjects in a process pool.
+
+    Each subject runs in its own worker process (recycled after every subject so its memory is released).
+    Progress is written to one status file per subject, so an interrupted batch resumes where it stopped,
+    and a failing subject (exception or killed worker) is recorded without stopping the other subjects.
+
+    :param subjects: list of subject IDs
+    :param pipeline_name: 'original' or 'proposed'
+    :param bids_root: root of the BIDS dataset
+    :param root_dir: root directory of the saved epochs (defaults to output_mne/epochs)
+    :param n_workers: number of worker processes, defaults to config.BATCH_N_WORKERS
+    :param max_memory_mb: memory budget per worker in MB, defaults to config.BATCH_WORKER_MEMORY_MB (None there for no limit)
+    :param only_missing: skip subjects whose epochs are already saved
+    :param overwrite: whether to overwrite existing epochs files
+    :param logger: logger object for progress messages
+
+    :return: per-subject status/timing table (also saved as batch_status.csv next to the epochs)
+    '''
+    if max_memory_mb is None:
+        max_memory_mb = config.BATCH_WORKER_MEMORY_MB
+    status_dir = _get_status_dir(pipeline_name, root_dir)
+    status_dir.mkdir(parents=True, exist_ok=True)
+
+    subjects = [str(s) for s in subjects]
+    skipped = []
+    pending = []
+    for subject_id in subjects:
+        if only_missing and _is_done(subject_id, pipeline_name, root_dir, status_dir):
+            skipped.append(subject_id)
+        else:
+            pending.append(subject_id)
+
+    n_workers = _resolve_n_workers(n_workers, max_memory_mb)
+    if logger is not None:
+        logger.info(
+            "Batch %s: %s subjects to run, %s already done, %s workers",
+            pipeline_name, len(pending), len(skipped), n_workers,
+        )
+
+    # a killed worker (e.g. out of memory) breaks the whole pool: subjects that never started are run again in a
+    # fresh pool, subjects that were running are retried alone (one worker each) and only marked as failed if their
+    # own worker is killed as well, so a subject sharing a pool with a heavy one is not blamed for its crash
+    isolated = []
+    while pending:
+        crashed = _run_pool(pending, n_workers, max_memory_mb, pipeline_name, bids_root, root_dir, overwrite,
+                            status_dir, logger)
+        not_started = []
+        for subject_id in crashed:
+            status = _read_status(status_dir, subject_id)
+            if status["status"] == "running":
+                isolated.append(subject_id)
+            elif status["status"] == "pending":
+                not_started.append(subject_id)
+        if not_started and len(not_started) == len(pending):
+            # no subject could start, e.g. the workers fail at startup: a new pool would break the same way
+            for subject_id in not_started:
+                _write_status(status_dir, {
+                    "subject_id": subject_id, "pipeline": pipeline_name, "status": "failed",
+                    "error": "Worker process terminated before starting the subject.",
+                })
+            if logger is not None:
+                logger.warning("Batch %s: no worker could start, %s subjects failed", pipeline_name, len(not_started))
+            break
+        pending = not_started
+
+    for subject_id in isolated:
+        if _run_pool([subject_id], 1, max_memory_mb, pipeline_name, bids_root, root_dir, overwrite, status_dir, logger):
+            status = _read_status(status_dir, subject_id) or {"subject_id": subject_id, "pipeline": pipeline_name}
+            status.update(status="failed", error="Worker process terminated abruptly (e.g. out of memory).")
+            _write_status(status_dir, status)
+            if logger is not None:
+                logger.warning("sub-%s: worker terminated abruptly", subject_id)
+
+    rows = []
+    for subject_id in subjects:
+        status = _read_status(status_dir, subject_id)
+        if subject_id in skipped:
+            status = {**(status or {}), "subject_id": subject_id, "pipeline": pipeline_name, "status": "skipped"}
+        rows.append(status or {"subject_id": subject_id, "pipeline": pipeline_name, "status": "missing"})
+
+    summary_df = pd.DataFrame(rows).reindex(columns=STATUS_COLUMNS)
+    summary_path = status_dir.parent / "batch_status.csv"
+    summary_df.to_csv(summary_path, index=False)
+    if logger is not None:
+        logger.info("Saved batch status table -> %s", summary_path)
+    return summary_df
+
+
+def _label_subject(subject_id: str, pipeline_name: str, bids_root: str) -> dict:
+    '''
+    Worker task: compute (or read from the cache) the ICLabel probabilities of the saved ICA of one subject.
+    Never raises, failures are returned as a 'failed' record.
+    '''
+    record = {"subject_id": subject_id, "pipeline": pipeline_name, "worker_pid": os.getpid()}
+    t_start = time.perf_counter()
+    try:
+        ica_path = _get_ica_path(subject_id, pipeline_name)
+        cache_path = iclabel_cache_path(ica_path)
+        mtime_before = cache_path.stat().st_mtime_ns if cache_path.exists() else None
+
+        eeg_band_notch, eeg_ica = _preprocess_branches(subject_id, Path(bids_root), pipeline_name)
+        trials = _get_ica_trials(eeg_band_notch, eeg_ica, pipeline_name)
+        trials.load_data()
+        ica = mne.preprocessing.read_ica(ica_path, verbose=False)
+        labels = get_iclabel_probabilities(trials, ica, cache_path=cache_path)
+
+        cached = mtime_before is not None and cache_path.stat().st_mtime_ns == mtime_before
+        record.update(status="cached" if cached else "labeled", n_components=len(labels), cache_path=str(cache_path))
+    except Exception as exc:
+        record.update(status="failed", error=f"{type(exc).__name__}: {exc}\n{traceback.format_exc()}")
+    except KeyboardInterrupt:
+        if not _BUDGET_EXCEEDED.is_set():
+            raise
+        record.update(status="failed", error="MemoryError: resident memory exceeded the per-worker budget.")
+    record["duration_sec"] = round(time.perf_counter() - t_start, 2)
+    return record
+
+
+def find_saved_ica_subjects(pipeline_name: str) -> list[str]:
+    '''
+    Subject IDs of all ICA objects saved for the given pipeline ({pipeline}-sub{id}_ica.fif).
+    '''
+    subjects = set()
+    prefix = f"{pipeline_name}-sub"
+    for base_dir in ICA_DIR_CANDIDATES:
+        for path in base_dir.glob(f"{prefix}*_ica.fif"):
+            subjects.add(path.name[len(prefix):-len("_ica.fif")])
+    return sorted(subjects)
+
+
+def run_iclabel_batch(
+    pipeline_name: str,
+    bids_root: Path,
+    subjects=None,
+    n_workers: int | None = None,
+    max_memory_mb: float | None = None,
+    logger=None,
+) -> pd.DataFrame:
+    '''
+    Compute the ICLabel probabilities of all saved ICA objects of a pipeline in a process pool and store them
+    next to the ICA files, so that iccomponent_removal (and any change of the exclusion criteria) only reads them.
+    Subjects whose cached probabilities still match their ICA and trials are not labeled again.
+
+    :param pipeline_name: 'original' or 'proposed'
+    :param bids_root: root of the BIDS dataset
+    :param subjects: list of subject IDs, defaults to all subjects with a saved ICA object
+    :param n_workers: number of worker processes, defaults to config.BATCH_N_WORKERS
+    :param max_memory_mb: memory budget per worker in MB, defaults to config.BATCH_WORKER_MEMORY_MB (None there for no limit)
+    :param logger: logger object for progress messages
+
+    :return: per-subject status/timing table
+    '''
+    if max_memory_mb is None:
+        max_memory_mb = config.BATCH_WORKER_MEMORY_MB
+    subjects = find_saved_ica_subjects(pipeline_name) if subjects is None else [str(s) for s in subjects]
+    if not subjects:
+        raise FileNotFoundError(f"No saved ICA objects found for pipeline '{pipeline_name}' in {[str(p) for p in ICA_DIR_CANDIDATES]}")
+
+    n_workers = _resolve_n_workers(n_workers, max_memory_mb)
+    if logger is not None:
+        logger.info("ICLabel batch %s: %s subjects, %s workers", pipeline_name, len(subjects), n_workers)
+
+    records = {}
+    with ProcessPoolExecutor(
+        max_workers=min(n_workers, len(subjects)),
+        initializer=_limit_worker_memory,
+        initargs=(max_memory_mb,),
+        max_tasks_per_child=1,
+    ) as executor:
+        futures = {
+            executor.submit(_label_subject, subject_id, pipeline_name, str(bids_root)): subject_id
+            for subject_id in subjects
+        }
+        for future in as_completed(futures):
+            subject_id = futures[future]
+            try:
+                record = future.result()
+            except BrokenProcessPool:
+                record = {
+                    "subject_id": subject_id, "pipeline": pipeline_name, "status": "failed",
+                    "error": "Worker process terminated abruptly (e.g. out of memory).",
+                }
+            records[subject_id] = record
+            if logger is not None:
+                logger.info("sub-%s: %s", subject_id, record["status"])
+
+    return pd.DataFrame([records[subject_id] for subject_id in subjects])
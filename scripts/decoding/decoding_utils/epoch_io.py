@@ -1,18 +1,25 @@
 import mne
 import numpy as np
 import pandas as pd
+import shutil
 
-from functools import lru_cache
+from functools import lru_cache, partial
 from pathlib import Path
 from mne_bids import BIDSPath, read_raw_bids
 import utils.ccs_eeg_utils as ccs_eeg_utils
-from pipeline.s00_add_reference import add_reference_channel
-from pipeline.s01_downsample_filter import down_sampling, band_filter, notch_filter
-from pipeline.s02_drop_bad_channels import drop_bad_channels, reref
+from utils.memmap_raw import make_scratch_dir, preload_memmap, run_chunked
+from utils.memory_profile import MemoryTracker, compare_memory_reports, track_stage
+from utils.stage_cache import cached_stage, file_identity, materialize, report_cache_stats
+from utils.tools import get_event_index, get_float_dtype
+from pipeline.s00_add_reference import add_reference_channel, reref
+from pipeline.s01_downsample_filter import down_sampling, band_filter, notch_filter, multi_band_filter, chain_support_sec
+from pipeline.s02_drop_bad_channels import drop_bad_channels
 from pipeline.s03_07_trial_rejection import trial_rejection_cust, trial_rejection_mne
-from pipeline.s04_ICA import get_ica, iccomponent_removal_author, iccomponent_removal_new
+from pipeline.s04_ICA import _match_components, get_ica, iccomponent_removal
 from pipeline.s05_interpolation import interpolation
+from pipeline.s06_early_trial_removal import exclude_early_trials
 from pipeline.s07_epoching import epoching, epoching_cust
+from pipeline.s08_find_bad_channels import find_bad_channels
 import config
 
 
@@ -83,26 +90,40 @@ def _fit_or_load_ica(
     trials: mne.Epochs,
     subject_id: str,
     pipeline_name: str,
+    refit: bool | None = None,
 ):
     '''
     Attempt to load a pre-fitted ICA object for the given subject and pipeline. If not found, fit a new ICA on the provided trials and save it for future use.
+    With refit (defaults to config.ICA_WARM_START), a saved ICA is used as the warm start of a new fit on the trials instead. The refit is not saved, since the hand-picked ic_excluded indices of config.SUBJECT_INFO refer to the saved ICA: they are mapped to the matching components of the refit.
+    Returns the ICA object, the path of its saved file (None for a refit) and the components to exclude (None to use the config / ICLabel, see iccomponent_removal).
     '''
+    if refit is None:
+        refit = config.ICA_WARM_START
+    method = config.PIPELINES[pipeline_name]["ica_method"]
     try:
-        return mne.preprocessing.read_ica(_get_ica_path(subject_id, pipeline_name))
+        ica_path = _get_ica_path(subject_id, pipeline_name)
     except FileNotFoundError:
         save_dir = ICA_DIR_CANDIDATES[0]
         save_dir.mkdir(parents=True, exist_ok=True)
         save_path = save_dir / f"{pipeline_name}-sub{subject_id}_ica.fif"
-        return get_ica(
-            trials,
-            method=config.PIPELINES[pipeline_name]["ica_method"],
-            save_path=save_path,
-        )
+        return get_ica(trials, method=method, save_path=save_path), save_path, None
+
+    saved_ica = mne.preprocessing.read_ica(ica_path)
+    if not refit:
+        return saved_ica, ica_path, None
+
+    ica = get_ica(trials, method=method, save_path=None, warm_start=saved_ica)
+    exclude_idx = config.SUBJECT_INFO[subject_id]["ic_excluded"][pipeline_name]
+    if exclude_idx is not None:
+        matched, _ = _match_components(saved_ica, ica)
+        exclude_idx = [int(matched[i]) for i in exclude_idx if i < len(matched) and matched[i] >= 0]
+    return ica, None, exclude_idx
 
 
-def _load_bids_raw(subject_id: str, bids_root: Path, pipeline_name: str = "proposed") -> mne.io.BaseRaw:
+def _open_bids_raw(subject_id: str, bids_root: str):
     '''
-    Load the raw EEG data for a given subject from the BIDS directory, apply the custom montage, and perform initial preprocessing steps (downsampling, filtering, bad channel handling, and re-referencing) according to the specified pipeline.
+    Open the raw EEG data for a given subject from the BIDS directory with its annotations, without loading the data.
+    Returns the Raw object and the custom montage.
     '''
     bids_root = Path(bids_root)
     bids_path = BIDSPath(
@@ -114,22 +135,235 @@ def _load_bids_raw(subject_id: str, bids_root: Path, pipeline_name: str = "propo
     )
     raw = read_raw_bids(bids_path, verbose="ERROR")
     ccs_eeg_utils.read_annotations_core(bids_path, raw)
-    raw.load_data()
 
     montage_path = bids_root / "code" / config.LOCS_FILENAME["site2"]
-    montage = _load_site2_montage(str(montage_path))
-    cfg = config.PIPELINES[pipeline_name]
-    bad_channels = config.SUBJECT_INFO[subject_id]["bad_channels"]
+    return raw, _load_site2_montage(str(montage_path))
 
+
+def _add_reference_and_montage(raw: mne.io.BaseRaw, montage) -> mne.io.BaseRaw:
+    '''
+    Add the Fz reference channel and apply the custom montage (in place).
+    '''
     raw = add_reference_channel(raw, "Fz")
     raw.set_montage(montage, match_case=False)
+    return raw
+
+
+def _read_bids_raw(subject_id: str, bids_root: str) -> mne.io.BaseRaw:
+    '''
+    Read the raw EEG data for a given subject from the BIDS directory with its annotations, add the Fz reference channel and apply the custom montage.
+    '''
+    raw, montage = _open_bids_raw(subject_id, bids_root)
+    raw.load_data()
+    return _add_reference_and_montage(raw, montage)
+
+
+def _drop_bad_channels_stage(eeg: mne.io.BaseRaw, bad_channels) -> mne.io.BaseRaw:
+    '''
+    drop_bad_channels with the (raw, **params) signature of a cached stage.
+    '''
+    return drop_bad_channels(bad_channels, eeg)
+
+
+def _band_notch_stage(eeg: mne.io.BaseRaw, f_low, f_high, line_freq, dtype) -> mne.io.BaseRaw:
+    '''
+    Bandpass + notch filter applied in a single FFT pass (see multi_band_filter), in the precision given by dtype.
+    '''
+    return multi_band_filter(eeg, {"out": dict(f_low=f_low, f_high=f_high, line_freq=line_freq)}, dtype=dtype)["out"]
+
+
+def _cached_preprocessing_stages(subject_id: str, bids_root: Path, pipeline_name: str, logger=None):
+    '''
+    Declare the cached preprocessing chain (BIDS read -> downsampling -> filtering -> bad channels -> re-referencing).
+    Returns the stage nodes of the ERP branch and of the ICA branch (None for the original pipeline, which fits ICA on the ERP branch).
+    '''
+    bids_root = Path(bids_root)
+    bad_channels = config.SUBJECT_INFO[subject_id]["bad_channels"][pipeline_name]
+    identity = file_identity([
+        bids_root / f"sub-{subject_id}" / "eeg",
+        bids_root / "code" / config.LOCS_FILENAME["site2"],
+    ])
+
+    read_node = cached_stage(
+        "read_bids", _read_bids_raw,
+        params={"subject_id": subject_id, "bids_root": str(bids_root)},
+        identity=identity, logger=logger,
+    )
+    down_node = cached_stage(
+        "down_sampling", partial(down_sampling, verbose=False),
+        params={"new_sfreq": config.SAMPLING_RATE, "method": config.RESAMPLE_METHOD}, upstream=read_node, logger=logger,
+    )
+
+    # ERP branch: bandpass + notch
+    if config.SHARED_FFT_FILTER:
+        erp_notch = cached_stage(
+            "band_notch_filter", _band_notch_stage,
+            params={"f_low": config.BANDPASS_FREQS[0], "f_high": config.BANDPASS_FREQS[1], "line_freq": config.NOTCH_FREQS,
+                    "dtype": get_float_dtype().name},
+            upstream=down_node, logger=logger,
+        )
+    else:
+        erp_band = cached_stage(
+            "band_filter", band_filter,
+            params={"f_low": config.BANDPASS_FREQS[0], "f_high": config.BANDPASS_FREQS[1]}, upstream=down_node, logger=logger,
+        )
+        erp_notch = cached_stage(
+            "notch_filter", notch_filter,
+            params={"line_freq": config.NOTCH_FREQS}, upstream=erp_band, logger=logger,
+        )
+    erp_drop = cached_stage(
+        "drop_bad_channels", _drop_bad_channels_stage,
+        params={"bad_channels": bad_channels}, upstream=erp_notch, logger=logger,
+    )
+    erp_node = cached_stage(
+        "reref", partial(reref, verbose=False), upstream=erp_drop, logger=logger,
+    )
+    if pipeline_name == "original":
+        return erp_node, None
+
+    # ICA branch: wider bandpass to fit the range of ICLabel
+    ica_band = cached_stage(
+        "band_filter", band_filter,
+        params={"f_low": 1, "f_high": 100}, upstream=down_node, logger=logger,
+    )
+    ica_drop = cached_stage(
+        "drop_bad_channels", _drop_bad_channels_stage,
+        params={"bad_channels": bad_channels}, upstream=ica_band, logger=logger,
+    )
+    ica_node = cached_stage(
+        "reref", partial(reref, verbose=False), upstream=ica_drop, logger=logger,
+    )
+    return erp_node, ica_node
 
-    eeg_down = down_sampling(raw, verbose=False)
-    eeg_band = band_filter(eeg_down)
-    eeg_band_notch = notch_filter(eeg_band)
-    eeg_band_notch = drop_bad_channels(bad_channels, eeg_band_notch)
-    eeg_band_notch = reref(eeg_band_notch, verbose=False)
 
+def _branch_bands(pipeline_name: str) -> dict:
+    '''
+    Filters of the preprocessing branches (see multi_band_filter): the ERP branch, and for the proposed pipeline the ICA branch with a wider bandpass to fit the range of ICLabel.
+    '''
+    bands = {"erp": dict(f_low=config.BANDPASS_FREQS[0], f_high=config.BANDPASS_FREQS[1], line_freq=config.NOTCH_FREQS)}
+    if pipeline_name != "original":
+        bands["ica"] = dict(f_low=1, f_high=100)
+    return bands
+
+
+def _filter_branches(load_raw, pipeline_name: str, bad_channels, inplace: bool = True, tracker: MemoryTracker | None = None,
+                     resample_method: str | None = None):
+    '''
+    Downsample, filter, drop the bad channels and re-reference the recording returned by load_raw (called here, so that the full-rate recording can be released once downsampled).
+    Returns the ERP branch and the ICA branch (None for the original pipeline).
+    '''
+    with track_stage(tracker, "read_bids"):
+        raw = load_raw()
+
+    with track_stage(tracker, "down_sampling"):
+        eeg_down = down_sampling(raw, new_sfreq=config.SAMPLING_RATE, verbose=False, method=resample_method or config.RESAMPLE_METHOD)
+        del raw
+    with track_stage(tracker, "filter"):
+        if config.SHARED_FFT_FILTER:
+            # both branches are filtered from one FFT of the downsampled signal
+            branches = multi_band_filter(eeg_down, _branch_bands(pipeline_name))
+            del eeg_down
+            eeg_band_notch, eeg_ica = branches["erp"], branches.get("ica")
+            del branches
+        elif inplace:
+            # the ICA branch is the only one needing its own copy, the ERP branch reuses the downsampled buffer
+            eeg_ica = None if pipeline_name == "original" else band_filter(eeg_down.copy(), f_low=1, f_high=100)
+            eeg_band_notch = notch_filter(band_filter(eeg_down, *config.BANDPASS_FREQS), config.NOTCH_FREQS)
+            del eeg_down
+        else:
+            eeg_band = band_filter(eeg_down.copy(), *config.BANDPASS_FREQS)
+            eeg_band_notch = notch_filter(eeg_band, config.NOTCH_FREQS)
+            eeg_ica = None if pipeline_name == "original" else band_filter(eeg_down, f_low=1, f_high=100)
+
+    with track_stage(tracker, "drop_bad_channels"):
+        eeg_band_notch = drop_bad_channels(bad_channels, eeg_band_notch, copy=not inplace)
+        if eeg_ica is not None:
+            eeg_ica = drop_bad_channels(bad_channels, eeg_ica, copy=not inplace)
+    with track_stage(tracker, "reref"):
+        eeg_band_notch = reref(eeg_band_notch, verbose=False)
+        if eeg_ica is not None:
+            eeg_ica = reref(eeg_ica, verbose=False)
+
+    return eeg_band_notch, eeg_ica
+
+
+def _preprocess_memmap(subject_id: str, bids_root: Path, pipeline_name: str = "proposed", inplace: bool = True,
+                       tracker: MemoryTracker | None = None):
+    '''
+    Same as the uncached chain of _preprocess_branches, with bounded memory: the full-rate recording is loaded into a memmap in a scratch directory (see utils.memmap_raw) and downsampled, filtered and re-referenced chunk by chunk into memmaps at the new sampling rate.
+    Downsampling uses the polyphase method, whose FIR filter can run on chunks with the same result as on the whole recording.
+    '''
+    bad_channels = config.SUBJECT_INFO[subject_id]["bad_channels"][pipeline_name]
+
+    def process(chunk):
+        eeg_band_notch, eeg_ica = _filter_branches(
+            lambda: _add_reference_and_montage(chunk, montage), pipeline_name, bad_channels, inplace=inplace,
+            resample_method="polyphase",
+        )
+        return {"erp": eeg_band_notch} if eeg_ica is None else {"erp": eeg_band_notch, "ica": eeg_ica}
+
+    scratch_dir = make_scratch_dir(prefix=f"sub-{subject_id}_")
+    try:
+        with track_stage(tracker, "read_bids"):
+            raw, montage = _open_bids_raw(subject_id, bids_root)
+            data = preload_memmap(raw, scratch_dir / "raw.npy")
+        try:
+            with track_stage(tracker, "chunked_stages"):
+                halo_sec = chain_support_sec(raw.info["sfreq"], config.SAMPLING_RATE, _branch_bands(pipeline_name))
+                branches = run_chunked(
+                    data, raw.info, process, halo_sec, scratch_dir, new_sfreq=config.SAMPLING_RATE,
+                    chunk_sec=config.MEMMAP_CHUNK_SEC, first_samp=raw.first_samp, annotations=raw.annotations,
+                )
+        finally:
+            del data
+            (scratch_dir / "raw.npy").unlink(missing_ok=True)
+    except BaseException:
+        # partial outputs are not attached to any Raw object yet, so nothing else would remove them
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise
+    # the remaining output memmaps, and then the scratch directory, are removed with the returned objects (see run_chunked)
+    return branches["erp"], branches.get("ica")
+
+
+def _preprocess_branches(subject_id: str, bids_root: Path, pipeline_name: str = "proposed", use_cache: bool | None = None,
+                         logger=None, inplace: bool | None = None, tracker: MemoryTracker | None = None,
+                         memmap: bool | None = None):
+    '''
+    Load the raw EEG data for a given subject from the BIDS directory, apply the custom montage, and perform initial preprocessing steps (downsampling, filtering, bad channel handling, and re-referencing) according to the specified pipeline.
+    With use_cache (defaults to config.STAGE_CACHE), the outputs of these steps are cached on disk and the chain resumes from the deepest cached step.
+    With inplace (defaults to config.INPLACE_PIPELINE), every step modifies its input instead of a copy and intermediate recordings are released as soon as they are consumed.
+    With memmap (defaults to config.MEMMAP_RAW), the steps run chunk by chunk on a disk-backed copy of the recording (see _preprocess_memmap), bypassing the stage cache.
+    Stages are recorded in tracker (see utils.memory_profile) if given.
+    Returns the ERP branch and the ICA branch (None for the original pipeline, which fits ICA on the ERP branch).
+    '''
+    if use_cache is None:
+        use_cache = config.STAGE_CACHE
+    if inplace is None:
+        inplace = config.INPLACE_PIPELINE
+    if memmap is None:
+        memmap = config.MEMMAP_RAW
+
+    if memmap:
+        return _preprocess_memmap(subject_id, bids_root, pipeline_name, inplace=inplace, tracker=tracker)
+    if use_cache:
+        erp_node, ica_node = _cached_preprocessing_stages(subject_id, bids_root, pipeline_name, logger=logger)
+        with track_stage(tracker, "cached_stages"):
+            eeg_band_notch = materialize(erp_node)
+            eeg_ica = None if ica_node is None else materialize(ica_node)
+        report_cache_stats(logger)
+        return eeg_band_notch, eeg_ica
+
+    bad_channels = config.SUBJECT_INFO[subject_id]["bad_channels"][pipeline_name]
+    return _filter_branches(
+        lambda: _read_bids_raw(subject_id, bids_root), pipeline_name, bad_channels, inplace=inplace, tracker=tracker,
+    )
+
+
+def _get_ica_trials(eeg_band_notch: mne.io.BaseRaw, eeg_ica: mne.io.BaseRaw | None, pipeline_name: str) -> mne.Epochs:
+    '''
+    Build the onset-locked trials the ICA of the given pipeline is fitted on (after trial rejection).
+    '''
+    cfg = config.PIPELINES[pipeline_name]
     if pipeline_name == "original":
         ica_trials, _ = trial_rejection_cust(
             eeg_band_notch,
@@ -137,32 +371,94 @@ def _load_bids_raw(subject_id: str, bids_root: Path, pipeline_name: str = "propo
             **cfg["rejection_params"]["ica"],
         )
     else:
-        eeg_ica = band_filter(eeg_down.copy(), f_low=1, f_high=100)
-        eeg_ica = drop_bad_channels(bad_channels, eeg_ica)
-        eeg_ica = reref(eeg_ica, verbose=False)
         ica_trials = trial_rejection_mne(
             eeg_ica,
             config.CONDITIONS_DICT["onset_locked"],
             **cfg["rejection_params"]["ica"],
         )
+    return ica_trials
 
-    ica = _fit_or_load_ica(ica_trials, subject_id, pipeline_name)
-    if pipeline_name == "original":
-        eeg_clean = iccomponent_removal_author(
-            eeg_band_notch,
-            ica_trials,
-            ica,
-            subject_id,
-        )
-    else:
-        eeg_clean = iccomponent_removal_new(
-            eeg_band_notch,
-            ica_trials,
-            ica,
-            subject_id,
+
+def _load_bids_raw(subject_id: str, bids_root: Path, pipeline_name: str = "proposed", use_cache: bool | None = None,
+                   logger=None, inplace: bool | None = None, tracker: MemoryTracker | None = None,
+                   memmap: bool | None = None) -> mne.io.BaseRaw:
+    '''
+    Load and preprocess the raw EEG data for a given subject (see _preprocess_branches), then remove the bad ICA components and interpolate the bad channels according to the specified pipeline.
+    '''
+    if inplace is None:
+        inplace = config.INPLACE_PIPELINE
+    eeg_band_notch, eeg_ica = _preprocess_branches(
+        subject_id, bids_root, pipeline_name, use_cache=use_cache, logger=logger, inplace=inplace, tracker=tracker,
+        memmap=memmap,
+    )
+    with track_stage(tracker, "ica_trials"):
+        ica_trials = _get_ica_trials(eeg_band_notch, eeg_ica, pipeline_name)
+        if inplace:
+            del eeg_ica     # only needed for the (preloaded) ICA trials
+
+    with track_stage(tracker, "ica"):
+        ica, ica_path, exclude_idx = _fit_or_load_ica(ica_trials, subject_id, pipeline_name)
+    with track_stage(tracker, "ic_removal"):
+        # removes the components from eeg_band_notch in place
+        iccomponent_removal(eeg_band_notch, ica_trials, ica, subject_id, pipeline_name, ica_path=ica_path,
+                            exclude_idx=exclude_idx)
+        eeg_clean = eeg_band_notch
+        if inplace:
+            del ica_trials
+
+    with track_stage(tracker, "interpolation"):
+        return interpolation(eeg_clean, verbose=False)
+
+
+def _profile_chain(subject_id: str, bids_root: str, pipeline_name: str, inplace: bool) -> pd.DataFrame:
+    '''
+    Run the s00-s08 chain of one subject (without the stage cache) and return its per-stage memory report.
+    Runs in its own worker process, so that the peak RSS of one run does not include the other run.
+    '''
+    cfg = config.PIPELINES[pipeline_name]
+    tracker = MemoryTracker()
+    raw = _load_bids_raw(subject_id, Path(bids_root), pipeline_name, use_cache=False, inplace=inplace, tracker=tracker)
+    with track_stage(tracker, "early_trial_removal"):
+        raw = exclude_early_trials(raw, cfg["early_trial_deletion"], verbose=False, mode="inplace" if inplace else "copy")
+    with track_stage(tracker, "epoching"):
+        epochs, rejection_info = build_feedback_epochs_from_raw(raw, pipeline_name)
+        if inplace:
+            del raw
+    with track_stage(tracker, "find_bad_channels"):
+        find_bad_channels(
+            epochs, cfg["bad_channels_rejection_criteria"], subject_id,
+            custom=pipeline_name == "original", rejection_info=rejection_info, verbose=False,
         )
+    return tracker.report()
+
 
-    return interpolation(eeg_clean, verbose=False)
+def profile_preprocessing_memory(subject_id: str, bids_root: Path, pipeline_name: str = "proposed",
+                                 out_path: Path | None = None, logger=None) -> pd.DataFrame:
+    '''
+    Run the s00-s08 chain of one subject once with copies between the steps and once in place (each in a fresh
+    process) and report the peak RSS and peak allocated memory of every stage and of the whole chain for both runs.
+    The ICA of the subject must already be saved, so that both runs load it instead of fitting it.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    _get_ica_path(subject_id, pipeline_name)    # raises FileNotFoundError if the ICA has not been saved yet
+    reports = {}
+    for inplace in (False, True):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            reports[inplace] = executor.submit(_profile_chain, subject_id, str(bids_root), pipeline_name, inplace).result()
+
+    comparison = compare_memory_reports(reports[False], reports[True])
+    if out_path is not None:
+        out_path = Path(out_path)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        comparison.to_csv(out_path, index=False)
+    if logger is not None:
+        overall = comparison.iloc[-1]
+        logger.info(
+            "sub-%s %s: peak RSS %.0f MB (copy) -> %.0f MB (in place)\n%s",
+            subject_id, pipeline_name, overall["peak_rss_mb_copy"], overall["peak_rss_mb_inplace"], comparison.to_string(index=False),
+        )
+    return comparison
 
 
 def build_feedback_epochs_from_raw(
@@ -276,10 +572,11 @@ def build_feedback_metadata(raw: mne.io.BaseRaw, behavior: pd.DataFrame) -> pd.D
     '''
     Build a metadata DataFrame for feedback-locked epochs by aligning the feedback events extracted from the raw EEG data with the corresponding rows in the behavior DataFrame. Validates that the contexts and outcomes match between the two sources and constructs a comprehensive metadata table for downstream analysis.
     '''
-    events, event_id = mne.events_from_annotations(raw, verbose=False)
+    index = get_event_index(raw)
+    events = index.events
 
     event_code_map = {}
-    for event_name, actual_id in event_id.items():
+    for event_name, actual_id in index.event_id.items():
         digits = "".join(ch for ch in str(event_name) if ch.isdigit())
         if not digits:
             continue
@@ -16,11 +16,13 @@ try:
     from .epoch_io import load_epochs
 except ImportError:
     from decoding.decoding_utils.epoch_io import load_epochs
+from utils.tools import get_epochs_data
 
 
-def decode_context(epochs: mne.Epochs, context: str, n_splits: int = 5):
+def decode_context(epochs: mne.Epochs, context: str, n_splits: int = 5, dtype=None):
     '''
     Perform time-resolved decoding of feedback outcome (win vs. loss) for a single context.
+    The features are passed to the classifier in the precision given by dtype (defaults to config.FLOAT_DTYPE).
     '''
     mask = epochs.metadata["context"] == context
     if int(mask.sum()) == 0:
@@ -38,7 +40,7 @@ def decode_context(epochs: mne.Epochs, context: str, n_splits: int = 5):
         raise RuntimeError(f"Not enough trials to decode {context}: class counts {class_counts.tolist()}")
 
     cv_splits = min(n_splits, min_class_n)
-    X = context_epochs.get_data(copy=True)
+    X = get_epochs_data(context_epochs, dtype)
 
     estimator = make_pipeline(
         StandardScaler(),
@@ -16,6 +16,7 @@ try:
     from .epoch_io import load_epochs
 except ImportError:
     from decoding.decoding_utils.epoch_io import load_epochs
+from utils.tools import get_epochs_data
 
 
 def decode_context_window(
@@ -24,9 +25,11 @@ def decode_context_window(
     window_start: float = 0.24,
     window_end: float = 0.34,
     n_splits: int = 5,
+    dtype=None,
 ):
     '''
-    Perform window-decoding for a single subject and context.'''
+    Perform window-decoding for a single subject and context.
+    The features are passed to the classifier in the precision given by dtype (defaults to config.FLOAT_DTYPE).'''
     mask = epochs.metadata["context"] == context
     if int(mask.sum()) == 0:
         raise RuntimeError(f"No epochs available for context '{context}'.")
@@ -49,7 +52,7 @@ def decode_context_window(
         raise RuntimeError(f"Not enough trials to decode {context}: class counts {class_counts.tolist()}")
 
     cv_splits = min(n_splits, min_class_n)
-    X = context_epochs.get_data(copy=True)
+    X = get_epochs_data(context_epochs, dtype)
 
     estimator = make_pipeline(
         Vectorizer(),
@@ -205,3 +208,52 @@ def run_group_decoding_window(
     summary_df = pd.DataFrame(summary_rows)
     group_stats = compute_group_stats_window(summary_df, contexts)
     return summary_df, group_stats, auc_store
+
+
+FLOAT32_AUC_TOL = 0.01  # max abs difference of float32 vs float64 mean AUCs
+
+
+def check_float32_decoding(
+    subjects: list[str],
+    pipeline_name: str,
+    contexts: list[str],
+    window_start: float = 0.24,
+    window_end: float = 0.34,
+    root_dir: Path | None = None,
+    tol: float = FLOAT32_AUC_TOL,
+    logger=None,
+) -> pd.DataFrame:
+    '''
+    Regression check of the float32 mode: run window-decoding with float64 and float32 features and compare
+    the mean AUC of every subject and context. Returns the per subject-context table of both AUCs and their
+    absolute difference, and raises RuntimeError if any difference exceeds tol.
+    '''
+    rows = []
+    for subject_id in subjects:
+        epochs = load_epochs(subject_id, pipeline_name, lock="feedback", preload=True, root_dir=root_dir)
+        for context in contexts:
+            try:
+                aucs = {
+                    dtype: decode_context_window(
+                        epochs, context=context, window_start=window_start, window_end=window_end, dtype=dtype,
+                    )["mean_auc"]
+                    for dtype in ("float64", "float32")
+                }
+            except (RuntimeError, ValueError) as exc:
+                warnings.warn(f"Skipping sub-{subject_id} {context}: {exc}")
+                continue
+            rows.append({
+                "subject_id": subject_id,
+                "context": context,
+                "auc_float64": aucs["float64"],
+                "auc_float32": aucs["float32"],
+                "abs_diff": abs(aucs["float64"] - aucs["float32"]),
+            })
+
+    check_df = pd.DataFrame(rows)
+    max_diff = float(check_df["abs_diff"].max()) if len(check_df) else 0.0
+    if logger is not None:
+        logger.info("float32 vs float64 decoding: max |AUC difference| = %.2e (tolerance %.0e)", max_diff, tol)
+    if max_diff > tol:
+        raise RuntimeError(f"float32 decoding AUCs differ from float64 by {max_diff:.2e} (tolerance {tol:.0e}).")
+    return check_df
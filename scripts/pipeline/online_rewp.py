@@ -0,0 +1,378 @@
+import socket
+import struct
+import time
+
+import mne
+import numpy as np
+from scipy import signal
+
+from pipeline.s03_07_trial_rejection import _scan_artifact_block
+from pipeline.s06_early_trial_removal import TASK_START_EVENTS
+from pipeline.s10_rewp_calculation import CONDITION_PAIRS
+from utils.tools import _normalize_event_key, get_event_index
+import config
+
+
+# frame headers of the socket stream: kind (b'D' data, b'M' marker, b'E' end of stream) and two unsigned integers
+_FRAME_HEADER = struct.Struct('<cQI')
+
+
+def causal_filter_sos(sfreq, f_low=0.1, f_high=30, line_freq=50):
+    '''
+    Causal counterpart of band_filter (+ notch_filter) of s01: the FIR filters of s01 are zero-phase and need the
+    samples after each time point, so the online chain uses a 4th order Butterworth bandpass as designed by MNE for
+    method='iir', phase='forward', followed by an IIR notch at the line frequency.
+
+    :param sfreq: sampling frequency
+    :param f_low: low cutoff frequency
+    :param f_high: high cutoff frequency
+    :param line_freq: line frequency to be removed (None for no notch)
+
+    :return: second-order sections of the cascade, for scipy.signal.sosfilt
+    '''
+    sos = mne.filter.create_filter(
+        None, sfreq, l_freq=f_low, h_freq=f_high, method='iir', phase='forward',
+        iir_params=dict(order=4, ftype='butter', output='sos'), verbose=False,
+    )['sos']
+    if line_freq is not None:
+        b, a = signal.iirnotch(line_freq, Q=30, fs=sfreq)
+        sos = np.vstack([sos, signal.tf2sos(b, a)])
+    return sos
+
+
+class OnlineRewP:
+    '''
+    Incremental RewP estimation from chunks of raw samples.
+
+    Every chunk is filtered causally at the input rate (see causal_filter_sos), decimated to new_sfreq and
+    re-referenced to the mastoids, then kept in a ring buffer. The markers of the first trials of each task type are
+    skipped (as exclude_early_trials, the task start markers arrive before the markers of their trial). The
+    feedback-locked window of every other marker of conditions_dict is cut as soon as its last sample has arrived,
+    baseline corrected, checked with the ERP rejection thresholds of the pipeline and added to the running average
+    of its condition.
+    '''
+
+    def __init__(self, ch_names, sfreq, pipeline_name='proposed', bad_channels=(), conditions_dict=None,
+                 new_sfreq=None, channel='FCz', mean_window=(0.240, 0.340), ref_channel='Fz', num_to_exclude=None):
+        '''
+        :param ch_names: channel names of the incoming chunks
+        :param sfreq: sampling frequency of the incoming chunks
+        :param pipeline_name: pipeline whose ERP rejection parameters are used ('original': custom checks,
+                              'proposed': MNE peak-to-peak checks)
+        :param bad_channels: channels left out of the averages (as drop_bad_channels)
+        :param conditions_dict: mapping of condition name to event markers, defaults to config.CONDITIONS_DICT['feedback_locked']
+        :param new_sfreq: sampling frequency of the epochs (an integer divisor of sfreq), defaults to config.SAMPLING_RATE
+        :param channel: channel of the RewP
+        :param mean_window: RewP time window (in seconds)
+        :param ref_channel: online reference channel, added as a flat channel if it is not streamed (as add_reference_channel)
+        :param num_to_exclude: number of early trials excluded per task type, defaults to the early_trial_deletion of the pipeline
+        '''
+        if conditions_dict is None:
+            conditions_dict = config.CONDITIONS_DICT['feedback_locked']
+        new_sfreq = config.SAMPLING_RATE if new_sfreq is None else new_sfreq
+        self.decim = int(round(sfreq / new_sfreq))
+        if self.decim < 1 or not np.isclose(sfreq / self.decim, new_sfreq):
+            raise ValueError(f"The new sampling rate {new_sfreq} Hz must divide the input rate {sfreq} Hz.")
+        self.sfreq, self.new_sfreq = float(sfreq), float(new_sfreq)
+        self.pipeline_name = pipeline_name
+        params = config.PIPELINES[pipeline_name]['rejection_params']['erp']
+        self.rejection = {k: v for k, v in params.items() if k not in ('tmin', 'tmax', 'baseline')}
+
+        # channel layout: streamed channels (+ flat reference), the averages only keep the good channels
+        self.n_in = len(ch_names)
+        self.add_ref = ref_channel is not None and ref_channel not in ch_names
+        all_names = list(ch_names) + ([ref_channel] if self.add_ref else [])
+        self.keep = np.array([i for i, name in enumerate(all_names) if name not in set(bad_channels)])
+        kept_names = [all_names[i] for i in self.keep]
+        mastoids = [name for name in ('TP9', 'TP10') if name in kept_names]
+        if not mastoids:
+            raise ValueError("Neither TP9 nor TP10 are available for re-referencing.")
+        self.ref_idx = [kept_names.index(name) for name in mastoids]
+        # single mastoid reference: the reference channel is dropped (see reref)
+        self.out_idx = np.array([i for i in range(len(kept_names)) if len(mastoids) == 2 or i not in self.ref_idx])
+        self.ch_names = [kept_names[i] for i in self.out_idx]
+        self.rewp_idx = self.ch_names.index(channel)
+
+        # causal filter state of every streamed channel (the flat reference channel stays zero), set on the first chunk
+        self.sos = causal_filter_sos(sfreq, *config.BANDPASS_FREQS, config.NOTCH_FREQS)
+        self.zi = None
+        self.n_in_seen = 0      # input samples received so far
+
+        # epoch layout, as mne.Epochs at new_sfreq
+        first = int(round(params['tmin'] * new_sfreq))
+        last = int(round(params['tmax'] * new_sfreq))
+        self.offsets = np.arange(first, last + 1)
+        self.times = self.offsets / self.new_sfreq
+        baseline = params['baseline']
+        self.baseline_mask = None if baseline is None else (self.times >= baseline[0]) & (self.times <= baseline[1])
+        self.rewp_window = ((np.atleast_1d(mean_window) - self.times[0]) * self.new_sfreq).astype(int)
+
+        # ring buffer of the processed samples at new_sfreq
+        self.capacity = 4 * len(self.offsets)
+        self.buffer = np.zeros((len(self.ch_names), self.capacity))
+        self.n_out = 0          # processed samples written so far
+
+        # marker description -> condition (one marker may belong to several conditions)
+        self.marker_conditions = {}
+        for name, markers in conditions_dict.items():
+            for marker in markers:
+                self.marker_conditions.setdefault(_normalize_event_key(marker), []).append(name)
+        self.pending = []       # (sample at new_sfreq, conditions) of markers whose window is not complete yet
+
+        # early trial exclusion, as get_early_trial_mask: trials counted per task type from their start markers
+        if num_to_exclude is None:
+            num_to_exclude = config.PIPELINES[pipeline_name]['early_trial_deletion']
+        self.num_to_exclude = num_to_exclude
+        self.task_type = {_normalize_event_key(name): task_type
+                          for task_type, names in enumerate(TASK_START_EVENTS.values()) for name in names}
+        self.n_trials = np.zeros(len(TASK_START_EVENTS), dtype=int)
+        self.in_early_trial = False     # markers before the first task start are never excluded
+        self.n_early = 0        # markers of conditions_dict skipped as part of an early trial
+        self.sums = {name: np.zeros((len(self.ch_names), len(self.offsets))) for name in conditions_dict}
+        self.counts = dict.fromkeys(conditions_dict, 0)
+        self.n_rejected = dict.fromkeys(conditions_dict, 0)
+
+    def push(self, data, markers=()):
+        '''
+        Process one chunk of raw samples and the markers received with it.
+
+        :param data: array of shape (n_channels, n_samples) in Volts
+        :param markers: iterable of (sample, description), sample counted from the first streamed sample at the input rate
+
+        :return: list of (condition, accepted) of the windows completed by this chunk
+        '''
+        for sample, description in markers:
+            key = _normalize_event_key(description)
+            task_type = self.task_type.get(key)
+            if task_type is not None:
+                self.in_early_trial = self.n_trials[task_type] < self.num_to_exclude
+                self.n_trials[task_type] += 1
+            conditions = self.marker_conditions.get(key)
+            if conditions is not None and self.in_early_trial:
+                self.n_early += 1
+            elif conditions is not None:
+                # same rounding as events_from_annotations on the downsampled recording
+                self.pending.append((int(round(sample / self.sfreq * self.new_sfreq)), conditions))
+
+        data = np.asarray(data, dtype=np.float64)
+        y = data
+        if data.shape[1]:
+            if self.zi is None:
+                # steady state for the first sample held constant before the stream, which avoids a startup transient
+                self.zi = signal.sosfilt_zi(self.sos)[:, None, :] * data[:, :1]
+            y, self.zi = signal.sosfilt(self.sos, data, axis=1, zi=self.zi)
+        # keep the samples on the grid of the new sampling rate
+        y = y[:, (-self.n_in_seen) % self.decim::self.decim]
+        self.n_in_seen += data.shape[1]
+        if self.add_ref:
+            y = np.vstack([y, np.zeros((1, y.shape[1]))])
+        y = y[self.keep]
+        y = (y - y[self.ref_idx].mean(axis=0))[self.out_idx]
+
+        completed = []
+        # write in pieces that never overwrite a window still pending
+        step = self.capacity - len(self.offsets)
+        for start in range(0, y.shape[1], step):
+            piece = y[:, start:start + step]
+            idx = np.arange(self.n_out, self.n_out + piece.shape[1]) % self.capacity
+            self.buffer[:, idx] = piece
+            self.n_out += piece.shape[1]
+            completed.extend(self._cut_windows())
+        if y.shape[1] == 0:
+            completed.extend(self._cut_windows())
+        return completed
+
+    def _cut_windows(self):
+        '''
+        Cut, check and average the pending windows whose samples are all in the ring buffer.
+        '''
+        completed = []
+        still_pending = []
+        for sample, conditions in self.pending:
+            first, last = sample + self.offsets[0], sample + self.offsets[-1]
+            if last >= self.n_out:
+                still_pending.append((sample, conditions))
+                continue
+            if first < 0 or first < self.n_out - self.capacity:
+                continue    # window starts before the stream, or marker arrived too late (dropped as by mne.Epochs)
+            epoch = self.buffer[:, np.arange(first, last + 1) % self.capacity]
+            if self.baseline_mask is not None:
+                epoch = epoch - epoch[:, self.baseline_mask].mean(axis=1, keepdims=True)
+            accepted = not self._is_artifact(epoch)
+            for name in conditions:
+                if accepted:
+                    self.sums[name] += epoch
+                    self.counts[name] += 1
+                else:
+                    self.n_rejected[name] += 1
+                completed.append((name, accepted))
+        self.pending = still_pending
+        return completed
+
+    def _is_artifact(self, epoch):
+        '''
+        ERP rejection thresholds of the pipeline: the four custom checks of trial_rejection_cust (original), or the
+        peak-to-peak checks of trial_rejection_mne (proposed).
+        '''
+        if self.pipeline_name == 'original':
+            criteria = {name: np.zeros((1, len(epoch)), dtype=bool) for name in ('maxMin', 'level', 'step', 'lowest')}
+            _scan_artifact_block(epoch[None], criteria=criteria, start=0, stop=1, **self.rejection)
+            return any(mask.any() for mask in criteria.values())
+        ptp = np.ptp(epoch, axis=1)
+        return bool(np.any(ptp > self.rejection['max']) or np.any(ptp < self.rejection['min']))
+
+    def averages(self):
+        '''
+        :return: running average of each condition with at least one accepted window, shape (n_channels, n_times)
+        '''
+        return {name: self.sums[name] / n for name, n in self.counts.items() if n > 0}
+
+    def evokeds(self):
+        '''
+        Running averages as Evoked objects, e.g. for rewp_calculation or plotting.
+        '''
+        info = mne.create_info(self.ch_names, self.new_sfreq, 'eeg')
+        return {
+            name: mne.EvokedArray(avg, info, tmin=self.times[0], nave=self.counts[name], comment=name, verbose=False)
+            for name, avg in self.averages().items()
+        }
+
+    def rewp(self):
+        '''
+        Current RewP metrics at the RewP channel, computed like rewp_calculation (window indices as
+        Evoked.time_as_index, inclusive end).
+
+        :return: dictionary mapping each condition pair to {'mean', 'max', 'p2p'} in µV (nan if a condition has no trials)
+        '''
+        i_start, i_end = self.rewp_window
+        results = {}
+        for label, win_key, loss_key in CONDITION_PAIRS:
+            if self.counts.get(win_key, 0) == 0 or self.counts.get(loss_key, 0) == 0:
+                results[label] = {'mean': np.nan, 'max': np.nan, 'p2p': np.nan}
+                continue
+            diff = (self.sums[win_key][self.rewp_idx, i_start:i_end + 1] / self.counts[win_key]
+                    - self.sums[loss_key][self.rewp_idx, i_start:i_end + 1] / self.counts[loss_key])
+            results[label] = {'mean': diff.mean() * 1e6, 'max': diff.max() * 1e6, 'p2p': np.ptp(diff) * 1e6}
+        return results
+
+
+def replay_chunks(raw, chunk_sec=0.1, realtime=False):
+    '''
+    Replay a recording (e.g. read from the BIDS directory, preloaded or not) as a stream of chunks.
+
+    :param raw: Raw object to replay, its annotations are sent as markers
+    :param chunk_sec: length of the chunks (in seconds)
+    :param realtime: whether to wait so that chunks arrive at the pace of the recording
+
+    :return: generator of (data, markers) with data of shape (n_channels, n_samples) and markers a list of
+             (sample, description), sample counted from the first sample of raw; a marker comes with the chunk
+             containing its sample
+    '''
+    index = get_event_index(raw)
+    id_to_name = {v: k for k, v in index.event_id.items()}
+    marker_samples = index.events[:, 0] - raw.first_samp
+    marker_names = [id_to_name[code] for code in index.events[:, 2]]
+
+    step = max(int(round(chunk_sec * raw.info['sfreq'])), 1)
+    t_start = time.perf_counter()
+    for start in range(0, raw.n_times, step):
+        stop = min(start + step, raw.n_times)
+        lo, hi = np.searchsorted(marker_samples, [start, stop])
+        markers = [(int(marker_samples[i]), marker_names[i]) for i in range(lo, hi)]
+        if realtime:
+            time.sleep(max(0.0, stop / raw.info['sfreq'] - (time.perf_counter() - t_start)))
+        yield raw.get_data(start=start, stop=stop), markers
+
+
+def serve_replay(raw, port, host='127.0.0.1', chunk_sec=0.1, realtime=True):
+    '''
+    Local stand-in for an amplifier: wait for one client on host:port and send it the replay of raw (see
+    replay_chunks) as binary frames, data as float32.
+    '''
+    with socket.create_server((host, port)) as server:
+        conn, _ = server.accept()
+        with conn:
+            for data, markers in replay_chunks(raw, chunk_sec=chunk_sec, realtime=realtime):
+                for sample, description in markers:
+                    payload = description.encode('utf-8')
+                    conn.sendall(_FRAME_HEADER.pack(b'M', sample, len(payload)) + payload)
+                payload = np.ascontiguousarray(data.T, dtype='<f4').tobytes()   # sample-major, as amplifiers send
+                conn.sendall(_FRAME_HEADER.pack(b'D', data.shape[1], data.shape[0]) + payload)
+            conn.sendall(_FRAME_HEADER.pack(b'E', 0, 0))
+
+
+def socket_chunks(port, host='127.0.0.1', timeout=10.0):
+    '''
+    Receive the stream of serve_replay.
+
+    :return: generator of (data, markers) as replay_chunks, markers come with the next data frame
+    '''
+    def read_exactly(conn, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        while n:
+            received = conn.recv_into(view[len(buf) - n:], n)
+            if received == 0:
+                raise ConnectionError("Stream closed before the end of stream frame.")
+            n -= received
+        return bytes(buf)
+
+    with socket.create_connection((host, port), timeout=timeout) as conn:
+        markers = []
+        while True:
+            kind, n1, n2 = _FRAME_HEADER.unpack(read_exactly(conn, _FRAME_HEADER.size))
+            if kind == b'E':
+                return
+            if kind == b'M':
+                markers.append((n1, read_exactly(conn, n2).decode('utf-8')))
+            elif kind == b'D':
+                data = np.frombuffer(read_exactly(conn, n1 * n2 * 4), dtype='<f4').reshape(n1, n2).T
+                yield data, markers
+                markers = []
+            else:
+                raise ValueError(f"Unknown frame kind: {kind!r}")
+
+
+def run_online_rewp(chunks, ch_names, sfreq, pipeline_name='proposed', bad_channels=(), verbose=True, **kwargs):
+    '''
+    Consume a stream of chunks (replay_chunks, socket_chunks) and update the RewP estimate as windows complete.
+
+    :param chunks: iterable of (data, markers)
+    :param ch_names: channel names of the stream
+    :param sfreq: sampling frequency of the stream
+    :param pipeline_name: pipeline whose ERP rejection parameters are used
+    :param bad_channels: channels left out of the averages
+    :param verbose: whether to print the RewP every time a window is accepted
+    :param kwargs: further parameters of OnlineRewP
+
+    :return: the OnlineRewP state at the end of the stream
+    '''
+    online = OnlineRewP(ch_names, sfreq, pipeline_name=pipeline_name, bad_channels=bad_channels, **kwargs)
+    for data, markers in chunks:
+        completed = online.push(data, markers)
+        if verbose and any(accepted for _, accepted in completed):
+            scores = online.rewp()
+            print(" | ".join(f"{label}: {score['mean']:5.2f} µV" for label, score in scores.items()))
+    return online
+
+
+def benchmark_online_rewp(raw, chunk_sec=0.1, pipeline_name='proposed'):
+    '''
+    Replay raw as fast as possible through OnlineRewP and compare the processing time with the duration of the
+    recording (real-time factor below 1: the online chain keeps up with the amplifier).
+    '''
+    online = OnlineRewP(raw.ch_names, raw.info['sfreq'], pipeline_name=pipeline_name)
+    chunks = list(replay_chunks(raw, chunk_sec=chunk_sec))
+    chunk_times = np.empty(len(chunks))
+    for i, (data, markers) in enumerate(chunks):
+        t_start = time.perf_counter()
+        online.push(data, markers)
+        chunk_times[i] = time.perf_counter() - t_start
+
+    duration = raw.n_times / raw.info['sfreq']
+    print(f"{len(raw.ch_names)} channels at {raw.info['sfreq']:.0f} Hz, chunks of {chunk_sec * 1000:.0f} ms:")
+    print(f"  processing {chunk_times.sum():.2f} s for {duration:.0f} s of data (real-time factor {chunk_times.sum() / duration:.3f})")
+    print(f"  per chunk: median {np.median(chunk_times) * 1000:.2f} ms, max {chunk_times.max() * 1000:.2f} ms")
+    print(f"  windows accepted: {sum(online.counts.values())}, rejected: {sum(online.n_rejected.values())}, "
+          f"early trials skipped: {online.n_early}")
+    return online
@@ -1,17 +1,35 @@
-from meegkit.dss import dss_line
+from meegkit.dss import dss0, dss_line
+from meegkit.utils import gaussfilt, smooth
 import numpy as np
+import mne
+import time
+from fractions import Fraction
+from scipy import fft as sp_fft
+from utils.tools import get_float_dtype
 
-def down_sampling(eeg, new_sfreq=250, verbose=True):
+def down_sampling(eeg, new_sfreq=250, verbose=True, method='fft'):
     '''
     Downsample the eeg signal.
     
     :param eeg: eeg signal to be processed
     :param new_sfreq: the frequency after downsampling
     :verbose: whether to print out which referencing method is being used
+    :param method: 'fft' (FFT resampling of the whole recording) or 'polyphase' (polyphase FIR resampling
+                   at the rational ratio new_sfreq / sfreq), both done in place by MNE. MNE's polyphase method
+                   resamples at the ratio of the output and input lengths, which is only new_sfreq / sfreq (with a
+                   short filter) if the length is a multiple of its denominator: the last samples beyond such a
+                   multiple (less than one output sample) are cropped first.
 
     :return: downsampled eeg signal
     '''
-    eeg_down = eeg.resample(new_sfreq, npad='auto')
+    if method not in ('fft', 'polyphase'):
+        raise ValueError(f"Unknown resampling method: {method}")
+    if method == 'polyphase':
+        _, down = _rational_ratio(eeg.info['sfreq'], new_sfreq)
+        n_keep = eeg.n_times - eeg.n_times % down
+        if n_keep < eeg.n_times:
+            eeg.crop(tmax=eeg.times[n_keep - 1], verbose=False)
+    eeg_down = eeg.resample(new_sfreq, npad='auto', method=method)
 
     if verbose:
         print(f"New Sampling Rate: {eeg_down.info['sfreq']} Hz")
@@ -19,6 +37,72 @@ def down_sampling(eeg, new_sfreq=250, verbose=True):
     return eeg_down
 
 
+def _rational_ratio(sfreq, new_sfreq, max_denominator=1000):
+    '''
+    Find integers up, down with new_sfreq / sfreq == up / down.
+    '''
+    ratio = Fraction(new_sfreq / sfreq).limit_denominator(max_denominator)
+    if not np.isclose(float(ratio) * sfreq, new_sfreq, rtol=0, atol=1e-6):
+        raise ValueError(f"No rational resampling ratio found for {sfreq} Hz -> {new_sfreq} Hz.")
+    return ratio.numerator, ratio.denominator
+
+
+def benchmark_down_sampling(eeg, new_sfreq=None, n_repeats=3, f_band=(0.1, 30)):
+    '''
+    Compare the accuracy and throughput of the FFT and polyphase resampling engines.
+
+    :param eeg: full-rate eeg signal (not modified)
+    :param new_sfreq: the frequency after downsampling, defaults to config.SAMPLING_RATE
+    :param n_repeats: number of timed repetitions (the best one is reported)
+    :param f_band: band used to compare the two engines after band filtering (the band analysed downstream)
+
+    :return: dictionary with run times, throughput, max/RMS differences (µV) and whether event samples agree
+    '''
+    import config
+    if new_sfreq is None:
+        new_sfreq = config.SAMPLING_RATE
+
+    timings, outputs = {}, {}
+    for method in ('fft', 'polyphase'):
+        best = np.inf
+        for _ in range(n_repeats):
+            eeg_in = eeg.copy()     # both methods resample in place
+            t_start = time.perf_counter()
+            outputs[method] = down_sampling(eeg_in, new_sfreq, verbose=False, method=method)
+            best = min(best, time.perf_counter() - t_start)
+        timings[method] = best
+
+    fft_data, poly_data = outputs['fft'].get_data(), outputs['polyphase'].get_data()
+    n = min(fft_data.shape[1], poly_data.shape[1])
+    raw_diff = (fft_data[:, :n] - poly_data[:, :n]) * 1e6
+    band_fft = band_filter(outputs['fft'].copy(), *f_band).get_data()
+    band_poly = band_filter(outputs['polyphase'].copy(), *f_band).get_data()
+    band_diff = (band_fft[:, :n] - band_poly[:, :n]) * 1e6
+
+    events_fft, _ = mne.events_from_annotations(outputs['fft'], verbose=False)
+    events_poly, _ = mne.events_from_annotations(outputs['polyphase'], verbose=False)
+
+    n_samples = eeg.n_times * len(eeg.ch_names)
+    result = {
+        'fft_sec': timings['fft'],
+        'polyphase_sec': timings['polyphase'],
+        'speedup': timings['fft'] / timings['polyphase'],
+        'fft_msamples_per_sec': n_samples / timings['fft'] / 1e6,
+        'polyphase_msamples_per_sec': n_samples / timings['polyphase'] / 1e6,
+        'max_abs_diff_uV': float(np.max(np.abs(raw_diff))),
+        'rms_diff_uV': float(np.sqrt(np.mean(raw_diff ** 2))),
+        'band_max_abs_diff_uV': float(np.max(np.abs(band_diff))),
+        'band_rms_diff_uV': float(np.sqrt(np.mean(band_diff ** 2))),
+        'events_match': bool(np.array_equal(events_fft, events_poly)),
+    }
+    print(f"FFT: {result['fft_sec']:.2f} s | Polyphase: {result['polyphase_sec']:.2f} s | Speedup: {result['speedup']:.1f}x")
+    print(f"Raw difference: max {result['max_abs_diff_uV']:.3g} µV, RMS {result['rms_diff_uV']:.3g} µV")
+    print(f"{f_band[0]}-{f_band[1]} Hz difference: max {result['band_max_abs_diff_uV']:.3g} µV, RMS {result['band_rms_diff_uV']:.3g} µV")
+    print(f"Event samples identical: {result['events_match']}")
+
+    return result
+
+
 def band_filter(eeg, f_low=0.1, f_high=30):
     '''
     Perform bandpass filtering on the downsampled eeg signal.
@@ -48,20 +132,267 @@ def notch_filter(eeg, line_freq=50):
     return eeg_band_notch
 
 
-def zapline_filter(eeg, line_freq=50):
+def zapline_filter(eeg, line_freq=50, segment_sec=None, overlap_sec=None, fit_sec=None, nremove=1, dtype=None):
     '''
     Perform zapline filtering on the bandpass filtered eeg signal.
+
+    With segment_sec, the recording is processed in overlapping segments of that length (blended with a
+    raised-cosine crossfade in the overlaps), using one spatial filter estimated from evenly spaced segments
+    covering fit_sec seconds. The memory used is then bounded by the segment length, not the recording length.
+    With segment_sec=0 (or a recording shorter than one segment), dss_line is applied to the whole recording at once.
     
     :param eeg: eeg signal to be processed
     :param line_freq: line frequency to be removed
+    :param segment_sec: segment length in seconds, defaults to config.ZAPLINE_SEGMENT_SEC (0 for the whole recording)
+    :param overlap_sec: overlap of consecutive segments in seconds, defaults to config.ZAPLINE_OVERLAP_SEC
+    :param fit_sec: amount of data (in seconds) used to estimate the spatial filter, defaults to config.ZAPLINE_FIT_SEC
+    :param nremove: number of line noise components to remove
+    :param dtype: precision of the segments, defaults to config.FLOAT_DTYPE
 
     :return: zapline filtered eeg signal
     '''
-    # input & output of dss_line are of shape: (n_samples, n_channels, n_trial)
+    import config
+    if segment_sec is None:
+        segment_sec = config.ZAPLINE_SEGMENT_SEC
     band_sfreq = eeg.info['sfreq']
-    eeg_zap_array, _ = dss_line(np.expand_dims(eeg.get_data().T, axis=2), fline=line_freq, sfreq=band_sfreq)
+    if segment_sec and segment_sec * band_sfreq < eeg.n_times:
+        _zapline_segmented(
+            eeg, line_freq, segment_sec,
+            config.ZAPLINE_OVERLAP_SEC if overlap_sec is None else overlap_sec,
+            config.ZAPLINE_FIT_SEC if fit_sec is None else fit_sec,
+            nremove, get_float_dtype(dtype),
+        )
+        return eeg
+
+    # input & output of dss_line are of shape: (n_samples, n_channels, n_trial)
+    eeg_zap_array, _ = dss_line(np.expand_dims(eeg.get_data().T, axis=2), fline=line_freq, sfreq=band_sfreq, nremove=nremove)
     # convert back to shape: (n_channels, n_samples)
     eeg_zap_array = eeg_zap_array.squeeze().T
     eeg._data = eeg_zap_array
 
     return eeg
+
+
+def _zapline_noise(x, sfreq, line_freq):
+    '''
+    Residual of the zapline smoothing filter (line frequency and harmonics + some high-frequency signal),
+    x of shape (n_samples, n_channels).
+    '''
+    return x - smooth(x, sfreq / line_freq)
+
+
+def _zapline_segmented(eeg, line_freq, segment_sec, overlap_sec, fit_sec, nremove, dtype):
+    '''
+    Segmented zapline, modifies eeg._data in place one segment at a time.
+
+    The DSS spatial filter is fitted once on evenly spaced segments. The removal of the line components
+    (regression of the residual on the DSS components, as in dss_line) then reduces to one fixed
+    (n_channels, n_channels) projection Q, so every segment is cleaned as y = x - residual(x) @ Q.
+    '''
+    sfreq = eeg.info['sfreq']
+    data = eeg._data
+    n_channels, n_times = data.shape
+    seg_len = int(round(segment_sec * sfreq))
+    n_overlap = int(round(overlap_sec * sfreq))
+    if not 0 <= n_overlap < seg_len:
+        raise ValueError(f"overlap_sec ({overlap_sec}) must be smaller than segment_sec ({segment_sec}).")
+    starts = np.arange(0, n_times - n_overlap, seg_len - n_overlap)
+
+    # shared spatial filter from a subsample of the segments
+    n_harm = int(np.floor((sfreq / 2) / line_freq))
+    n_fit = min(len(starts), max(1, int(np.ceil(fit_sec / segment_sec))))
+    c0 = np.zeros((n_channels, n_channels))
+    c1 = np.zeros((n_channels, n_channels))
+    for start in starts[np.unique(np.linspace(0, len(starts) - 1, n_fit).round().astype(int))]:
+        x_noise = _zapline_noise(data[:, start:start + seg_len].T.astype(np.float64), sfreq, line_freq)
+        x_noise -= x_noise.mean(axis=0)
+        x_biased = gaussfilt(x_noise, sfreq, line_freq, fwhm=1, n_harm=n_harm)
+        c0 += x_noise.T @ x_noise
+        c1 += x_biased.T @ x_biased
+    todss, _, _, _ = dss0(c0, c1)
+    w = todss[:, :nremove]
+    Q = (w @ np.linalg.solve(w.T @ c0 @ w, w.T @ c0)).astype(dtype)
+
+    # fade-in weights of the next segment in the overlap (the previous segment gets 1 - ramp)
+    ramp = (0.5 - 0.5 * np.cos(np.pi * (np.arange(n_overlap) + 0.5) / max(n_overlap, 1)))[:, None].astype(dtype)
+    tail = None
+    power_in, power_removed = 0.0, 0.0
+    for start in starts:
+        stop = min(start + seg_len, n_times)
+        x = data[:, start:stop].T.astype(dtype)     # shape: (n_samples, n_channels)
+        y = x - _zapline_noise(x, sfreq, line_freq) @ Q
+        x_centered = x - x.mean(axis=0)
+        power_in += float(np.sum(x_centered ** 2))
+        power_removed += float(np.sum((x - y) ** 2))
+        del x, x_centered
+
+        if tail is not None:
+            y[:n_overlap] = tail * (1 - ramp) + y[:n_overlap] * ramp
+        n_keep = len(y) if stop == n_times else len(y) - n_overlap
+        data[:, start:start + n_keep] = y[:n_keep].T    # the next segment only reads samples after this range
+        tail = y[n_keep:]
+
+    print(f"Power of components removed by segmented DSS: {power_removed / power_in:.2f}")
+
+
+def _fir_response(sfreq, f_low, f_high, line_freq=None):
+    '''
+    Zero-phase FIR impulse response of band_filter (optionally followed by notch_filter), as designed by MNE.
+
+    :param sfreq: sampling frequency
+    :param f_low: low cutoff frequency
+    :param f_high: high cutoff frequency
+    :param line_freq: line frequency to be removed (None for no notch)
+
+    :return: symmetric filter taps (odd length)
+    '''
+    h = mne.filter.create_filter(None, sfreq, l_freq=f_low, h_freq=f_high, verbose=False)
+    if line_freq is not None:
+        # impulse response of the notch filter, taken from MNE itself so that the design matches exactly
+        n_imp = max(len(h), int(10 * sfreq)) | 1
+        impulse = np.zeros((1, n_imp))
+        impulse[0, n_imp // 2] = 1.0
+        h_notch = mne.filter.notch_filter(impulse, sfreq, line_freq, verbose=False)[0]
+        h = np.convolve(h, h_notch)
+    return h
+
+
+def chain_support_sec(sfreq, new_sfreq, bands):
+    '''
+    Half-length (in seconds) of the impulse response of polyphase downsampling followed by the filters of bands,
+    i.e. how far the value of an output sample depends on the input around it.
+
+    :param sfreq: sampling frequency of the input
+    :param new_sfreq: sampling frequency after polyphase downsampling
+    :param bands: dictionary mapping branch name to dict(f_low=..., f_high=..., line_freq=None), see multi_band_filter
+
+    :return: half-length of the longest branch in seconds
+    '''
+    up, down = _rational_ratio(sfreq, new_sfreq)
+    # half-length of the anti-aliasing filter of MNE's polyphase resampling (scipy.signal.resample_poly, Kaiser window)
+    resample_sec = 10 * max(up, down) / (sfreq * up)
+    filter_sec = max((len(_fir_response(new_sfreq, **band)) - 1) / 2 / new_sfreq for band in bands.values())
+    return resample_sec + filter_sec
+
+
+def multi_band_filter(eeg, bands, chunk_channels=8, dtype=None):
+    '''
+    Apply several bandpass (+ optional notch) filters to the same eeg signal, computing the FFT of the
+    signal only once. Each band is the same zero-phase FIR filter as band_filter / notch_filter, applied
+    as a single multiplication in the frequency domain.
+
+    :param eeg: eeg signal to be processed (not modified)
+    :param bands: dictionary mapping branch name to dict(f_low=..., f_high=..., line_freq=None)
+    :param chunk_channels: number of channels transformed at once (bounds the memory of the FFT)
+    :param dtype: precision of the FFT, defaults to config.FLOAT_DTYPE
+
+    :return: dictionary mapping branch name to the filtered eeg signal
+    '''
+    sfreq = eeg.info['sfreq']
+    dtype = get_float_dtype(dtype)
+    data = eeg._data    # read only, no copy
+    n_channels, n_times = data.shape
+    picks = mne.pick_types(eeg.info, eeg=True, exclude=[])
+
+    responses = {name: _fir_response(sfreq, **band) for name, band in bands.items()}
+    n_edge = min(max(len(h) for h in responses.values()), n_times) - 1
+    n_fft = sp_fft.next_fast_len(n_times + 2 * n_edge + max(len(h) for h in responses.values()) - 1, real=True)
+
+    # frequency responses, with the group delay of each (symmetric) filter removed by the output offset
+    spectra = {name: sp_fft.rfft(h.astype(dtype), n_fft) for name, h in responses.items()}
+    outputs = {name: data.copy() for name in bands}
+
+    for start in range(0, len(picks), chunk_channels):
+        idx = picks[start:start + chunk_channels]
+        x_ext = np.pad(data[idx].astype(dtype, copy=False), ((0, 0), (n_edge, n_edge)), mode='reflect', reflect_type='odd')
+        x_fft = sp_fft.rfft(x_ext, n_fft, axis=1)
+        del x_ext
+        for name, h in responses.items():
+            offset = n_edge + (len(h) - 1) // 2
+            y = sp_fft.irfft(x_fft * spectra[name], n_fft, axis=1)
+            outputs[name][idx] = y[:, offset:offset + n_times]
+
+    filtered = {}
+    for name, band in bands.items():
+        out = mne.io.RawArray(outputs.pop(name), eeg.info.copy(), first_samp=eeg.first_samp, copy='auto', verbose=False)
+        out.set_annotations(eeg.annotations)
+        with out.info._unlock():
+            out.info['highpass'] = float(band['f_low'])
+            out.info['lowpass'] = float(band['f_high'])
+        filtered[name] = out
+
+    return filtered
+
+
+def benchmark_multi_band_filter(eeg, bands=None, n_repeats=3):
+    '''
+    Compare multi_band_filter with chains of band_filter / notch_filter calls (one per branch).
+
+    Two chains are timed: the per-branch chain, which filters every branch from a copy of eeg (the same outputs as
+    multi_band_filter, used for the accuracy check), and the baseline chain of _load_bids_raw, which filtered the
+    first (ERP) branch in place, so that the other branches were filtered from its output instead of from eeg.
+    The difference to the baseline outputs is reported as well: for the ICA branch it is the change of its input
+    (1-100 Hz of the downsampled signal, as in single_subject_processing.ipynb, instead of 1-30 Hz + notch).
+
+    :param eeg: downsampled eeg signal
+    :param bands: dictionary of branches (defaults to the ERP and ICA branches of the proposed pipeline)
+    :param n_repeats: number of timed repetitions (the best one is reported)
+
+    :return: dictionary with the run times, the speedups and the max abs differences (µV) per branch
+    '''
+    if bands is None:
+        bands = {
+            'erp': dict(f_low=0.1, f_high=30, line_freq=50),
+            'ica': dict(f_low=1, f_high=100, line_freq=None),
+        }
+
+    def filter_branch(out, band):
+        out = band_filter(out, f_low=band['f_low'], f_high=band['f_high'])
+        if band.get('line_freq') is not None:
+            out = notch_filter(out, line_freq=band['line_freq'])
+        return out
+
+    def run_chain():
+        return {name: filter_branch(eeg.copy(), band) for name, band in bands.items()}
+
+    def run_baseline():
+        outputs = {}
+        source = eeg.copy()
+        for name, band in bands.items():
+            # the first branch is filtered in place, the next ones start from a copy of its output
+            outputs[name] = filter_branch(source.copy() if outputs else source, band)
+        return outputs
+
+    timings = {}
+    for label, func in (('baseline', run_baseline), ('chain', run_chain),
+                        ('shared_fft', lambda: multi_band_filter(eeg, bands))):
+        best = np.inf
+        for _ in range(n_repeats):
+            t_start = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - t_start)
+        timings[label] = (best, result)
+
+    def max_abs_diff_uV(reference):
+        return {
+            name: float(np.max(np.abs(reference[name].get_data() - shared_out[name].get_data())) * 1e6)
+            for name in bands
+        }
+
+    shared_out = timings['shared_fft'][1]
+    result = {
+        'baseline_sec': timings['baseline'][0],
+        'chain_sec': timings['chain'][0],
+        'shared_fft_sec': timings['shared_fft'][0],
+        'speedup': timings['baseline'][0] / timings['shared_fft'][0],
+        'speedup_vs_chain': timings['chain'][0] / timings['shared_fft'][0],
+        'max_abs_diff_uV': max_abs_diff_uV(timings['chain'][1]),
+        'baseline_max_abs_diff_uV': max_abs_diff_uV(timings['baseline'][1]),
+    }
+    print(f"Baseline: {result['baseline_sec']:.2f} s | Chain: {result['chain_sec']:.2f} s | "
+          f"Shared FFT: {result['shared_fft_sec']:.2f} s | Speedup: {result['speedup']:.1f}x")
+    for name in bands:
+        print(f"[{name}] max abs difference: {result['max_abs_diff_uV'][name]:.2e} µV vs chain, "
+              f"{result['baseline_max_abs_diff_uV'][name]:.2e} µV vs baseline")
+
+    return result
@@ -1,15 +1,16 @@
 
 
-def drop_bad_channels(bad_channels, eeg):
+def drop_bad_channels(bad_channels, eeg, copy=True):
     '''
     Drop bad channels based on subject ID. Bad channels are found after the first trial processing step.
     
     :param bad_channels: list of bad channels to drop
     :param eeg: eeg data to drop bad channels from
+    :param copy: whether to drop the channels from a copy (True) or from eeg itself (False)
 
     :return: eeg data with bad channels dropped
     '''
     eeg.info['bads'] = bad_channels
-    eeg_ica = eeg.copy().drop_channels(bad_channels)
+    eeg_ica = (eeg.copy() if copy else eeg).drop_channels(bad_channels)
 
     return eeg_ica
\ No newline at end of file
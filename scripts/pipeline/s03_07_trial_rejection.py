@@ -1,9 +1,11 @@
 import numpy as np
 import mne
-from utils.tools import get_event_dict
+from utils.tools import get_event_dict, get_float_dtype
+import config
 
 ### ------------- Customized Trial Rejection ------------------
-def trial_rejection_cust(eeg, stim_dict, maxMin=500e-6, level=500e-6, step=40e-6, lowest=0.1e-6, tmin=0, tmax=3, baseline=None):
+def trial_rejection_cust(eeg, stim_dict, maxMin=500e-6, level=500e-6, step=40e-6, lowest=0.1e-6, tmin=0, tmax=3, baseline=None,
+                         from_raw=None):
     '''
     Customized trial rejection based on four artifact checks:
         1. MaxMin: whether the peak-to-peak amplitude range is over the threshold
@@ -21,6 +23,8 @@ def trial_rejection_cust(eeg, stim_dict, maxMin=500e-6, level=500e-6, step=40e-6
     :param tmin: start time of the epoch
     :param tmax: end time of the epoch
     :param baseline: baseline period (None for no baseline correction)
+    :param from_raw: whether to check the trials on strided views of the continuous data and only build epochs
+                     for the surviving trials, defaults to config.REJECTION_FROM_RAW
 
     :return trials: trials after rejecting bad trials
     :return rejected_info: dictionary containing the info of rejected trials: reason(channel name) for each dropped trial
@@ -28,6 +32,11 @@ def trial_rejection_cust(eeg, stim_dict, maxMin=500e-6, level=500e-6, step=40e-6
     # get the event dict filtered by conditions
     evts, evts_dict_stim = get_event_dict(eeg, stim_dict)
 
+    if from_raw is None:
+        from_raw = config.REJECTION_FROM_RAW
+    if from_raw:
+        return _trial_rejection_cust_from_raw(eeg, evts, evts_dict_stim, maxMin, level, step, lowest, tmin, tmax, baseline)
+
     # dividing the data into trials
     trials = mne.Epochs(eeg, evts, evts_dict_stim, tmin=tmin, tmax=tmax, baseline=baseline, verbose=False) 
 
@@ -51,49 +60,78 @@ def trial_rejection_cust(eeg, stim_dict, maxMin=500e-6, level=500e-6, step=40e-6
     return trials, rejected_info
 
 
-def find_artifacts(trials, maxMin, level, step, lowest):
+def find_artifacts(trials, maxMin, level, step, lowest, chunk_mb=None, return_criteria=False, dtype=None):
     """
     Find artifacts in the given trials based on four criteria (see docstring of `trial_rejection_cust` for details).
+    The epochs are scanned block by block so that at most `chunk_mb` of data is held in memory at once, and all
+    four criteria are evaluated in one pass over each block.
 
     :param trials: mne.Epochs object containing the trials to be checked
     :param maxMin: max-min amplitude threshold
     :param level: amplitude level threshold
     :param step: step threshold
     :param lowest: lowest amplitude threshold
+    :param chunk_mb: max size (in MB) of one block of epochs, defaults to config.ARTIFACT_CHUNK_MB
+    :param return_criteria: whether to also return the mask of each single criterion
+    :param dtype: precision of the scanned blocks, defaults to config.FLOAT_DTYPE
 
     :return: A boolean array of shape (n_epochs, n_channels) indicating whether each channel in each epoch is marked as an artifact
+    :return: (only if return_criteria) dictionary mapping each criterion name to its own (n_epochs, n_channels) mask
     """
+    if chunk_mb is None:
+        chunk_mb = config.ARTIFACT_CHUNK_MB
+    dtype = get_float_dtype(dtype)
 
-    data = trials.get_data(verbose=False)    # shape: (n_epochs, n_channels, n_times)
-    n_epochs, n_channels, _ = data.shape
+    # resolve the final list of epochs (edges / annotations) without keeping the data
+    trials.drop_bad(verbose=False)
+    n_epochs, n_channels, n_times = len(trials), len(trials.ch_names), len(trials.times)
 
-    is_artifact = np.zeros((n_epochs, n_channels), dtype=bool)
+    criteria = {
+        name: np.zeros((n_epochs, n_channels), dtype=bool)
+        for name in ('maxMin', 'level', 'step', 'lowest')
+    }
 
-    # CHECKPOINT 1: MaxMin
+    epoch_bytes = n_channels * n_times * np.dtype(np.float64).itemsize
+    chunk_size = max(1, int(chunk_mb * 1024 ** 2 // epoch_bytes))
+
+    for start in range(0, n_epochs, chunk_size):
+        stop = min(start + chunk_size, n_epochs)
+        data = trials.get_data(item=slice(start, stop), verbose=False)    # shape: (chunk, n_channels, n_times)
+        data = data.astype(dtype, copy=False)
+        _scan_artifact_block(data, maxMin, level, step, lowest, criteria, start, stop)
+
+    is_artifact = criteria['maxMin'] | criteria['level'] | criteria['step'] | criteria['lowest']
+
+    if return_criteria:
+        return is_artifact, criteria
+    return is_artifact
+
+
+def _scan_artifact_block(data, maxMin, level, step, lowest, criteria, start, stop):
+    """
+    Evaluate the four artifact criteria on one block of epochs and write them into rows [start, stop) of `criteria`.
+    The max abs amplitude is derived from the max and min amplitude, so no abs copy of the block is made.
+    """
     max_amp = np.max(data, axis=2)
     min_amp = np.min(data, axis=2)
-    is_minMax_artifact = np.abs(max_amp - min_amp) > maxMin
-    is_artifact |= is_minMax_artifact      # return True if either of left or right variable is True
+    abs_amp = np.maximum(max_amp, -min_amp)
+
+    # CHECKPOINT 1: MaxMin
+    criteria['maxMin'][start:stop] = (max_amp - min_amp) > maxMin
 
     # CHECKPOINT 2: Level
-    is_level_artifact =  np.max(np.abs(data), axis=2)  > level
-    is_artifact |= is_level_artifact
+    criteria['level'][start:stop] = abs_amp > level
 
     # CHEKPOINT 3: Step
-    diff = np.diff(data, axis=2)
-    is_step_artifact = np.any(diff > step, axis=2) # !!!!!!!!!!!!!
-    is_artifact |= is_step_artifact
+    criteria['step'][start:stop] = np.any(np.diff(data, axis=2) > step, axis=2)
 
-    # CHECKPOINT 4: lowest
-    is_lowest_artifact = np.all(np.abs(data) < lowest, axis=2)
-    is_artifact |= is_lowest_artifact
-
-    return is_artifact
+    # CHECKPOINT 4: lowest (all |x| < lowest <=> max |x| < lowest)
+    criteria['lowest'][start:stop] = abs_amp < lowest
 
 
 
 ### ------------- Trial Rejection by MNE Methods------------------
-def trial_rejection_mne(eeg, stim_dict, max=500e-6, min=0.1e-6, tmin=0, tmax=3, baseline=None):
+def trial_rejection_mne(eeg, stim_dict, max=500e-6, min=0.1e-6, tmin=0, tmax=3, baseline=None, from_raw=None):
     '''
     Trial rejection using MNE built-in methods based on peak-to-peak amplitude and flat signal checks.
     
@@ -105,12 +143,19 @@ def trial_rejection_mne(eeg, stim_dict, max=500e-6, min=0.1e-6, tmin=0, tmax=3,
     :param tmin: start time of the epoch
     :param tmax: end time of the epoch
     :param baseline: baseline period (None for no baseline correction)
+    :param from_raw: whether to check the trials on strided views of the continuous data and only build epochs
+                     for the surviving trials, defaults to config.REJECTION_FROM_RAW
 
     :return: trials after rejecting bad trials
     '''
     # get the event dict filtered by conditions
     evts, evts_dict_stim = get_event_dict(eeg, stim_dict)
 
+    if from_raw is None:
+        from_raw = config.REJECTION_FROM_RAW
+    if from_raw:
+        return _trial_rejection_mne_from_raw(eeg, evts, evts_dict_stim, max, min, tmin, tmax, baseline)
+
     ### peak-to-peak amp check
     reject_criteria = dict(
         eeg=max
@@ -134,4 +179,191 @@ def trial_rejection_mne(eeg, stim_dict, max=500e-6, min=0.1e-6, tmin=0, tmax=3,
         preload=True
     )
 
-    return trials
\ No newline at end of file
+    return trials
+
+
+
+### ------------- Trial Rejection on Continuous Data ------------------
+def _bad_annotation_overlap(eeg, starts, n_times):
+    '''
+    Description of the first BAD annotation overlapping each trial (None if there is none), as checked by mne.Epochs
+    with reject_by_annotation=True.
+
+    :param starts: first sample of each trial, relative to the first sample of the data
+    :param n_times: number of samples of a trial
+    '''
+    annot = eeg.annotations
+    is_bad = np.array([desc.lower().startswith('bad') for desc in annot.description], dtype=bool)
+    if not is_bad.any() or len(starts) == 0:
+        return [None] * len(starts)
+
+    sfreq = eeg.info['sfreq']
+    # onsets relative to the first sample of the data
+    onset = annot.onset[is_bad] - (eeg.first_time if annot.orig_time is not None else 0.0)
+    offset = onset + annot.duration[is_bad]
+    descriptions = annot.description[is_bad]
+    overlap = (onset[None, :] < ((starts + n_times) / sfreq)[:, None]) & (offset[None, :] > (starts / sfreq)[:, None])
+    first_bad = overlap.argmax(axis=1)
+    return [descriptions[j] if overlap[i, j] else None for i, j in enumerate(first_bad)]
+
+
+def get_event_windows(eeg, evts, evts_dict_stim, tmin, tmax, reject_by_annotation=True):
+    '''
+    Build a zero-copy sliding-window view over the continuous data, so that the trial of each event is a window
+    of the view. Uses the same sample arithmetic as mne.Epochs, and like mne.Epochs drops the trials overlapping
+    a BAD annotation.
+
+    :param eeg: eeg data in mne.Raw format (preloaded)
+    :param evts: event array
+    :param evts_dict_stim: event dictionary of the events to keep
+    :param tmin: start time of the epoch
+    :param tmax: end time of the epoch
+    :param reject_by_annotation: whether to drop the trials overlapping an annotation starting with 'bad' (as mne.Epochs)
+
+    :return windows: read-only view of shape (n_channels, n_windows, n_times) over the raw data buffer
+    :return rows: indices (into evts) of the kept events whose trial lies inside the recording
+    :return starts: first sample of the trial for each entry of rows, i.e. its window index in windows
+    :return times: time points of one trial
+    :return drop_log: list with the drop reason of each event in evts (empty tuple if the event is kept)
+    '''
+    if not eeg.preload:
+        raise ValueError("Raw data must be preloaded to extract event windows.")
+
+    sfreq = eeg.info['sfreq']
+    first = int(round(tmin * sfreq))
+    n_times = int(round(tmax * sfreq)) - first + 1
+    times = np.arange(first, first + n_times) / sfreq
+
+    data = eeg._data    # no copy: the views below point into the raw buffer
+    n_samples = data.shape[1]
+    windows = np.lib.stride_tricks.sliding_window_view(data, n_times, axis=1)
+
+    starts_all = evts[:, 0] - eeg.first_samp + first
+    is_kept = np.isin(evts[:, 2], list(evts_dict_stim.values()))
+    in_bounds = (starts_all >= 0) & (starts_all + n_times <= n_samples)
+
+    drop_log = [()] * len(evts)
+    for idx in np.where(~is_kept)[0]:
+        drop_log[idx] = ('IGNORED',)
+    for idx in np.where(is_kept & ~in_bounds)[0]:
+        drop_log[idx] = ('TOO_SHORT',)
+
+    rows = np.where(is_kept & in_bounds)[0]
+    if reject_by_annotation:
+        bad = _bad_annotation_overlap(eeg, starts_all[rows], n_times)
+        for idx, desc in zip(rows, bad):
+            if desc is not None:
+                drop_log[idx] = (desc,)
+        rows = rows[[desc is None for desc in bad]]
+    return windows, rows, starts_all[rows], times, drop_log
+
+
+def _iter_window_blocks(windows, starts, times, baseline, chunk_mb=None, dtype=None):
+    '''
+    Yield (start, stop, block) for consecutive blocks of trials, where block is a baseline-corrected
+    (n_trials, n_channels, n_times) copy of at most chunk_mb (defaults to config.ARTIFACT_CHUNK_MB),
+    in the precision given by dtype (defaults to config.FLOAT_DTYPE).
+    '''
+    if chunk_mb is None:
+        chunk_mb = config.ARTIFACT_CHUNK_MB
+    dtype = get_float_dtype(dtype)
+    n_channels, _, n_times = windows.shape
+    trial_bytes = n_channels * n_times * windows.dtype.itemsize
+    chunk_size = max(1, int(chunk_mb * 1024 ** 2 // trial_bytes))
+
+    for start in range(0, len(starts), chunk_size):
+        stop = min(start + chunk_size, len(starts))
+        block = np.moveaxis(windows[:, starts[start:stop]], 1, 0)    # only this block is copied
+        block = block.astype(dtype, copy=False)
+        if baseline is not None:
+            mne.baseline.rescale(block, times, baseline, mode='mean', copy=False, verbose=False)
+        yield start, stop, block
+
+
+def _epochs_from_survivors(eeg, evts, rows, drop_log, evts_dict_stim, **epochs_kwargs):
+    '''
+    Build mne.Epochs for the surviving events only, and restore drop_log and selection so that they refer
+    to the full event array (as if all events had been epoched and the rejected ones dropped).
+    Conditions whose trials were all rejected stay in the event_id of the epochs, as in trial_rejection_cust.
+    '''
+    if rows.size == 0:
+        # mne.Epochs needs at least one event: all events are epoched and dropped, as in trial_rejection_cust
+        preload = epochs_kwargs.pop('preload', False)
+        trials = mne.Epochs(eeg, evts, evts_dict_stim, on_missing='ignore', **epochs_kwargs)
+        trials.drop(np.arange(len(trials.events)), verbose=False)
+        if preload:
+            trials.load_data()
+        trials.drop_log = tuple(drop_log)
+        return trials
+
+    trials = mne.Epochs(eeg, evts[rows], evts_dict_stim, on_missing='ignore', **epochs_kwargs)
+    trials.drop_bad(verbose=False)
+
+    drop_log = list(drop_log)
+    for sub_idx, row in enumerate(rows):
+        drop_log[row] = trials.drop_log[sub_idx]
+    trials.selection = rows[trials.selection]
+    trials.drop_log = tuple(drop_log)
+
+    return trials
+
+
+def _trial_rejection_cust_from_raw(eeg, evts, evts_dict_stim, maxMin, level, step, lowest, tmin, tmax, baseline):
+    '''
+    Same as trial_rejection_cust, but the four artifact checks are evaluated on views of the continuous data
+    and the epochs are built for the surviving trials only.
+    '''
+    windows, rows, starts, times, drop_log = get_event_windows(eeg, evts, evts_dict_stim, tmin, tmax)
+
+    criteria = {
+        name: np.zeros((len(rows), len(eeg.ch_names)), dtype=bool)
+        for name in ('maxMin', 'level', 'step', 'lowest')
+    }
+    for start, stop, block in _iter_window_blocks(windows, starts, times, baseline):
+        _scan_artifact_block(block, maxMin, level, step, lowest, criteria, start, stop)
+    artifact_mask = criteria['maxMin'] | criteria['level'] | criteria['step'] | criteria['lowest']
+
+    is_artifacts_idx = np.where(np.any(artifact_mask, axis=1))[0]
+    rejected_info = {}
+    for idx in is_artifacts_idx:
+        ch_indiced = np.where(artifact_mask[idx])[0]
+        rejected_info[idx] = [eeg.ch_names[ch_idx] for ch_idx in ch_indiced]
+        drop_log[rows[idx]] = ('USER',)
+
+    keep = np.ones(len(rows), dtype=bool)
+    keep[is_artifacts_idx] = False
+    trials = _epochs_from_survivors(
+        eeg, evts, rows[keep], drop_log, evts_dict_stim,
+        tmin=tmin, tmax=tmax, baseline=baseline, verbose=False
+    )
+
+    return trials, rejected_info
+
+
+def _trial_rejection_mne_from_raw(eeg, evts, evts_dict_stim, max, min, tmin, tmax, baseline):
+    '''
+    Same as trial_rejection_mne, but the peak-to-peak checks are evaluated on views of the continuous data
+    and the epochs are built (and preloaded) for the surviving trials only.
+    '''
+    windows, rows, starts, times, drop_log = get_event_windows(eeg, evts, evts_dict_stim, tmin, tmax)
+
+    # same channels as the 'eeg' key of the MNE reject/flat dicts, bad channels are ignored by MNE
+    eeg_picks = mne.pick_types(eeg.info, eeg=True, exclude='bads')
+    keep = np.ones(len(rows), dtype=bool)
+    for start, stop, block in _iter_window_blocks(windows, starts, times, baseline):
+        ptp = np.ptp(block[:, eeg_picks], axis=2)   # shape: (n_trials, n_eeg_channels)
+        is_max = ptp > max
+        is_flat = ptp < min
+        for i in np.where(np.any(is_max | is_flat, axis=1))[0]:
+            keep[start + i] = False
+            drop_log[rows[start + i]] = tuple(
+                [eeg.ch_names[eeg_picks[c]] for c in np.where(is_max[i])[0]]
+                + [eeg.ch_names[eeg_picks[c]] for c in np.where(is_flat[i])[0]]
+            )
+
+    trials = _epochs_from_survivors(
+        eeg, evts, rows[keep], drop_log, evts_dict_stim,
+        tmin=tmin, tmax=tmax, reject=dict(eeg=max), flat=dict(eeg=min), baseline=baseline, preload=True
+    )
+
+    return trials
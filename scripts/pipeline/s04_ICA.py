@@ -1,4 +1,13 @@
+import hashlib
+import json
+import os
+import time
+import warnings
+from pathlib import Path
+
 import mne
+import numpy as np
+from scipy.optimize import linear_sum_assignment
 # from mne_icalabel import label_components NOTE: only shows the component with the highest probability
 from mne_icalabel.iclabel import iclabel_label_components
 from utils.logger import log_ica_exclusion
@@ -6,21 +15,76 @@ from utils.visualization import iclabel_visualize
 import config
 
 
-def get_ica(trials, method='picard', save_path=None):
+def _make_ica(method, n_components=None, fit_params=None):
+    '''
+    Create an (unfitted) ICA object with the settings used by the pipelines.
+    '''
+    if method == 'picard':
+        params = dict(ortho=False, extended=True)
+    else:
+        params = dict(extended=True)
+    params.update(fit_params or {})
+    return mne.preprocessing.ICA(n_components=n_components, method=method, fit_params=params, random_state=2016)     # random_state for reproducibility (the authors used 2016)
+
+
+def _warm_start_params(trials, ica_init, method, n_components, decim):
+    '''
+    Initial unmixing matrix for refitting ICA from an existing decomposition.
+
+    The existing unmixing is taken to sensor space and projected onto the whitened PCA space of the new fit,
+    which is computed by a (cheap) one-iteration fit on the same data.
+
+    :return: fit_params entry with the initial matrix, or an empty dict if the decomposition does not match
+    '''
+    if ica_init.ch_names != trials.ch_names:
+        warnings.warn("Channels of the warm start ICA do not match the trials, fitting from scratch.")
+        return {}
+
+    probe = _make_ica(method, n_components, fit_params=dict(max_iter=1))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        probe.fit(trials, decim=decim, verbose=False)
+    n = probe.n_components_
+    if ica_init.n_components_ != n:
+        warnings.warn(f"Warm start ICA has {ica_init.n_components_} components instead of {n}, fitting from scratch.")
+        return {}
+
+    # sources = unmixing @ pca_components[:n] @ (data / pre_whitener - pca_mean)
+    unmixing_sensor = ica_init.unmixing_matrix_ @ ica_init.pca_components_[:n] / ica_init.pre_whitener_.T
+    w_init = (
+        unmixing_sensor * probe.pre_whitener_.T
+        @ probe.pca_components_[:n].T
+        * np.sqrt(probe.pca_explained_variance_[:n])
+    )
+    if method == 'picard':
+        return dict(w_init=w_init)
+    return dict(weights=w_init.T)   # infomax computes sources as data @ weights
+
+
+def get_ica(trials, method='picard', save_path=None, decim=None, n_components=None, warm_start=None):
     '''
     Fit ICA on the given MNE Epochs object.
     
     :param trials_mne: MNE Epochs object containing EEG data.
     :param method: ICA method to use.
     :param save_path: path to save the fitted ICA object. If None, the ICA object will not be saved.
+    :param decim: fit on every decim-th sample only, defaults to config.ICA_DECIM (None or 1 for all samples).
+    :param n_components: number of PCA components passed to ICA, defaults to config.ICA_N_COMPONENTS (0 for all).
+    :param warm_start: ICA object or path of a saved ICA to start the fit from (None to fit from scratch).
 
     :return: Fitted ICA object.
     '''
-    if method == 'picard':
-        ica = mne.preprocessing.ICA(method=method, fit_params=dict(ortho=False, extended=True), random_state=2016)     # random_state for reproducibility (the authors used 2016)
-    else:
-        ica = mne.preprocessing.ICA(method=method, fit_params=dict(extended=True), random_state=2016) 
-    ica.fit(trials,verbose=True)
+    if decim is None:
+        decim = config.ICA_DECIM
+    if n_components is None:
+        n_components = config.ICA_N_COMPONENTS
+    n_components = n_components or None    # MNE keeps all components with None
+    if isinstance(warm_start, (str, Path)):
+        warm_start = mne.preprocessing.read_ica(warm_start, verbose=False)
+
+    init_params = {} if warm_start is None else _warm_start_params(trials, warm_start, method, n_components, decim)
+    ica = _make_ica(method, n_components, fit_params=init_params)
+    ica.fit(trials, decim=decim, verbose=True)
 
     if save_path:
         ica.save(save_path, overwrite=True)
@@ -29,7 +93,161 @@ def get_ica(trials, method='picard', save_path=None):
     return ica
 
 
-def iccomponent_removal(eeg, trials, ica, subject_id, active_pipeline, logger=None, save_path=None):
+def _match_components(ica_ref, ica):
+    '''
+    Match the components of two ICA decompositions of the same data by the absolute correlation of their
+    sensor-space unmixing vectors.
+
+    :return: index in ica of the component matched to each component of ica_ref, and the matched correlations
+    '''
+    def sensor_unmixing(x):
+        n = x.n_components_
+        return x.unmixing_matrix_ @ x.pca_components_[:n] / x.pre_whitener_.T
+
+    w_ref, w = sensor_unmixing(ica_ref), sensor_unmixing(ica)
+    w_ref = w_ref / np.linalg.norm(w_ref, axis=1, keepdims=True)
+    w = w / np.linalg.norm(w, axis=1, keepdims=True)
+    similarity = np.abs(w_ref @ w.T)
+    rows, cols = linear_sum_assignment(-similarity)
+    matched = np.full(len(w_ref), -1)
+    matched[rows] = cols
+    matched_similarity = np.zeros(len(w_ref))
+    matched_similarity[rows] = similarity[rows, cols]
+    return matched, matched_similarity
+
+
+def benchmark_get_ica(trials, erp_epochs, exclude_idx, method='picard', variants=None, conditions_dict=None,
+                      proportiontocut=0.05, channel='FCz'):
+    '''
+    Compare accelerated ICA fits with the current full fit.
+
+    For each variant, report the fit time, the similarity of its components with the full fit (absolute correlation
+    of the matched sensor-space unmixing vectors) and the RewP scores after removing the components matched to
+    exclude_idx of the full fit.
+
+    :param trials: MNE Epochs object for ICA fitting.
+    :param erp_epochs: preloaded feedback-locked MNE Epochs object to clean and compute the RewP scores from.
+    :param exclude_idx: components removed from the full fit (e.g. config.SUBJECT_INFO[subject]['ic_excluded'][pipeline]).
+    :param method: ICA method to use.
+    :param variants: dictionary mapping variant name to get_ica keyword arguments (decim, n_components, warm_start).
+                     The warm start variants may use the value 'full' to start from the full fit.
+    :param conditions_dict: feedback conditions, defaults to config.CONDITIONS_DICT['feedback_locked'].
+    :param proportiontocut: trimming of the ERPs.
+    :param channel: channel of the RewP scores.
+
+    :return: pandas DataFrame with one row per fit.
+    '''
+    import pandas as pd
+    from pipeline.s09_make_erps import get_evoked
+    from pipeline.s10_rewp_calculation import rewp_calculation
+
+    if conditions_dict is None:
+        conditions_dict = config.CONDITIONS_DICT['feedback_locked']
+    if variants is None:
+        variants = {
+            'decim_4': dict(decim=4),
+            'pca_20': dict(n_components=20),
+            'decim_4_pca_20': dict(decim=4, n_components=20),
+            'warm_start': dict(warm_start='full'),
+        }
+
+    def rewp_scores(ica, exclude):
+        ica.exclude = list(exclude)
+        evokeds = get_evoked(conditions_dict, ica.apply(erp_epochs.copy(), verbose=False), proportiontocut, verbose=False)
+        scores = rewp_calculation(evokeds, channel=channel, verbose=False)
+        return {label: score['mean'] for label, score in scores.items()}
+
+    fits = {}
+    t_start = time.perf_counter()
+    fits['full'] = get_ica(trials, method, decim=1, n_components=0, warm_start=None)
+    times = {'full': time.perf_counter() - t_start}
+    for name, kwargs in variants.items():
+        kwargs = {'decim': 1, **kwargs}
+        if kwargs.get('warm_start') == 'full':
+            kwargs['warm_start'] = fits['full']
+        t_start = time.perf_counter()
+        fits[name] = get_ica(trials, method, **kwargs)
+        times[name] = time.perf_counter() - t_start
+
+    ref_scores = rewp_scores(fits['full'], exclude_idx)
+    rows = []
+    for name, ica in fits.items():
+        matched, similarity = _match_components(fits['full'], ica)
+        exclude = [int(matched[i]) for i in exclude_idx if i < len(matched) and matched[i] >= 0]
+        scores = ref_scores if name == 'full' else rewp_scores(ica, exclude)
+        rows.append({
+            'variant': name,
+            'fit_sec': times[name],
+            'speedup': times['full'] / times[name],
+            'n_components': ica.n_components_,
+            'n_iter': getattr(ica, 'n_iter_', np.nan),
+            'mean_component_similarity': float(similarity.mean()),
+            'excluded_component_similarity': float(similarity[exclude_idx].mean()) if len(exclude_idx) else np.nan,
+            'max_abs_rewp_diff_uV': float(np.nanmax(np.abs([scores[k] - ref_scores[k] for k in ref_scores]))),
+            **{f'rewp_{k}': v for k, v in scores.items()},
+        })
+    result = pd.DataFrame(rows)
+    print(result[['variant', 'fit_sec', 'speedup', 'mean_component_similarity', 'max_abs_rewp_diff_uV']].to_string(index=False))
+    return result
+
+
+def iclabel_cache_path(ica_path):
+    '''
+    Path of the ICLabel probability cache stored next to a saved ICA object ({pipeline}-sub{id}_ica.fif).
+    '''
+    ica_path = Path(ica_path)
+    return ica_path.with_name(ica_path.name.replace('_ica.fif', '') + '_iclabel.npz')
+
+
+def _iclabel_key(trials, ica, chunk_size=64):
+    '''
+    Hash of the ICA decomposition and of the trials it is labeled on. The trials are hashed in chunks,
+    so no second copy of the data is made.
+    '''
+    h = hashlib.sha256()
+    for array in (ica.unmixing_matrix_, ica.pca_components_, ica.pca_mean_, ica.pre_whitener_):
+        h.update(np.ascontiguousarray(array).tobytes())
+    h.update(json.dumps([ica.ch_names, trials.ch_names, trials.info['sfreq'], trials.times[0], len(trials)]).encode('utf-8'))
+    for start in range(0, len(trials), chunk_size):
+        h.update(np.ascontiguousarray(trials.get_data(item=slice(start, start + chunk_size), verbose=False)).tobytes())
+    return h.hexdigest()[:32]
+
+
+def get_iclabel_probabilities(trials, ica, cache_path=None):
+    '''
+    ICLabel probabilities of the ICA components, read from cache_path if it was computed for the same
+    decomposition and trials, otherwise computed and stored there.
+
+    :param trials: MNE Epochs object the ICA was fitted on.
+    :param ica: Fitted ICA object.
+    :param cache_path: .npz cache file (see iclabel_cache_path). If None, the probabilities are not cached.
+
+    :return: probability matrix of shape (n_components, 7 classes).
+    '''
+    if cache_path is None:
+        return iclabel_label_components(trials, ica)
+
+    cache_path = Path(cache_path)
+    key = _iclabel_key(trials, ica)
+    if cache_path.exists():
+        try:
+            with np.load(cache_path) as cached:
+                if str(cached['key']) == key:
+                    return cached['labels']
+        except (OSError, ValueError, KeyError):
+            pass    # unreadable cache, recompute it
+
+    labels = iclabel_label_components(trials, ica)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix('.tmp')
+    with tmp_path.open('wb') as f:
+        np.savez(f, key=key, labels=labels)
+    os.replace(tmp_path, cache_path)
+    return labels
+
+
+def iccomponent_removal(eeg, trials, ica, subject_id, active_pipeline, logger=None, save_path=None, ica_path=None,
+                        exclude_idx=None):
     '''
     Remove bad IC components based on the given criteria. 
 
@@ -40,10 +258,13 @@ def iccomponent_removal(eeg, trials, ica, subject_id, active_pipeline, logger=No
     :param active_pipeline: the name of the active pipeline, used to determine the criteria for excluding components.
     :param logger: Logger object for logging the exclusion process. If None, logging will be skipped.
     :param save_path: path to save the visualization of excluded components. If None, the visualization will not be saved.
+    :param ica_path: path of the saved ICA object, the ICLabel probabilities are cached next to it. If None, they are not cached.
+    :param exclude_idx: components to remove, defaults to the ic_excluded of config.SUBJECT_INFO (ICLabel if None there too).
 
     :return: Cleaned MNE Raw object.
     '''
-    exclude_idx = config.SUBJECT_INFO[subject_id]['ic_excluded'][active_pipeline]   # check is exclude idx is already saved
+    if exclude_idx is None:
+        exclude_idx = config.SUBJECT_INFO[subject_id]['ic_excluded'][active_pipeline]   # check is exclude idx is already saved
 
     if exclude_idx is None:
         exclude_idx = []
@@ -58,7 +279,7 @@ def iccomponent_removal(eeg, trials, ica, subject_id, active_pipeline, logger=No
             'channel noise': 6,
             'other': 7
         }
-        all_labels = iclabel_label_components(trials, ica)
+        all_labels = get_iclabel_probabilities(trials, ica, cache_path=None if ica_path is None else iclabel_cache_path(ica_path))
         for i, probabilities in enumerate(all_labels):
             if active_pipeline == 'original':
                 if probabilities[label_dict['eye blink']] > probabilities[label_dict['brain']] or \
@@ -1,7 +1,53 @@
 import mne
 import numpy as np
+from utils.tools import get_event_index
 
-def exclude_early_trials(data, num_to_exclude=10, verbose=True):
+# task types (trial counts of 'S 11' and 'S 21' are shared) and the event names marking the start of their trials
+TASK_START_EVENTS = {
+    'S 1': ['Stimulus:S  1'],
+    'S 11_S 21': ['Stimulus:S 11', 'Stimulus:S 21'],
+    'S 31': ['Stimulus:S 31'],
+}
+
+
+def get_early_trial_mask(events, event_dict, num_to_exclude=10):
+    '''
+    Find the events belonging to the first few trials of each task type, without iterating over the events.
+    A trial starts at a task start event and contains all events until the next task start event (of any type).
+    Events before the first task start do not belong to any trial and are never excluded.
+
+    :param events: events array, as returned by mne.events_from_annotations
+    :param event_dict: mapping of event name to event id
+    :param num_to_exclude: Number of early trials to exclude per task type
+
+    :return: boolean mask of shape (n_events,), True for the events to exclude
+    '''
+    codes = events[:, 2]
+
+    # task type of each event id (-1: not a task start)
+    type_lut = np.full(max(codes.max(initial=0), max(event_dict.values(), default=0)) + 1, -1)
+    for task_type, names in enumerate(TASK_START_EVENTS.values()):
+        for name in names:
+            if name in event_dict:
+                type_lut[event_dict[name]] = task_type
+    event_type = type_lut[codes]
+    is_start = event_type >= 0
+    if not is_start.any():
+        return np.zeros(len(codes), dtype=bool)
+
+    # trial segment ID of each event (-1 before the first trial start)
+    segment = np.cumsum(is_start) - 1
+
+    # index of each trial within its task type, from cumulative counts per type
+    start_type = event_type[is_start]
+    counts = np.cumsum(start_type[:, None] == np.arange(len(TASK_START_EVENTS)), axis=0)
+    trial_index = counts[np.arange(len(start_type)), start_type] - 1
+    is_early_trial = trial_index < num_to_exclude
+
+    return (segment >= 0) & is_early_trial[np.maximum(segment, 0)]
+
+
+def exclude_early_trials(data, num_to_exclude=10, verbose=True, mode='copy'):
     '''
     Exclude first few trials (default: 10) for each task type from the Epochs data.
         'S  1' = start of low-value task fixation (all low cue)
@@ -12,83 +58,34 @@ def exclude_early_trials(data, num_to_exclude=10, verbose=True):
     :param data: Raw eeg data
     :param num_to_exclude: Number of early trials to exclude per task type
     :verbose: whether to print out which referencing method is being used
+    :param mode: 'copy' returns a copy of the Raw data with the new annotations, 'inplace' replaces the annotations
+                 of data itself, 'annotations' only returns the new annotations (neither mode copies the signal)
 
-    :return: Raw data with early trials excluded
+    :return: Raw data with early trials excluded (for 'annotations': the annotations without the early trials)
     '''
-    events, event_dict = mne.events_from_annotations(data)
-    
-    # trial counts per task type
-    trial_count = {'S 1': 0, 'S 11_S 21': 0, 'S 31': 0}
-
-    task_start_ids = {}
-    
-    # Find the event ID for task starters so that we could know when one trial stops
-    for event_name, event_id in event_dict.items():
-        if 'Stimulus:S  1' == event_name:
-            task_start_ids['S 1'] = [event_id]
-        elif 'Stimulus:S 11' == event_name or 'Stimulus:S 21'== event_name:
-            if 'S 11_S 21' not in task_start_ids: 
-                task_start_ids['S 11_S 21'] = []
-            task_start_ids['S 11_S 21'].append(event_id)
-        elif 'Stimulus:S 31' == event_name:
-            task_start_ids['S 31'] = [event_id]
-
-    # flatten all start ids
-    all_task_starts = []
-    for ids in task_start_ids.values():
-        all_task_starts.extend(ids)
-
-    events_to_exclude = []
-    i = 0
-    while i < len(events):
-        event_id = events[i, 2] # ith event's eventid (2 means event id)
-        
-        # Determine if this event marks the start of a trial
-        current_task_type = None
-        if 'S 1' in task_start_ids and event_id in task_start_ids['S 1']:
-            current_task_type = 'S 1'
-        elif 'S 11_S 21' in task_start_ids and event_id in task_start_ids['S 11_S 21']:
-            current_task_type = 'S 11_S 21'
-        elif 'S 31' in task_start_ids and event_id in task_start_ids['S 31']:
-            current_task_type = 'S 31'
-
-        # If it is a trial start
-        if current_task_type is not None:
-            # Check if the trial should be excluded
-            if trial_count[current_task_type] < num_to_exclude:
-                events_to_exclude.append(i)
-                
-                # Mark subsequent events until the next trial starts
-                j = 1
-                while (i + j) < len(events):
-                    next_id = events[i + j, 2]
-                    if next_id in all_task_starts:
-                        break 
-                    events_to_exclude.append(i + j)
-                    j += 1
-            
-            trial_count[current_task_type] += 1
-        
-        i += 1
-
-    # Remove excluded events
-    # Create mask: True = keep, False = exclude
-    keep_mask = np.ones(len(events), dtype=bool)
-    keep_mask[events_to_exclude] = False
+    if mode not in ('copy', 'inplace', 'annotations'):
+        raise ValueError(f"Unknown mode: {mode}")
+
+    index = get_event_index(data)
+    events, event_dict = index.events, index.event_id
+    exclude_mask = get_early_trial_mask(events, event_dict, num_to_exclude)
 
     # Keep only non-excluded events
-    events_filtered = events[keep_mask]
+    events_filtered = events[~exclude_mask]
 
-    data_clean = data.copy()
-    
-    # Add back the filtered events
     new_annot = mne.annotations_from_events(
         events_filtered,
-        data_clean.info['sfreq'],
+        data.info['sfreq'],
         event_desc={v: k for k, v in event_dict.items()}
     )
-    data_clean.set_annotations(new_annot)
-    
+
     if verbose:
-        print(f"Excluded {len(events_to_exclude)} events (first {num_to_exclude} trials of each block).")
-    return data_clean
\ No newline at end of file
+        print(f"Excluded {int(exclude_mask.sum())} events (first {num_to_exclude} trials of each block).")
+
+    if mode == 'annotations':
+        return new_annot
+    data_clean = data.copy() if mode == 'copy' else data
+
+    # Add back the filtered events
+    data_clean.set_annotations(new_annot)
+    return data_clean
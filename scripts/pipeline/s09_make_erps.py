@@ -1,24 +1,74 @@
-from scipy.stats import trim_mean
 import numpy as np
 import mne
+from utils.tools import _normalize_event_key, get_epochs_data
 
-def get_trimmed_mean(epochs, proportiontocut):
+
+def _trim_bounds(n_trials, proportiontocut):
+    '''
+    Rows kept by the trimmed mean of n_trials sorted trials, as in scipy.stats.trim_mean.
+    '''
+    lowercut = int(proportiontocut * n_trials)
+    uppercut = n_trials - lowercut
+    if lowercut > uppercut:
+        raise ValueError("Proportion too big.")
+    return lowercut, uppercut
+
+
+def trimmed_mean(data, proportiontocut):
+    '''
+    Trimmed mean along the trial axis (axis 0), same result as scipy.stats.trim_mean along axis 0.
+    The trials are partitioned once for the whole array instead of once per channel x time point.
+
+    :param data: array of shape (n_trials, ...)
+    :param proportiontocut: Proportion of trials to cut from each end of the distribution
+
+    :return: array of shape data.shape[1:]
+    '''
+    lowercut, uppercut = _trim_bounds(len(data), proportiontocut)
+    if lowercut == 0:
+        return data.mean(axis=0)
+    data = np.partition(data, (lowercut, uppercut - 1), axis=0)
+    return data[lowercut:uppercut].mean(axis=0)
+
+
+def trimmed_mean_batch(data, offsets, proportiontocut):
+    '''
+    Trimmed means of several conditions stacked along the trial axis, condition k being data[offsets[k]:offsets[k + 1]].
+    Conditions with the same number of trials are trimmed together in one partition.
+
+    :param data: array of shape (n_trials_total, ...)
+    :param offsets: array of n_conditions + 1 increasing trial indices, offsets[0] = 0 and offsets[-1] = n_trials_total
+    :param proportiontocut: Proportion of trials to cut from each end of the distribution
+
+    :return: array of shape (n_conditions, ...), nan for the conditions without trials
+    '''
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    if offsets[0] != 0 or offsets[-1] != len(data) or np.any(counts < 0):
+        raise ValueError("offsets must increase from 0 to the number of trials.")
+
+    out = np.full((len(counts),) + data.shape[1:], np.nan, dtype=data.dtype)
+    for n_trials in np.unique(counts[counts > 0]):
+        groups = np.flatnonzero(counts == n_trials)
+        # (n_trials, n_groups, ...) stack of all the conditions with n_trials trials
+        rows = offsets[groups][None, :] + np.arange(n_trials)[:, None]
+        out[groups] = trimmed_mean(data[rows], proportiontocut)
+    return out
+
+
+def get_trimmed_mean(epochs, proportiontocut, dtype=None):
     '''
     Calculate the trimmed mean ERP from epochs.
 
     :param epochs: MNE Epochs object
     :param proportiontocut: Proportion of trials to cut from each end of the distribution
+    :param dtype: precision of the trial data while computing the mean, defaults to config.FLOAT_DTYPE
 
     :returns: trimmed_evoked -- the trimmed mean ERP as an Evoked object
     '''
-    data = epochs.get_data()
+    data = get_epochs_data(epochs, dtype)
     n_trials = len(epochs)
-    trimmed_erp_data = np.apply_along_axis(
-        trim_mean,
-        axis=0, # along the trial axis
-        arr=data,
-        proportiontocut=proportiontocut
-    ) # (n_channels, n_times)
+    trimmed_erp_data = trimmed_mean(data, proportiontocut) # (n_channels, n_times)
     # Create the final Evoked object
     trimmed_evoked = mne.EvokedArray(
         trimmed_erp_data, 
@@ -30,7 +80,7 @@ def get_trimmed_mean(epochs, proportiontocut):
 
 
 
-def get_evoked(conditions_dict, epochs, proportiontocut=0.05, verbose=True):
+def get_evoked(conditions_dict, epochs, proportiontocut=0.05, verbose=True, dtype=None):
     '''
     Generate evoked ERPs for different conditions using trimmed mean.
     
@@ -38,6 +88,7 @@ def get_evoked(conditions_dict, epochs, proportiontocut=0.05, verbose=True):
     :param epochs: MNE Epochs object
     :param proportiontocut: Proportion of trials to cut from each end of the distribution
     :param verbose: Whether to print warnings for conditions with no trials
+    :param dtype: precision of the trial data while computing the means, defaults to config.FLOAT_DTYPE
 
     :return: Dictionary of Evoked objects for each condition
     '''
@@ -48,7 +99,7 @@ def get_evoked(conditions_dict, epochs, proportiontocut=0.05, verbose=True):
         try:
             epoch_cond = epochs[marker]
             # 2. Generate the ERP using your trimmed mean function
-            erp_cond = get_trimmed_mean(epoch_cond, proportiontocut=proportiontocut)
+            erp_cond = get_trimmed_mean(epoch_cond, proportiontocut=proportiontocut, dtype=dtype)
             # Set the comment so it shows up in the object summary
             erp_cond.comment = name
             all_evokeds[name] = erp_cond
@@ -61,6 +112,103 @@ def get_evoked(conditions_dict, epochs, proportiontocut=0.05, verbose=True):
     return all_evokeds
 
 
+def grouped_trimmed_mean(data, labels, n_groups, proportiontocut):
+    '''
+    Trimmed mean of the trials of every group in one sweep: the trials are ordered by group once and all groups are
+    trimmed together (see trimmed_mean_batch).
+
+    :param data: array of shape (n_trials, n_channels, n_times)
+    :param labels: integer group of each trial in [0, n_groups), trials with a negative label are left out
+    :param n_groups: number of groups
+    :param proportiontocut: Proportion of trials to cut from each end of the distribution (0 for the plain mean)
+
+    :return: array of shape (n_groups, n_channels, n_times) (nan for the groups without trials), number of trials per group
+    '''
+    labels = np.asarray(labels)
+    if np.any(labels >= n_groups):
+        raise ValueError(f"Group labels must be smaller than n_groups={n_groups}.")
+    keep = np.flatnonzero(labels >= 0)
+    order = keep[np.argsort(labels[keep], kind='stable')]
+    counts = np.bincount(labels[keep], minlength=n_groups)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return trimmed_mean_batch(data[order], offsets, proportiontocut), counts
+
+
+def get_condition_labels(epochs, conditions_dict):
+    '''
+    Index of the condition of every epoch, from the event codes of the epochs. Bad epochs are dropped first so that
+    the labels match the epochs data.
+
+    :param epochs: MNE Epochs object
+    :param conditions_dict: dictionary mapping condition names to event markers
+
+    :return: integer array of shape (n_epochs,), position of the condition in conditions_dict or -1 if none matches
+    '''
+    epochs.drop_bad(verbose=False)
+    code_to_condition = {}
+    norm_event_id = {_normalize_event_key(k): v for k, v in epochs.event_id.items()}
+    for i, markers in enumerate(conditions_dict.values()):
+        for marker in ([markers] if isinstance(markers, str) else markers):
+            code = norm_event_id.get(_normalize_event_key(marker))
+            if code is not None:
+                code_to_condition.setdefault(code, i)
+    return np.array([code_to_condition.get(code, -1) for code in epochs.events[:, 2]], dtype=int)
+
+
+def get_evoked_grouped(conditions_dict, epochs, bin_labels=None, n_bins=None, proportiontocut=0.05, as_evoked=True,
+                       verbose=True, dtype=None):
+    '''
+    Evoked ERPs of every condition (and every bin) from a single read of the epochs data, instead of one
+    epochs[marker] copy per condition and one get_evoked call per bin.
+
+    :param conditions_dict: dictionary mapping condition names to event markers
+    :param epochs: MNE Epochs object
+    :param bin_labels: bin index of every epoch in [0, n_bins) (-1 to leave it out), None for no binning
+    :param n_bins: number of bins, defaults to max(bin_labels) + 1
+    :param proportiontocut: Proportion of trials to cut from each end of the distribution
+    :param as_evoked: whether to return Evoked objects (True) or the data arrays and trial counts (False)
+    :param verbose: Whether to print warnings for conditions with no trials
+    :param dtype: precision of the trial data while computing the means, defaults to config.FLOAT_DTYPE
+
+    :return: (as_evoked) dictionary of Evoked objects for each condition as get_evoked, or a list of such
+             dictionaries (one per bin) if bin_labels is given
+    :return: (not as_evoked) array of shape (n_bins, n_conditions, n_channels, n_times) (n_bins = 1 without binning)
+             and the (n_bins, n_conditions) trial counts
+    '''
+    names = list(conditions_dict)
+    labels = get_condition_labels(epochs, conditions_dict)
+    if bin_labels is None:
+        bins, n_bins = np.zeros(len(labels), dtype=int), 1
+    else:
+        bins = np.asarray(bin_labels)
+        if len(bins) != len(labels):
+            raise ValueError(f"Got {len(bins)} bin labels for {len(labels)} epochs.")
+        n_bins = int(bins.max()) + 1 if n_bins is None else n_bins
+    # group = bin * n_conditions + condition
+    groups = np.where((labels >= 0) & (bins >= 0), bins * len(names) + labels, -1)
+
+    data = get_epochs_data(epochs, dtype)
+    erps, counts = grouped_trimmed_mean(data, groups, n_bins * len(names), proportiontocut)
+    erps = erps.reshape((n_bins, len(names)) + data.shape[1:])
+    counts = counts.reshape(n_bins, len(names))
+    if not as_evoked:
+        return erps, counts
+
+    binned_evokeds = []
+    for b in range(n_bins):
+        all_evokeds = {}
+        for i, name in enumerate(names):
+            if counts[b, i] == 0:
+                if verbose:
+                    print(f"Warning: No trials found for condition {name}" + ("" if bin_labels is None else f" in bin {b + 1}"))
+                continue
+            all_evokeds[name] = mne.EvokedArray(
+                erps[b, i], epochs.info, tmin=epochs.times[0], nave=int(counts[b, i]), comment=name
+            )
+        binned_evokeds.append(all_evokeds)
+    return binned_evokeds[0] if bin_labels is None else binned_evokeds
+
+
 def get_evoked_difference(all_evokeds):
     '''
     Calculate difference waves (Win - Loss) for each condition pair.
@@ -2,6 +2,15 @@ import mne
 import numpy as np
 
 
+# RewP difference waves: (label, Win condition, Loss condition)
+CONDITION_PAIRS = [
+    ('Low-Low',   'Low-Low Win',   'Low-Low Loss'),
+    ('Mid-Low',   'Mid-Low Win',   'Mid-Low Loss'),
+    ('Mid-High',  'Mid-High Win',  'Mid-High Loss'),
+    ('High-High', 'High-High Win', 'High-High Loss'),
+]
+
+
 def calculate_mean_amplitude(evoked, channel_name, tmin, tmax):
     """Calculates the mean amplitude for a channel within a time window.
     
@@ -90,16 +99,9 @@ def rewp_calculation(all_evokeds, channel='FCz', mean_window=(0.240, 0.340), ver
     :param verbose: If True, prints the results to the console
     
     :return: Dictionary with RewP metrics for each condition pair"""
-    condition_pairs = [
-        ('Low-Low',   'Low-Low Win',   'Low-Low Loss'),
-        ('Mid-Low',   'Mid-Low Win',   'Mid-Low Loss'),
-        ('Mid-High',  'Mid-High Win',  'Mid-High Loss'),
-        ('High-High', 'High-High Win', 'High-High Loss')
-    ]
-
     results = {}
 
-    for label, win_key, loss_key in condition_pairs:
+    for label, win_key, loss_key in CONDITION_PAIRS:
         if win_key in all_evokeds and loss_key in all_evokeds:
             # Create the Difference Wave: RewP = Win - Loss
             # weights=[1, -1] performs the subtraction
@@ -112,7 +114,7 @@ def rewp_calculation(all_evokeds, channel='FCz', mean_window=(0.240, 0.340), ver
             max_amp = calculate_max_amplitude(rewp_diff, channel, *mean_window)
             p2p_amp, n_t, p_t, n_amp, p_amp = calculate_peak_to_peak(rewp_diff, channel, *mean_window)
 
-            results[label] = {'mean': mean_amp, 'max': mean_amp, 'p2p': p2p_amp}
+            results[label] = {'mean': mean_amp, 'max': max_amp, 'p2p': p2p_amp}
             
             if verbose:
                 print(f"[{label}] Mean: {mean_amp:5.2f} µV | Max: {max_amp:5.2f} µV| P2P: {p2p_amp:5.2f} µV")
@@ -123,4 +125,89 @@ def rewp_calculation(all_evokeds, channel='FCz', mean_window=(0.240, 0.340), ver
     return results
 
 
+def stack_evokeds(group_evokeds, conditions=None, picks=None):
+    """
+    Stack the evokeds of all subjects into one (subjects, conditions, channels, times) array.
+
+    :param group_evokeds: {subject_id: {condition_name: Evoked}}
+    :param conditions: conditions to stack, defaults to all conditions of CONDITION_PAIRS
+    :param picks: names of the channels to stack, defaults to the channels of the first evoked
+
+    :return: data array (nan for the conditions a subject has no evoked for)
+    :return: axes -- dictionary naming the axes: 'subjects', 'conditions', 'ch_names', 'times' and the 'sfreq'
+    """
+    if conditions is None:
+        conditions = [cond for _, win_key, loss_key in CONDITION_PAIRS for cond in (win_key, loss_key)]
+    subjects = list(group_evokeds)
+    ref = next((ev for subject_id in subjects for ev in group_evokeds[subject_id].values()), None)
+    if ref is None:
+        raise ValueError("group_evokeds contains no evoked.")
+    ch_names = list(ref.ch_names if picks is None else picks)
+
+    data = np.full((len(subjects), len(conditions), len(ch_names), len(ref.times)), np.nan)
+    for i, subject_id in enumerate(subjects):
+        for j, cond in enumerate(conditions):
+            evoked = group_evokeds[subject_id].get(cond)
+            if evoked is None:
+                continue
+            if evoked.info['sfreq'] != ref.info['sfreq'] or not np.array_equal(evoked.times, ref.times):
+                raise ValueError(f"Evoked of subject {subject_id}, condition {cond} has different times.")
+            data[i, j] = evoked.get_data(picks=ch_names)
+
+    axes = {'subjects': subjects, 'conditions': list(conditions), 'ch_names': ch_names,
+            'times': ref.times.copy(), 'sfreq': ref.info['sfreq']}
+    return data, axes
+
+
+def rewp_tensor(data, axes, channel='FCz', mean_window=(0.240, 0.340), condition_pairs=CONDITION_PAIRS):
+    """
+    RewP metrics of all subjects and condition pairs at once from a (subjects, conditions, channels, times) array
+    (see stack_evokeds). Same numbers as rewp_calculation: Win - Loss difference wave, window indices as
+    Evoked.time_as_index with inclusive end.
+
+    :param data: array of shape (n_subjects, n_conditions, n_channels, n_times)
+    :param axes: dictionary with the 'conditions', 'ch_names', 'times' and 'sfreq' of data
+    :param channel: Name of the channel to analyze (default 'FCz')
+    :param mean_window: Tuple defining the time window (default 240-340 ms)
+    :param condition_pairs: list of (label, Win condition, Loss condition)
 
+    :return: dictionary of (n_subjects, n_pairs) arrays: 'mean', 'max', 'p2p' (µV), 'n_latency', 'p_latency' (ms),
+             'n_amplitude', 'p_amplitude' (V); nan where a subject misses one condition of a pair or a pair misses
+             from axes['conditions']
+    :return: labels -- list of the pair labels (second axis of the arrays)
+    """
+    conditions = axes['conditions']
+    times = axes['times']
+    c = axes['ch_names'].index(channel)
+    i_start, i_end = ((np.atleast_1d(mean_window) - times[0]) * axes['sfreq']).astype(int)
+
+    labels = [label for label, _, _ in condition_pairs]
+    present = [k for k, (_, win_key, loss_key) in enumerate(condition_pairs)
+               if win_key in conditions and loss_key in conditions]
+    win_idx = [conditions.index(condition_pairs[k][1]) for k in present]
+    loss_idx = [conditions.index(condition_pairs[k][2]) for k in present]
+
+    # difference waves in the window, shape (n_subjects, n_present, n_window)
+    diff = data[:, win_idx, c, i_start:i_end + 1] - data[:, loss_idx, c, i_start:i_end + 1]
+    n_idx = np.argmin(diff, axis=-1)
+    p_idx = np.argmax(diff, axis=-1)
+    n_amp = np.take_along_axis(diff, n_idx[..., None], axis=-1)[..., 0]
+    p_amp = np.take_along_axis(diff, p_idx[..., None], axis=-1)[..., 0]
+    mean = np.mean(diff, axis=-1)
+    missing = np.isnan(mean)
+
+    window_times = times[i_start:i_end + 1]
+    values = {
+        'mean': mean * 1e6,
+        'max': p_amp * 1e6,
+        'p2p': (p_amp - n_amp) * 1e6,
+        'n_latency': np.where(missing, np.nan, window_times[n_idx] * 1000),
+        'p_latency': np.where(missing, np.nan, window_times[p_idx] * 1000),
+        'n_amplitude': np.where(missing, np.nan, n_amp),
+        'p_amplitude': np.where(missing, np.nan, p_amp),
+    }
+    results = {}
+    for key, value in values.items():
+        results[key] = np.full((len(data), len(condition_pairs)), np.nan)
+        results[key][:, present] = value
+    return results, labels
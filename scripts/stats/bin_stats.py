@@ -2,7 +2,6 @@ from scipy import stats
 from statsmodels.stats.multitest import multipletests
 import numpy as np
 import pandas as pd
-import pingouin as pg
 
 
 def bin1_vs_bin5_stats(rewp_per_subject, conditions):
@@ -37,32 +36,114 @@ def bin1_vs_bin5_stats(rewp_per_subject, conditions):
     return results
 
 
-def rm_anova_stats(rewp_per_subject, conditions, n_bins, subjects):
+def _orthonormal_contrasts(k):
     '''
-    Perform repeated measures ANOVA with factors condition and bin, using pingouin.
+    (k, k - 1) matrix with orthonormal columns orthogonal to the constant vector.
     '''
-    records = []
-    for s_idx, subj in enumerate(subjects):
-        for cond in conditions:
-            for b in range(n_bins):
-                records.append({
-                    'subject': subj,
-                    'condition': cond,
-                    'bin': b + 1,
-                    'rewp': rewp_per_subject[cond][s_idx, b]
-                })
-
-    df_balanced = pd.DataFrame(records)
-    subjects_with_nan = df_balanced[df_balanced['rewp'].isna()]['subject'].unique()
-    df_balanced = df_balanced[~df_balanced['subject'].isin(subjects_with_nan)]
-
-    aov = pg.rm_anova(
-        data=df_balanced,
-        dv='rewp',
-        within=['condition', 'bin'],
-        subject='subject',
-        effsize='np2',
-        correction=True
-    )
-    
-    return aov[['Source', 'F', 'ddof1', 'ddof2', 'p-unc', 'p-GG-corr', 'np2', 'eps']]
\ No newline at end of file
+    q, _ = np.linalg.qr(np.column_stack([np.ones(k), np.eye(k)[:, :k - 1]]))
+    return q[:, 1:]
+
+
+def _twoway_effects(n_a, n_b):
+    '''
+    Orthonormal contrasts of the main effects and of the interaction over the flattened (n_a * n_b) cells.
+    '''
+    h_a, h_b = _orthonormal_contrasts(n_a), _orthonormal_contrasts(n_b)
+    return {
+        'a': np.kron(h_a, np.ones((n_b, 1)) / np.sqrt(n_b)),
+        'b': np.kron(np.ones((n_a, 1)) / np.sqrt(n_a), h_b),
+        'ab': np.kron(h_a, h_b),
+    }
+
+
+def _rm_anova_twoway_batch(x, effects):
+    '''
+    F, sums of squares and Greenhouse-Geisser epsilon of every effect, for a batch of (..., n_subjects, n_cells) data.
+    Each effect is tested on the subject-wise contrast scores y = x @ M: SS_effect = n * |mean(y)|^2 and SS_error
+    is the residual sum of squares of y around its mean.
+    '''
+    n = x.shape[-2]
+    out = {}
+    for name, contrasts in effects.items():
+        y = x @ contrasts                                   # (..., n_subjects, df)
+        df = contrasts.shape[1]
+        y_mean = y.mean(axis=-2, keepdims=True)
+        resid = y - y_mean
+        ss_effect = n * np.sum(y_mean[..., 0, :] ** 2, axis=-1)
+        ss_error = np.sum(resid ** 2, axis=(-2, -1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            F = (ss_effect / df) / (ss_error / (df * (n - 1)))
+            # GG epsilon from the covariance of the orthonormal contrast scores
+            cov = np.einsum('...si,...sj->...ij', resid, resid) / (n - 1)
+            eps = np.trace(cov, axis1=-2, axis2=-1) ** 2 / (df * np.sum(cov ** 2, axis=(-2, -1)))
+        out[name] = {'F': F, 'ss_effect': ss_effect, 'ss_error': ss_error, 'df': df,
+                     'eps': np.ones_like(F) if df == 1 else eps}
+    return out
+
+
+def rm_anova_twoway(x, factor_names=('condition', 'bin'), n_perm=0, seed=0, chunk_perm=1000):
+    '''
+    Two-way repeated measures ANOVA on a (n_subjects, n_levels_a, n_levels_b) array, with Greenhouse-Geisser
+    corrected p-values and an optional within-subject permutation test, with one scheme per effect:
+    the levels of factor a are permuted within each subject with the same permutation for every level of b (and
+    vice versa for factor b), and the interaction is tested by permuting, within each subject, the residuals left
+    after removing both main effects (an approximate test, as for any residual permutation). n_perm permutations
+    are evaluated chunk_perm at a time in batched matrix products. Subjects with missing values are left out.
+
+    :return: DataFrame with columns Source, F, ddof1, ddof2, p-unc, p-GG-corr, np2, eps (as pingouin.rm_anova), and p-perm if n_perm > 0
+    '''
+    x = np.asarray(x, float)
+    x = x[np.all(np.isfinite(x), axis=(1, 2))]
+    n, n_a, n_b = x.shape
+    if n < 2:
+        raise ValueError("Need at least 2 subjects without missing values for rmANOVA")
+    x = x.reshape(n, n_a * n_b)
+    effects = _twoway_effects(n_a, n_b)
+    res = _rm_anova_twoway_batch(x, effects)
+
+    if n_perm > 0:
+        rng = np.random.default_rng(seed)
+        cells = x.reshape(1, n, n_a, n_b)
+        # interaction residuals: cells minus the subject x a and subject x b means
+        resid = (cells - cells.mean(axis=3, keepdims=True) - cells.mean(axis=2, keepdims=True)
+                 + cells.mean(axis=(2, 3), keepdims=True)).reshape(1, n, n_a * n_b)
+        exceed = dict.fromkeys(effects, 0)
+        for start in range(0, n_perm, chunk_perm):
+            size = min(chunk_perm, n_perm - start)
+            permuted = {
+                'a': np.take_along_axis(cells, np.argsort(rng.random((size, n, n_a, 1)), axis=2), axis=2),
+                'b': np.take_along_axis(cells, np.argsort(rng.random((size, n, 1, n_b)), axis=3), axis=3),
+                'ab': np.take_along_axis(resid, np.argsort(rng.random((size, n, n_a * n_b)), axis=2), axis=2),
+            }
+            for name, x_perm in permuted.items():
+                F_perm = _rm_anova_twoway_batch(x_perm.reshape(size, n, n_a * n_b), {name: effects[name]})[name]['F']
+                exceed[name] += int(np.sum(F_perm >= res[name]['F']))
+
+    rows = []
+    sources = {'a': factor_names[0], 'b': factor_names[1], 'ab': f'{factor_names[0]} * {factor_names[1]}'}
+    for name, source in sources.items():
+        r = res[name]
+        df1, df2 = r['df'], r['df'] * (n - 1)
+        eps = float(r['eps'])
+        row = {
+            'Source': source,
+            'F': float(r['F']),
+            'ddof1': df1,
+            'ddof2': df2,
+            'p-unc': float(stats.f.sf(r['F'], df1, df2)),
+            'p-GG-corr': float(stats.f.sf(r['F'], df1 * eps, df2 * eps)),
+            'np2': float(r['ss_effect'] / (r['ss_effect'] + r['ss_error'])),
+            'eps': eps,
+        }
+        if n_perm > 0:
+            row['p-perm'] = (exceed[name] + 1) / (n_perm + 1)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def rm_anova_stats(rewp_per_subject, conditions, n_bins, subjects, n_perm=0, seed=0):
+    '''
+    Perform repeated measures ANOVA with factors condition and bin (see rm_anova_twoway).
+    '''
+    x = np.stack([np.asarray(rewp_per_subject[cond], float)[:len(subjects), :n_bins] for cond in conditions], axis=1)
+    return rm_anova_twoway(x, factor_names=('condition', 'bin'), n_perm=n_perm, seed=seed)
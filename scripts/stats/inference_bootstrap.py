@@ -0,0 +1,230 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import stats
+from utils.logger import log
+import config
+
+
+BLOCK_SIZE = 1000  # resamples per block of the resampling plan, each block has its own SeedSequence stream
+
+
+def _plan_blocks(n_boot):
+    """
+    Split n_boot resamples into fixed-size blocks of the resampling plan (independent of memory and data size).
+    """
+    sizes = [BLOCK_SIZE] * (n_boot // BLOCK_SIZE)
+    if n_boot % BLOCK_SIZE:
+        sizes.append(n_boot % BLOCK_SIZE)
+    return sizes
+
+
+def _group_blocks(n_blocks, n_subjects, n_columns, max_mb, n_workers):
+    """
+    Group consecutive plan blocks into tasks whose results stay below max_mb, with at least n_workers tasks
+    when there are enough blocks.
+
+    :return: list of lists of block indices
+    """
+    block_bytes = 8 * BLOCK_SIZE * (n_subjects + 2 * n_columns)
+    per_task = max(1, min(int(max_mb * 1024 ** 2 // block_bytes), -(-n_blocks // max(n_workers, 1))))
+    return [list(range(start, min(start + per_task, n_blocks))) for start in range(0, n_blocks, per_task)]
+
+
+def _missingness_patterns(valid):
+    """
+    Group the columns by the set of subjects with valid values.
+
+    :return: list of (rows, columns) index arrays, one per pattern
+    """
+    patterns, inverse = np.unique(valid.T, axis=0, return_inverse=True)
+    inverse = np.ravel(inverse)
+    return [(np.flatnonzero(pattern), np.flatnonzero(inverse == k)) for k, pattern in enumerate(patterns)]
+
+
+def _resample_block(seed, size, diff, patterns):
+    """
+    Bootstrap mean and SD of every column for one block of resamples. For each missingness pattern, the resamples
+    are drawn among the subjects with valid values in its columns, and stored as the number of times each of these
+    subjects is drawn (shared by all the columns of the pattern).
+
+    :return: (size, n_columns) arrays of the means and SDs
+    """
+    rng = np.random.default_rng(seed)
+    mean = np.full((size, diff.shape[1]), np.nan)
+    sd = np.full((size, diff.shape[1]), np.nan)
+    for rows, cols in patterns:
+        m = rows.size
+        if m < 2:
+            continue
+        counts = rng.multinomial(m, np.full(m, 1.0 / m), size=size).astype(float)   # (size, m)
+        d = diff[np.ix_(rows, cols)]
+        mean[:, cols] = (counts @ d) / m
+        var = ((counts @ d ** 2) - m * mean[:, cols] ** 2) / (m - 1)
+        sd[:, cols] = np.sqrt(np.maximum(var, 0))
+    return mean, sd
+
+
+def _resample_blocks(seeds, sizes, diff, patterns):
+    """
+    Run several plan blocks in sequence (one task of paired_bootstrap).
+    """
+    parts = [_resample_block(seed, size, diff, patterns) for seed, size in zip(seeds, sizes)]
+    return tuple(np.concatenate(part) for part in zip(*parts))
+
+
+def _jackknife(diff, valid):
+    """
+    Leave-one-subject-out mean and dz of every column (nan for the left out invalid subjects).
+    """
+    n = valid.sum(axis=0)
+    s1 = diff.sum(axis=0)
+    s2 = (diff ** 2).sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (s1 - diff) / (n - 1)
+        var = ((s2 - diff ** 2) - (n - 1) * mean ** 2) / (n - 2)
+        dz = mean / np.sqrt(np.maximum(var, 0))
+    mean[~valid.astype(bool)] = np.nan
+    dz[~valid.astype(bool)] = np.nan
+    return mean, dz
+
+
+def _percentile_ci(boot, ci):
+    alpha = (1 - ci) / 2
+    return float(np.nanquantile(boot, alpha)), float(np.nanquantile(boot, 1 - alpha))
+
+
+def _bca_ci(boot, theta, jack, ci):
+    """
+    Bias-corrected and accelerated interval: bias from the share of resamples below theta, acceleration from
+    the jackknife skewness.
+    """
+    boot = boot[np.isfinite(boot)]
+    jack = jack[np.isfinite(jack)]
+    if boot.size == 0 or not np.isfinite(theta):
+        return (np.nan, np.nan)
+    prop = (np.sum(boot < theta) + 0.5 * np.sum(boot == theta)) / boot.size
+    z0 = stats.norm.ppf(np.clip(prop, 1 / (boot.size + 1), boot.size / (boot.size + 1)))
+    dev = jack.mean() - jack
+    denom = 6 * np.sum(dev ** 2) ** 1.5
+    a = np.sum(dev ** 3) / denom if denom > 0 else 0.0
+    z = stats.norm.ppf([(1 - ci) / 2, 1 - (1 - ci) / 2])
+    levels = stats.norm.cdf(z0 + (z0 + z) / (1 - a * (z0 + z)))
+    lo, hi = np.quantile(boot, levels)
+    return float(lo), float(hi)
+
+
+def _studentized_ci(boot, boot_se, theta, se, ci):
+    """
+    Bootstrap-t interval: quantiles of (boot - theta) / boot_se, scaled by the standard error of the sample.
+    """
+    t = (boot - theta) / boot_se
+    t = t[np.isfinite(t)]
+    if t.size == 0 or not np.isfinite(se):
+        return (np.nan, np.nan)
+    alpha = (1 - ci) / 2
+    q_lo, q_hi = np.quantile(t, [alpha, 1 - alpha])
+    return float(theta - q_hi * se), float(theta - q_lo * se)
+
+
+def _dz_se(dz, n):
+    """
+    Approximate standard error of Cohen's dz.
+    """
+    return np.sqrt(1 / n + dz ** 2 / (2 * n))
+
+
+def paired_bootstrap(scores, comparisons, n_boot=10000, seed=0, ci=0.95, max_memory_mb=None, n_workers=1,
+                     logger=None):
+    """
+    Bootstrap intervals of the mean paired difference and Cohen's dz for several comparisons of the scores matrix,
+    all from one resampling plan of the subjects.
+
+    The plan is split into blocks of BLOCK_SIZE resamples, each drawn from its own SeedSequence stream, so the result
+    only depends on seed, whatever the memory ceiling or the number of workers. Blocks are grouped into tasks of at
+    most max_memory_mb, run in parallel with n_workers. Within each comparison, only the subjects with valid scores
+    in both conditions are used: comparisons sharing the same missingness pattern are resampled together, among the
+    complete cases of that pattern.
+
+    :param scores: (n_subjects, n_conditions) array, e.g. from compute_rewp_scores
+    :param comparisons: list of (label, idx_a, idx_b), as for run_score_robustness
+    :param max_memory_mb: memory ceiling of one task, defaults to config.BOOTSTRAP_MAX_MB
+    :param n_workers: worker processes (1 to run in the calling process)
+    :return: {label: {"n", "mean_diff", "d", "ci_mean", "ci_d", "n_boot", "ci"}}, ci_mean and ci_d map each
+             method ('percentile', 'bca', 'studentized') to (low, high)
+    """
+    scores = np.asarray(scores, float)
+    max_memory_mb = config.BOOTSTRAP_MAX_MB if max_memory_mb is None else max_memory_mb
+
+    diff = np.stack([scores[:, idx_a] - scores[:, idx_b] for _, idx_a, idx_b in comparisons], axis=1)
+    valid = np.isfinite(diff)
+    diff = np.where(valid, diff, 0.0)
+    n_subjects, n_columns = diff.shape
+    patterns = _missingness_patterns(valid)
+    n_valid = valid.sum(axis=0)
+
+    sizes = _plan_blocks(n_boot)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = _group_blocks(len(sizes), n_subjects, n_columns, max_memory_mb, n_workers)
+    task_args = [([seeds[i] for i in task], [sizes[i] for i in task]) for task in tasks]
+    if n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks))) as executor:
+            futures = [executor.submit(_resample_blocks, task_seeds, task_sizes, diff, patterns)
+                       for task_seeds, task_sizes in task_args]
+            parts = [future.result() for future in futures]
+    else:
+        parts = [_resample_blocks(task_seeds, task_sizes, diff, patterns) for task_seeds, task_sizes in task_args]
+    boot_mean, boot_sd = (np.concatenate(part) for part in zip(*parts))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        boot_d = np.where(boot_sd > 0, boot_mean / boot_sd, np.nan)
+        boot_mean_se = boot_sd / np.sqrt(n_valid)
+    boot_d_se = _dz_se(boot_d, n_valid)
+
+    jack_mean, jack_d = _jackknife(diff, valid)
+
+    results = {}
+    for j, (label, _, _) in enumerate(comparisons):
+        d_j = diff[valid[:, j], j]
+        n = d_j.size
+        if n < 3:
+            results[label] = {"n": int(n), "mean_diff": np.nan, "d": np.nan,
+                              "ci_mean": dict.fromkeys(("percentile", "bca", "studentized"), (np.nan, np.nan)),
+                              "ci_d": dict.fromkeys(("percentile", "bca", "studentized"), (np.nan, np.nan)),
+                              "n_boot": int(n_boot), "ci": float(ci)}
+            continue
+
+        mean_diff = float(np.mean(d_j))
+        sd = float(np.std(d_j, ddof=1))
+        d = float(mean_diff / sd) if sd > 0 else np.nan
+
+        results[label] = {
+            "n": int(n),
+            "mean_diff": mean_diff,
+            "d": d,
+            "ci_mean": {
+                "percentile": _percentile_ci(boot_mean[:, j], ci),
+                "bca": _bca_ci(boot_mean[:, j], mean_diff, jack_mean[:, j], ci),
+                "studentized": _studentized_ci(boot_mean[:, j], boot_mean_se[:, j], mean_diff, sd / np.sqrt(n), ci),
+            },
+            "ci_d": {
+                "percentile": _percentile_ci(boot_d[:, j], ci),
+                "bca": _bca_ci(boot_d[:, j], d, jack_d[:, j], ci),
+                "studentized": _studentized_ci(boot_d[:, j], boot_d_se[:, j], d, _dz_se(d, n), ci),
+            },
+            "n_boot": int(n_boot),
+            "ci": float(ci),
+        }
+        res = results[label]
+        log(logger, f"[{label}] mean diff = {mean_diff:.4g}, BCa CI = ({res['ci_mean']['bca'][0]:.4g}, "
+                    f"{res['ci_mean']['bca'][1]:.4g}); Cohen's dz = {d:.4g}, BCa CI = "
+                    f"({res['ci_d']['bca'][0]:.4g}, {res['ci_d']['bca'][1]:.4g}), n = {n}")
+
+    return results
+
+
+def paired_bootstrap_ci(x1, x2, n_boot=10000, seed=0, ci=0.95, logger=None, **kwargs):
+    """
+    Bootstrap intervals of the mean paired difference and Cohen's dz for one pair of conditions (see paired_bootstrap).
+    """
+    scores = np.column_stack([np.asarray(x1, float), np.asarray(x2, float)])
+    return paired_bootstrap(scores, [("x1 - x2", 0, 1)], n_boot=n_boot, seed=seed, ci=ci, logger=logger,
+                            **kwargs)["x1 - x2"]
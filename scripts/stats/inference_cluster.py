@@ -0,0 +1,211 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from scipy import sparse, stats
+from scipy.sparse.csgraph import connected_components
+from pipeline.s10_rewp_calculation import CONDITION_PAIRS, stack_evokeds
+from utils.logger import log
+import config
+
+
+# data shared with the worker processes (set by _init_worker)
+_WORKER = {}
+
+
+def channel_adjacency(ch_names, montage=None, bids_root=None):
+    """
+    Channel adjacency (Delaunay triangulation of the sensor positions, mne.channels.find_ch_adjacency) for the
+    given channels, from a montage or from the site2 montage of the BIDS dataset.
+
+    :param ch_names: channel names, in the order of the data
+    :param montage: DigMontage with the channel positions, defaults to the site2 montage of bids_root
+    :param bids_root: root of the BIDS dataset (only used without montage)
+    :return: sparse (n_channels, n_channels) adjacency matrix
+    """
+    import mne
+    if montage is None:
+        montage = mne.channels.read_custom_montage(Path(bids_root) / "code" / config.LOCS_FILENAME["site2"])
+    info = mne.create_info(list(ch_names), 1.0, "eeg")
+    info.set_montage(montage, match_case=False, on_missing="raise")
+    adjacency, names = mne.channels.find_ch_adjacency(info, ch_type="eeg")
+    order = [names.index(ch) for ch in ch_names]
+    return sparse.csr_matrix(adjacency)[order][:, order]
+
+
+def _spatiotemporal_adjacency(ch_adjacency, n_times):
+    """
+    Adjacency of the (channel, time) points flattened as channel * n_times + time: same time point on neighbouring
+    channels, or neighbouring time points on the same channel.
+    """
+    time_adjacency = sparse.diags([np.ones(n_times - 1), np.ones(n_times - 1)], [-1, 1])
+    adjacency = sparse.kron(ch_adjacency, sparse.eye(n_times)) + sparse.kron(sparse.eye(ch_adjacency.shape[0]), time_adjacency)
+    return sparse.csr_matrix(adjacency, dtype=bool)
+
+
+def _batched_t(signs, data, sumsq):
+    """
+    One-sample t values of every sign-flipped data set at once.
+
+    :param signs: (n_perm, n_subjects) array of +-1
+    :param data: (n_subjects, n_points) array
+    :param sumsq: sum of squares of data over subjects (unchanged by sign flips)
+    :return: (n_perm, n_points) t values
+    """
+    n = data.shape[0]
+    mean = signs @ data / n
+    var = np.maximum(sumsq - n * mean ** 2, 0) / (n - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = mean / np.sqrt(var / n)
+    return np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _find_clusters(t_values, threshold, adjacency):
+    """
+    Clusters of adjacent points above threshold (positive) or below -threshold (negative).
+
+    :return: list of (sign, point indices, cluster mass = sum of t values)
+    """
+    clusters = []
+    for sign in (1, -1):
+        points = np.flatnonzero(sign * t_values > threshold)
+        if points.size == 0:
+            continue
+        n_comp, labels = connected_components(adjacency[points][:, points], directed=False)
+        masses = np.bincount(labels, weights=t_values[points], minlength=n_comp)
+        order = np.argsort(labels, kind="stable")
+        for comp, members in enumerate(np.split(points[order], np.cumsum(np.bincount(labels, minlength=n_comp))[:-1])):
+            clusters.append((sign, members, float(masses[comp])))
+    return clusters
+
+
+def _max_cluster_mass(t_values, threshold, adjacency):
+    """
+    Largest absolute cluster mass (0 if there is no cluster).
+    """
+    masses = [abs(mass) for _, _, mass in _find_clusters(t_values, threshold, adjacency)]
+    return max(masses, default=0.0)
+
+
+def _init_worker(data, adjacency, threshold):
+    _WORKER.update(data=data, sumsq=np.sum(data ** 2, axis=0), adjacency=adjacency, threshold=threshold)
+
+
+def _null_chunk(seed, n_perm, chunk_perm):
+    """
+    Max cluster masses of n_perm random sign flips, evaluated chunk_perm permutations per matrix product.
+    """
+    rng = np.random.default_rng(seed)
+    data, sumsq = _WORKER["data"], _WORKER["sumsq"]
+    null = np.empty(n_perm)
+    for start in range(0, n_perm, chunk_perm):
+        n_rows = min(chunk_perm, n_perm - start)
+        signs = rng.integers(0, 2, size=(n_rows, data.shape[0])) * 2.0 - 1.0
+        t_perm = _batched_t(signs, data, sumsq)
+        for i in range(n_rows):
+            null[start + i] = _max_cluster_mass(t_perm[i], _WORKER["threshold"], _WORKER["adjacency"])
+    return null
+
+
+def cluster_permutation_test(data, ch_adjacency, n_perm=5000, p_threshold=0.05, seed=0, n_workers=None,
+                             chunk_perm=None, logger=None):
+    """
+    Spatiotemporal cluster-based sign-flip permutation test (two-sided) of subject-level difference waves against 0.
+    Points are thresholded with the one-sample t test at p_threshold, adjacent points of the same sign form clusters
+    and each cluster mass (sum of t) is compared with the null distribution of the max absolute cluster mass.
+
+    :param data: (n_subjects, n_channels, n_times) difference waves, subjects with nan are left out
+    :param ch_adjacency: (n_channels, n_channels) channel adjacency, see channel_adjacency
+    :param n_perm: number of random sign flips
+    :param p_threshold: two-sided p-value of the point-wise cluster-forming threshold
+    :param seed: seed of the sign flips (each worker gets its own SeedSequence stream)
+    :param n_workers: worker processes, defaults to config.CLUSTER_N_WORKERS
+    :param chunk_perm: permutations per batched matrix product, defaults to config.CLUSTER_CHUNK_PERM
+    :return: dict with the point-wise 't_obs' (n_channels, n_times), the 'threshold', the 'clusters' sorted by p
+             (each with 'sign', 'mask' (n_channels, n_times), 'mass', 'p'), the 'null' max cluster masses and 'n'
+    """
+    data = np.asarray(data, dtype=float)
+    data = data[np.all(np.isfinite(data), axis=(1, 2))]
+    n_subjects, n_channels, n_times = data.shape
+    if n_subjects < 2:
+        raise ValueError("Need at least 2 subjects with complete difference waves.")
+    n_workers = config.CLUSTER_N_WORKERS if n_workers is None else n_workers
+    chunk_perm = config.CLUSTER_CHUNK_PERM if chunk_perm is None else chunk_perm
+
+    flat = data.reshape(n_subjects, -1)
+    adjacency = _spatiotemporal_adjacency(sparse.csr_matrix(ch_adjacency), n_times)
+    threshold = float(stats.t.ppf(1 - p_threshold / 2, df=n_subjects - 1))
+    t_obs = _batched_t(np.ones((1, n_subjects)), flat, np.sum(flat ** 2, axis=0))[0]
+    clusters = _find_clusters(t_obs, threshold, adjacency)
+
+    # permutations split into one chunk per worker, each with an independent random stream
+    seeds = np.random.SeedSequence(seed).spawn(max(n_workers, 1))
+    sizes = np.diff(np.linspace(0, n_perm, len(seeds) + 1, dtype=int))
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(flat, adjacency, threshold)) as executor:
+            parts = list(executor.map(_null_chunk, seeds, sizes, [chunk_perm] * len(seeds)))
+    else:
+        _init_worker(flat, adjacency, threshold)
+        parts = [_null_chunk(s, n, chunk_perm) for s, n in zip(seeds, sizes)]
+    null = np.concatenate(parts)
+
+    results = []
+    for sign, members, mass in clusters:
+        mask = np.zeros(n_channels * n_times, dtype=bool)
+        mask[members] = True
+        p = (np.sum(null >= abs(mass)) + 1) / (n_perm + 1)
+        results.append({"sign": sign, "mask": mask.reshape(n_channels, n_times), "mass": mass, "p": float(p)})
+    results.sort(key=lambda c: c["p"])
+
+    n_sig = sum(c["p"] < 0.05 for c in results)
+    log(logger, f"Cluster permutation: {len(results)} clusters (t > {threshold:.2f}), {n_sig} with p < .05, "
+                f"{n_perm} permutations, n = {n_subjects}")
+    return {"t_obs": t_obs.reshape(n_channels, n_times), "threshold": threshold, "clusters": results,
+            "null": null, "n": int(n_subjects)}
+
+
+def rewp_contrast_waves(group_evokeds, pair_a="Mid-High", pair_b="High-High"):
+    """
+    Subject-level Win - Loss difference waves of context pair_a minus those of pair_b (or of pair_a alone if pair_b
+    is None), on all channels.
+
+    :param group_evokeds: {subject_id: {condition_name: Evoked}}
+    :return: (n_subjects, n_channels, n_times) array (nan for subjects missing a condition), axes of stack_evokeds
+    """
+    data, axes = stack_evokeds(group_evokeds)
+    pairs = {label: (win_key, loss_key) for label, win_key, loss_key in CONDITION_PAIRS}
+    conditions = axes["conditions"]
+
+    def diff_wave(label):
+        win_key, loss_key = pairs[label]
+        return data[:, conditions.index(win_key)] - data[:, conditions.index(loss_key)]
+
+    waves = diff_wave(pair_a) if pair_b is None else diff_wave(pair_a) - diff_wave(pair_b)
+    return waves, axes
+
+
+def cluster_test_rewp(group_evokeds, pair_a="Mid-High", pair_b="High-High", montage=None, bids_root=None,
+                      tmin=None, tmax=None, logger=None, **kwargs):
+    """
+    Cluster permutation test of the RewP contrast pair_a vs pair_b (Win - Loss difference waves) over channels x time.
+
+    :param group_evokeds: {subject_id: {condition_name: Evoked}}
+    :param montage, bids_root: channel positions for the adjacency, see channel_adjacency
+    :param tmin, tmax: time range of the test (in seconds), defaults to the whole epoch
+    :param kwargs: further parameters of cluster_permutation_test
+    :return: dict of cluster_permutation_test with the 'ch_names' and 'times' of the tested points
+    """
+    waves, axes = rewp_contrast_waves(group_evokeds, pair_a=pair_a, pair_b=pair_b)
+    times = axes["times"]
+    in_range = np.ones(len(times), dtype=bool)
+    if tmin is not None:
+        in_range &= times >= tmin
+    if tmax is not None:
+        in_range &= times <= tmax
+
+    ch_adjacency = channel_adjacency(axes["ch_names"], montage=montage, bids_root=bids_root)
+    log(logger, f"[{pair_a} vs {pair_b}] cluster permutation test over {len(axes['ch_names'])} channels x "
+                f"{in_range.sum()} time points")
+    res = cluster_permutation_test(waves[:, :, in_range], ch_adjacency, logger=logger, **kwargs)
+    res.update(ch_names=axes["ch_names"], times=times[in_range])
+    return res
@@ -28,6 +28,62 @@ def swtest(x):
     return float(p)
 
 
+def swtest_batch(x, axis=0):
+    """
+    Shapiro-Wilk p values along one axis of an N-D array (finite values only, np.nan where n < 3).
+    The Shapiro-Wilk statistic has no closed form over arrays, so each vector is tested on its own.
+    """
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    p = np.full(x.shape[:-1], np.nan)
+    for idx in np.ndindex(p.shape):
+        p[idx] = swtest(x[idx])
+    return p
+
+
+def paired_ttest_batch(x1, x2, axis=0, check_normality=False):
+    """
+    Paired-samples t-tests along one axis of N-D arrays, with the complete-case logic of paired_ttest applied
+    element by element (only the pairs where both values are finite are used).
+
+    Parameters
+    ----------
+    x1, x2 : array-like
+        Paired observations, broadcast against each other; the subjects lie along `axis`.
+    axis : int
+        Subject axis.
+    check_normality : bool
+        Whether to run Shapiro-Wilk on the paired differences of every element.
+
+    Returns
+    -------
+    dict of arrays with the shape of the broadcast inputs without `axis`
+        {"n", "t", "p", "df", "mean_diff", "cohen_dz", "normality_p"}, np.nan where n < 2
+    """
+    x1, x2 = np.broadcast_arrays(np.asarray(x1, dtype=float), np.asarray(x2, dtype=float))
+    valid = np.isfinite(x1) & np.isfinite(x2)
+    diff = np.where(valid, x1 - x2, 0.0)
+
+    n = valid.sum(axis=axis)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_diff = diff.sum(axis=axis) / n
+        resid = np.where(valid, diff - np.expand_dims(mean_diff, axis), 0.0)
+        sd_diff = np.sqrt(np.sum(resid ** 2, axis=axis) / (n - 1))
+        t = mean_diff / (sd_diff / np.sqrt(n))
+        dz = np.where(sd_diff > 0, mean_diff / sd_diff, np.nan)
+    too_few = n < 2
+    df = (n - 1).astype(float)
+    p = 2 * stats.t.sf(np.abs(t), np.where(too_few, 1.0, df))
+
+    normality_p = np.full(n.shape, np.nan)
+    if check_normality:
+        normality_p = swtest_batch(np.where(valid, x1 - x2, np.nan), axis=axis)
+
+    result = {"n": n, "t": t, "p": p, "df": df, "mean_diff": mean_diff, "cohen_dz": dz, "normality_p": normality_p}
+    for key in ("t", "p", "df", "mean_diff", "cohen_dz", "normality_p"):
+        result[key] = np.where(too_few, np.nan, result[key])
+    return result
+
+
 def paired_ttest(x1, x2, check_normality=True, logger=None):
     """
     Paired-samples t-test.
@@ -53,16 +109,8 @@ def paired_ttest(x1, x2, check_normality=True, logger=None):
             "normality_p": float
         }
     """
-    x1 = np.asarray(x1, dtype=float)
-    x2 = np.asarray(x2, dtype=float)
-
-    # keep only subjects with valid paired observations in both conditions
-    valid_pair_mask = np.isfinite(x1) & np.isfinite(x2)
-    x1 = x1[valid_pair_mask]
-    x2 = x2[valid_pair_mask]
-
-    diff = x1 - x2
-    n = diff.size
+    res = paired_ttest_batch(np.ravel(x1), np.ravel(x2), check_normality=check_normality)
+    n = int(res["n"])
 
     if n < 2:
         return {
@@ -75,33 +123,82 @@ def paired_ttest(x1, x2, check_normality=True, logger=None):
             "normality_p": np.nan,
         }
 
-    normality_p = np.nan
+    normality_p = float(res["normality_p"])
     if check_normality:
-        normality_p = swtest(diff)
         if np.isfinite(normality_p):
             log(logger, f"Shapiro-Wilk on paired differences: p = {normality_p:.4g}")
         else:
             log(logger, "Shapiro-Wilk on paired differences: not testable (n < 3)")
 
-    t, p = stats.ttest_rel(x1, x2)
-    sd_diff = np.std(diff, ddof=1)
-    dz = np.mean(diff) / sd_diff if sd_diff > 0 else np.nan
+    t, p = float(res["t"]), float(res["p"])
+    mean_diff, dz = float(res["mean_diff"]), float(res["cohen_dz"])
 
     log(logger, f"Paired t-test: t({n - 1}) = {t:.4g}, p = {p:.4g}")
-    log(logger, f"Mean difference = {np.mean(diff):.4g}")
+    log(logger, f"Mean difference = {mean_diff:.4g}")
     log(logger, f"Cohen's dz = {dz:.4g}")
 
     return {
         "n": int(n),
-        "t": float(t),
-        "p": float(p),
+        "t": t,
+        "p": p,
         "df": int(n - 1),
-        "mean_diff": float(np.mean(diff)),
-        "cohen_dz": float(dz),
-        "normality_p": float(normality_p),
+        "mean_diff": mean_diff,
+        "cohen_dz": dz,
+        "normality_p": normality_p,
     }
 
 
+def rm_anova_oneway_batch(x, subject_axis=0, condition_axis=1):
+    """
+    One-way repeated-measures ANOVAs along two axes of an N-D array, with the complete-case logic of rm_anova_oneway
+    applied element by element (a subject is used only if it is finite in all conditions).
+
+    Parameters
+    ----------
+    x : array-like
+        Repeated-measures data, subjects along `subject_axis` and conditions along `condition_axis`.
+
+    Returns
+    -------
+    dict of arrays with the shape of x without the two axes
+        {"n", "k", "F", "p", "df1", "df2", "partial_eta2", "generalized_eta2"}, np.nan where n < 2
+    """
+    x = np.moveaxis(np.asarray(x, dtype=float), (subject_axis, condition_axis), (-2, -1))
+    k = x.shape[-1]
+    if k < 2:
+        raise ValueError("Need at least 2 conditions for rmANOVA")
+
+    complete = np.all(np.isfinite(x), axis=-1)      # (..., n_subjects)
+    n = complete.sum(axis=-1)
+    x = np.where(complete[..., None], x, 0.0)
+    w = complete[..., None].astype(float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grand_mean = x.sum(axis=(-2, -1)) / (n * k)
+        cond_means = x.sum(axis=-2) / n[..., None]
+        subj_means = x.sum(axis=-1) / k
+
+        ss_total = np.sum(w * (x - grand_mean[..., None, None]) ** 2, axis=(-2, -1))
+        ss_conditions = n * np.sum((cond_means - grand_mean[..., None]) ** 2, axis=-1)
+        ss_subjects = k * np.sum(complete * (subj_means - grand_mean[..., None]) ** 2, axis=-1)
+        ss_error = ss_total - ss_conditions - ss_subjects
+
+        df1 = k - 1
+        df2 = (df1 * (n - 1)).astype(float)
+        F = (ss_conditions / df1) / (ss_error / df2)
+        partial_eta2 = np.where(ss_conditions + ss_error > 0, ss_conditions / (ss_conditions + ss_error), np.nan)
+        total = ss_conditions + ss_subjects + ss_error
+        generalized_eta2 = np.where(total > 0, ss_conditions / total, np.nan)
+    too_few = n < 2
+    p = stats.f.sf(F, df1, np.where(too_few, 1.0, df2))
+
+    result = {"n": n, "k": k, "F": F, "p": p, "df1": df1, "df2": df2,
+              "partial_eta2": partial_eta2, "generalized_eta2": generalized_eta2}
+    for key in ("F", "p", "df2", "partial_eta2", "generalized_eta2"):
+        result[key] = np.where(too_few, np.nan, result[key])
+    return result
+
+
 def rm_anova_oneway(x, logger=None):
     """
     One-way repeated-measures ANOVA.
@@ -130,40 +227,15 @@ def rm_anova_oneway(x, logger=None):
     if x.ndim != 2:
         raise ValueError("x must be a 2D array of shape (n_subjects, n_conditions)")
 
-    # keep only complete subjects across all repeated-measures conditions
-    complete_subject_mask = np.all(np.isfinite(x), axis=1)
-    x = x[complete_subject_mask]
-
-    n, k = x.shape
+    n = int(np.all(np.isfinite(x), axis=1).sum())
+    k = x.shape[1]
     if n < 2 or k < 2:
         raise ValueError("Need at least 2 subjects and 2 conditions for rmANOVA")
 
-    grand_mean = np.mean(x)
-    cond_means = np.mean(x, axis=0)
-    subj_means = np.mean(x, axis=1)
-
-    ss_total = np.sum((x - grand_mean) ** 2)
-    ss_conditions = n * np.sum((cond_means - grand_mean) ** 2)
-    ss_subjects = k * np.sum((subj_means - grand_mean) ** 2)
-    ss_error = ss_total - ss_conditions - ss_subjects
-
-    df1 = k - 1
-    df_subjects = n - 1
-    df2 = df1 * df_subjects
-
-    ms_conditions = ss_conditions / df1
-    ms_error = ss_error / df2
-    F = ms_conditions / ms_error
-    p = 1.0 - stats.f.cdf(F, df1, df2)
-
-    partial_eta2 = (
-        ss_conditions / (ss_conditions + ss_error)
-        if (ss_conditions + ss_error) > 0 else np.nan
-    )
-    generalized_eta2 = (
-        ss_conditions / (ss_conditions + ss_subjects + ss_error)
-        if (ss_conditions + ss_subjects + ss_error) > 0 else np.nan
-    )
+    res = rm_anova_oneway_batch(x)
+    F, p = float(res["F"]), float(res["p"])
+    df1, df2 = int(res["df1"]), int(res["df2"])
+    partial_eta2, generalized_eta2 = float(res["partial_eta2"]), float(res["generalized_eta2"])
 
     log(logger, f"RM ANOVA: F({df1},{df2}) = {F:.4g}, p = {p:.4g}")
     log(logger, f"partial eta^2 = {partial_eta2:.4g}")
@@ -172,10 +244,10 @@ def rm_anova_oneway(x, logger=None):
     return {
         "n": int(n),
         "k": int(k),
-        "F": float(F),
-        "p": float(p),
-        "df1": int(df1),
-        "df2": int(df2),
-        "partial_eta2": float(partial_eta2),
-        "generalized_eta2": float(generalized_eta2),
-    }
\ No newline at end of file
+        "F": F,
+        "p": p,
+        "df1": df1,
+        "df2": df2,
+        "partial_eta2": partial_eta2,
+        "generalized_eta2": generalized_eta2,
+    }
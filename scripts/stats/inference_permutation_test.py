@@ -1,23 +1,142 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from itertools import product
 from utils.logger import log
 
 
-def paired_permutation_test(x1, x2, logger=None):
+EXACT_MAX_N = 20          # enumerate all 2^n sign vectors up to this many subjects
+ENUM_CHUNK_ROWS = 2 ** 16 # sign vectors per enumeration block
+DP_MAX_HALF = 2 ** 20     # grid size of the quantized differences (sum of |differences| in grid units)
+DP_P_TOL = 1e-3           # max width of the p-value bounds of the quantized null before switching to Monte Carlo
+MC_N_PERM = 100000        # random sign vectors of the Monte Carlo fallback
+MC_Z = 2.576              # Monte Carlo p-value error bound: 99% normal interval half-width
+
+
+def _valid_paired_diff(x1, x2):
     """
-    Exact paired sign-flip permutation test (two-sided),
-    using the mean paired difference as the test statistic.
+    Paired differences of the subjects with valid observations in both conditions.
     """
     x1 = np.asarray(x1, dtype=float)
     x2 = np.asarray(x2, dtype=float)
-
-    # keep only subjects with valid paired observations in both conditions
     valid_pair_mask = np.isfinite(x1) & np.isfinite(x2)
-    x1 = x1[valid_pair_mask]
-    x2 = x2[valid_pair_mask]
+    return x1[valid_pair_mask] - x2[valid_pair_mask]
+
+
+def _signflip_enumerate(diff, stat_obs):
+    """
+    All 2^n sign-flip means, block by block, in the order of itertools.product([-1, 1], repeat=n).
+    """
+    n = diff.size
+    n_rows = 2 ** n
+    bits = np.arange(n - 1, -1, -1, dtype=np.int64)
+    perm_stats = np.empty(n_rows)
+    for start in range(0, n_rows, ENUM_CHUNK_ROWS):
+        rows = np.arange(start, min(start + ENUM_CHUNK_ROWS, n_rows), dtype=np.int64)
+        sign_block = ((rows[:, None] >> bits) & 1) * 2.0 - 1.0
+        perm_stats[start:start + len(rows)] = (sign_block * diff[None, :]).mean(axis=1)
+    p_perm = float(np.mean(np.abs(perm_stats) >= np.abs(stat_obs)))
+    return {"values": perm_stats, "weights": None, "p": p_perm, "p_error": 0.0, "method": "exact_signflip"}
+
+
+def _signflip_quantized(diff, stat_obs):
+    """
+    Exact sign-flip null of the differences quantized on a grid of DP_MAX_HALF steps, by dynamic programming over
+    the subset sums (no sign vector is enumerated). Quantization moves every sum by at most n/2 grid steps, which
+    gives lower and upper bounds of the p-value.
+    """
+    n = diff.size
+    abs_diff = np.abs(diff)
+    step = abs_diff.sum() / DP_MAX_HALF
+    q = np.rint(abs_diff / step).astype(np.int64)
+    total = int(q.sum())
+
+    # counts[t]: number of sign vectors with sum(q_i over the positive signs) = t, sum = 2 t - total
+    counts = np.zeros(total + 1)
+    counts[0] = 1.0
+    for q_i in q:
+        if q_i == 0:
+            counts *= 2
+        else:
+            counts[q_i:] = counts[q_i:] + counts[:-q_i]
+    sums = 2 * np.arange(total + 1) - total
+
+    obs = abs(int(np.sum(np.sign(diff) * q)))
+    n_rows = 2.0 ** n
+    p_perm = counts[np.abs(sums) >= obs].sum() / n_rows
+    p_low = counts[np.abs(sums) >= obs + n].sum() / n_rows
+    p_high = counts[np.abs(sums) >= obs - n].sum() / n_rows
+
+    keep = counts > 0
+    return {
+        "values": sums[keep] * step / n, "weights": counts[keep], "p": float(p_perm),
+        "p_error": float(max(p_high - p_perm, p_perm - p_low)), "p_bounds": (float(p_low), float(p_high)),
+        "method": "exact_signflip_quantized",
+    }
+
 
-    diff = x1 - x2
+def _signflip_monte_carlo(diff, stat_obs, n_perm, seed):
+    """
+    Sign-flip null from n_perm random sign vectors, p-value (k + 1) / (n_perm + 1) with a 99% error bound.
+    """
+    n = diff.size
+    rng = np.random.default_rng(seed)
+    perm_stats = np.empty(n_perm)
+    for start in range(0, n_perm, ENUM_CHUNK_ROWS):
+        n_rows = min(ENUM_CHUNK_ROWS, n_perm - start)
+        sign_block = rng.integers(0, 2, size=(n_rows, n)) * 2.0 - 1.0
+        perm_stats[start:start + n_rows] = (sign_block * diff[None, :]).mean(axis=1)
+    k = int(np.sum(np.abs(perm_stats) >= np.abs(stat_obs)))
+    p_perm = (k + 1) / (n_perm + 1)
+    p_error = MC_Z * np.sqrt(p_perm * (1 - p_perm) / n_perm)
+    return {"values": perm_stats, "weights": None, "p": float(p_perm), "p_error": float(p_error), "method": "monte_carlo_signflip"}
+
+
+def signflip_null(diff, n_perm=MC_N_PERM, seed=0, method="auto"):
+    """
+    Null distribution of the mean paired difference under sign flips, shared by paired_permutation_test and
+    plot_exact_permutation_null.
+
+    method='auto': exact enumeration up to EXACT_MAX_N subjects, then the exact null of the quantized differences
+    (dynamic programming), then Monte Carlo if the quantization bounds of the p-value are wider than DP_P_TOL.
+
+    :param diff: paired differences (finite values only)
+    :param n_perm: number of random sign vectors of the Monte Carlo fallback
+    :param seed: seed of the Monte Carlo fallback
+    :param method: 'auto', 'exact', 'quantized' or 'monte_carlo'
+
+    :return: dict with the null 'values' (and their 'weights', None for one value per sign vector), the observed
+             'stat_obs', the two-sided 'p', its error bound 'p_error', the 'method' and 'n'
+    """
+    diff = np.asarray(diff, dtype=float)
+    n = diff.size
+    stat_obs = float(np.mean(diff))
+
+    if method == "auto":
+        method = "exact" if n <= EXACT_MAX_N else "quantized"
+    if method == "quantized" and not np.any(diff):
+        method = "exact" if n <= EXACT_MAX_N else "monte_carlo"
+
+    if method == "exact":
+        null = _signflip_enumerate(diff, stat_obs)
+    elif method == "quantized":
+        null = _signflip_quantized(diff, stat_obs)
+        if null["p_bounds"][1] - null["p_bounds"][0] > DP_P_TOL:
+            null = _signflip_monte_carlo(diff, stat_obs, n_perm, seed)
+    elif method == "monte_carlo":
+        null = _signflip_monte_carlo(diff, stat_obs, n_perm, seed)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    null.update({"stat_obs": stat_obs, "n": int(n)})
+    return null
+
+
+def paired_permutation_test(x1, x2, null=None, logger=None):
+    """
+    Exact paired sign-flip permutation test (two-sided),
+    using the mean paired difference as the test statistic.
+    The null distribution is computed by signflip_null (or passed as null), also returned for plotting.
+    """
+    diff = _valid_paired_diff(x1, x2)
     n = diff.size
 
     if n < 2:
@@ -30,17 +149,15 @@ def paired_permutation_test(x1, x2, logger=None):
             "method": "exact_signflip",
         }
 
-    stat_obs = float(np.mean(diff))
-
-    sign_matrix = np.array(list(product([-1.0, 1.0], repeat=n)), dtype=float)
-    perm_stats = (sign_matrix * diff[None, :]).mean(axis=1)
-
-    p_perm = float(np.mean(np.abs(perm_stats) >= np.abs(stat_obs)))
+    if null is None:
+        null = signflip_null(diff)
+    stat_obs = null["stat_obs"]
+    p_perm = null["p"]
 
     sd_diff = np.std(diff, ddof=1)
     dz = np.mean(diff) / sd_diff if sd_diff > 0 else np.nan
 
-    log(logger, f"Permutation (exact sign-flip): stat = {stat_obs:.4g}, p = {p_perm:.4g}, n = {n}")
+    log(logger, f"Permutation ({null['method']}): stat = {stat_obs:.4g}, p = {p_perm:.4g} (± {null['p_error']:.2g}), n = {n}")
     log(logger, f"Mean difference = {np.mean(diff):.4g}")
     log(logger, f"Cohen's dz = {dz:.4g}")
 
@@ -48,9 +165,11 @@ def paired_permutation_test(x1, x2, logger=None):
         "n": int(n),
         "stat": float(stat_obs),
         "p": float(p_perm),
+        "p_error": float(null["p_error"]),
         "mean_diff": float(np.mean(diff)),
         "cohen_dz": float(dz),
-        "method": "exact_signflip",
+        "method": null["method"],
+        "null": null,
     }
 
 
@@ -60,37 +179,30 @@ def plot_exact_permutation_null(
     comparison_name="MH vs HH",
     xlabel="Mean difference in RewP (μV)",
     title="Exact paired permutation null distribution",
+    null=None,
     logger=None,
 ):
     """
     Plot the exact sign-flip null distribution for paired data.
     Test statistic = mean paired difference.
+    The null distribution is computed by signflip_null, or reused from paired_permutation_test (its "null").
     """
-    x1 = np.asarray(x1, dtype=float)
-    x2 = np.asarray(x2, dtype=float)
-
-    # keep only complete paired observations
-    valid_pair_mask = np.isfinite(x1) & np.isfinite(x2)
-    x1 = x1[valid_pair_mask]
-    x2 = x2[valid_pair_mask]
-
-    diff = x1 - x2
+    diff = _valid_paired_diff(x1, x2)
     n = diff.size
 
     if n < 2:
         raise ValueError("Need at least 2 paired observations.")
 
-    stat_obs = float(np.mean(diff))
-
-    sign_matrix = np.array(list(product([-1.0, 1.0], repeat=n)), dtype=float)
-    perm_stats = (sign_matrix * diff[None, :]).mean(axis=1)
-
-    p_perm = float(np.mean(np.abs(perm_stats) >= np.abs(stat_obs)))
+    if null is None:
+        null = signflip_null(diff)
+    stat_obs = null["stat_obs"]
+    perm_stats = null["values"]
+    p_perm = null["p"]
 
     p_text = "< .001" if p_perm < 0.001 else f"= {p_perm:.3f}".replace("0.", ".")
 
     fig, ax = plt.subplots(figsize=(6, 4.5))
-    ax.hist(perm_stats, bins=30, edgecolor="black", alpha=0.8)
+    ax.hist(perm_stats, bins=30, weights=null["weights"], edgecolor="black", alpha=0.8)
 
     ax.axvline(
         stat_obs,
@@ -138,6 +250,8 @@ def plot_exact_permutation_null(
         "stat_obs": float(stat_obs),
         "p": float(p_perm),
         "perm_stats": perm_stats,
+        "weights": null["weights"],
+        "method": null["method"],
     }
 
 
@@ -1,8 +1,13 @@
 import csv
 import json
 import numpy as np
+import pandas as pd
 from pathlib import Path
-from pipeline.s10_rewp_calculation import rewp_calculation
+from pipeline.s09_make_erps import get_evoked
+from pipeline.s10_rewp_calculation import CONDITION_PAIRS, rewp_tensor, stack_evokeds
+from scipy import stats
+from stats.inference_parametric import paired_ttest_batch
+from stats.inference_permutation_test import paired_permutation_test
 from utils.logger import log, log_scores
 
 
@@ -13,6 +18,8 @@ KEY_MAP = {
     'HH': 'High-High',
 }
 
+FLOAT32_REWP_TOL_UV = 1e-3  # max abs difference of float32 vs float64 RewP scores (µV)
+
 
 def compute_rewp_scores(group_evokeds, ch_name='FCz', tmin=0.240, tmax=0.340, logger=None):
     """
@@ -24,29 +31,131 @@ def compute_rewp_scores(group_evokeds, ch_name='FCz', tmin=0.240, tmax=0.340, lo
     if not group_evokeds:
         raise ValueError("group_evokeds is empty.")
 
-    subjects = list(group_evokeds.keys())
-    scores = []
-    for subject_id in subjects:
-        ev = group_evokeds[subject_id]
-        score_map = rewp_calculation(
-            ev,
-            epoch_dict=None,
-            verbose=False,
-            channel=ch_name,
-            mean_window=(tmin, tmax),
-        )
-        scores.append([
-            score_map[KEY_MAP['LL']]['mean'],
-            score_map[KEY_MAP['ML']]['mean'],
-            score_map[KEY_MAP['MH']]['mean'],
-            score_map[KEY_MAP['HH']]['mean'],
-        ])
-
-    scores = np.asarray(scores)
+    # all subjects and pairs at once, only the RewP channel is read
+    data, axes = stack_evokeds(group_evokeds, picks=[ch_name])
+    results, labels = rewp_tensor(data, axes, channel=ch_name, mean_window=(tmin, tmax))
+    subjects = axes['subjects']
+    scores = results['mean'][:, [labels.index(KEY_MAP[key]) for key in ('LL', 'ML', 'MH', 'HH')]]
     #log_scores(scores, subjects, logger=logger)
     return scores, subjects, KEY_MAP.copy()
 
 
+def make_window_grid(starts, lengths):
+    """
+    All (tmin, tmax) windows with tmin in starts and tmax = tmin + length for length in lengths (in seconds).
+    """
+    return [(float(tmin), float(tmin + length)) for tmin in starts for length in lengths]
+
+
+def sweep_rewp_scores(group_evokeds, windows, channels=None, logger=None):
+    """
+    RewP mean-amplitude scores (Win-Loss) for LL/ML/MH/HH over a grid of windows and channels. The difference waves
+    are summed cumulatively along time once, so the mean of every window costs O(1).
+
+    :param group_evokeds: {subject_id: {condition_name: Evoked}}
+    :param windows: list of (tmin, tmax) in seconds, see make_window_grid
+    :param channels: channels to sweep, defaults to all channels of the evokeds
+    :return: tidy DataFrame with columns subject, channel, tmin, tmax, condition (LL/ML/MH/HH), score (µV)
+    """
+    if not group_evokeds:
+        raise ValueError("group_evokeds is empty.")
+
+    data, axes = stack_evokeds(group_evokeds, picks=channels)
+    conditions = axes['conditions']
+    pair_of_key = {label: (win_key, loss_key) for label, win_key, loss_key in CONDITION_PAIRS}
+    keys = list(KEY_MAP)
+    win_idx = [conditions.index(pair_of_key[KEY_MAP[key]][0]) for key in keys]
+    loss_idx = [conditions.index(pair_of_key[KEY_MAP[key]][1]) for key in keys]
+
+    # cumulative sums of the difference waves with a leading zero, shape (n_subjects, 4, n_channels, n_times + 1)
+    diff = data[:, win_idx] - data[:, loss_idx]
+    csum = np.concatenate([np.zeros(diff.shape[:-1] + (1,)), np.cumsum(diff, axis=-1)], axis=-1)
+
+    # window indices as Evoked.time_as_index, inclusive end (as rewp_calculation)
+    windows = np.atleast_2d(np.asarray(windows, dtype=float))
+    idx = ((windows - axes['times'][0]) * axes['sfreq']).astype(int)
+    i_start, i_end = idx[:, 0], idx[:, 1]
+    if np.any(i_start < 0) or np.any(i_end >= len(axes['times'])) or np.any(i_end < i_start):
+        raise ValueError("All windows must lie within the epochs and have tmin <= tmax.")
+
+    # shape (n_subjects, 4, n_channels, n_windows)
+    scores = (csum[..., i_end + 1] - csum[..., i_start]) / (i_end - i_start + 1) * 1e6
+
+    n_subjects, n_keys, n_channels, n_windows = scores.shape
+    table = pd.DataFrame({
+        'subject': np.repeat(axes['subjects'], n_keys * n_channels * n_windows),
+        'channel': np.tile(np.repeat(axes['ch_names'], n_windows), n_subjects * n_keys),
+        'tmin': np.tile(windows[:, 0], n_subjects * n_keys * n_channels),
+        'tmax': np.tile(windows[:, 1], n_subjects * n_keys * n_channels),
+        'condition': np.tile(np.repeat(keys, n_channels * n_windows), n_subjects),
+        'score': scores.ravel(),
+    })
+    log(logger, f"RewP sweep: {n_channels} channels x {n_windows} windows x {n_subjects} subjects")
+    return table
+
+
+def _mean_ci_t_batch(x, valid, alpha=0.05):
+    """
+    Mean and t-distribution CI (as mean_ci_t) of every row of x, over the entries where valid is True.
+    """
+    n = valid.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = np.where(valid, x, 0.0).sum(axis=1) / n
+        sd = np.sqrt(np.sum(np.where(valid, x - m[:, None], 0.0) ** 2, axis=1) / (n - 1))
+        half = stats.t.ppf(1 - alpha / 2, df=np.maximum(n - 1, 1)) * sd / np.sqrt(n)
+    half = np.where(n < 2, np.nan, half)
+    return m, m - half, m + half
+
+
+def sweep_rewp_comparison(sweep_table, key_a='MH', key_b='HH', permutation_points=None, logger=None):
+    """
+    Paired comparison of two conditions (as summarize_rewp_comparison) for every channel/window of a sweep.
+    The table is pivoted once to (grid points x subjects) matrices and the t-tests of all grid points are computed
+    at once (paired_ttest_batch). The sign-flip permutation test is costly, so it is only run on the requested points.
+
+    :param sweep_table: DataFrame returned by sweep_rewp_scores
+    :param permutation_points: (channel, tmin, tmax) grid points where the permutation test is also run,
+                               'all' for every point, None for none (p_permutation is NaN where it is not run)
+    :return: DataFrame with one row per channel/window: means and CIs of both conditions, paired t-test and
+             permutation results
+    """
+    wide = sweep_table.pivot_table(
+        index=['channel', 'tmin', 'tmax'], columns=['condition', 'subject'], values='score', dropna=False, sort=False
+    )
+    subjects = sweep_table['subject'].unique()
+    x_a = wide[key_a].reindex(columns=subjects).to_numpy(dtype=float)     # (n_points, n_subjects)
+    x_b = wide[key_b].reindex(columns=subjects).to_numpy(dtype=float)
+    valid = np.isfinite(x_a) & np.isfinite(x_b)
+
+    t_res = paired_ttest_batch(x_a, x_b, axis=1)
+    mean_a, low_a, high_a = _mean_ci_t_batch(x_a, valid)
+    mean_b, low_b, high_b = _mean_ci_t_batch(x_b, valid)
+    summary = wide.index.to_frame(index=False)
+    summary = summary.assign(**{
+        'n': t_res['n'],
+        f'mean_{key_a}': mean_a, f'ci_low_{key_a}': low_a, f'ci_high_{key_a}': high_a,
+        f'mean_{key_b}': mean_b, f'ci_low_{key_b}': low_b, f'ci_high_{key_b}': high_b,
+        't': t_res['t'], 'p_ttest': t_res['p'], 'cohen_dz': t_res['cohen_dz'],
+        'p_permutation': np.nan,
+    })
+
+    if permutation_points is not None:
+        if isinstance(permutation_points, str) and permutation_points == 'all':
+            rows = np.arange(len(wide))
+        else:
+            rows = wide.index.get_indexer(pd.MultiIndex.from_tuples(
+                [(channel, float(tmin), float(tmax)) for channel, tmin, tmax in permutation_points]
+            ))
+            if np.any(rows < 0):
+                raise ValueError("Some permutation points are not in the sweep grid.")
+        for row in rows:
+            summary.loc[row, 'p_permutation'] = paired_permutation_test(x_a[row], x_b[row], logger=None)['p']
+
+    log(logger, f"{key_a} vs {key_b} over {len(summary)} channel/window choices: "
+                f"p_ttest < 0.05 in {np.mean(summary['p_ttest'] < 0.05):.1%}")
+    return summary
+
+
 def save_rewp_scores(scores, subjects, out_path, logger=None):
     """
     Save RewP scores to CSV.
@@ -88,4 +197,30 @@ def load_rewp_scores(path, logger=None):
 
     scores = np.asarray(scores, dtype=float)
     log(logger, f"Loaded RewP scores <- {path}")
-    return scores, subjects, KEY_MAP.copy()
\ No newline at end of file
+    return scores, subjects, KEY_MAP.copy()
+
+
+def check_float32_rewp_scores(group_epochs, conditions_dict, proportiontocut=0.05, ch_name='FCz', tmin=0.240, tmax=0.340,
+                              tol=FLOAT32_REWP_TOL_UV, logger=None):
+    """
+    Regression check of the float32 mode: build the trimmed-mean ERPs with float64 and float32 trial data,
+    compute the RewP scores of both and compare them.
+
+    :param group_epochs: {subject_id: feedback-locked Epochs}
+    :param conditions_dict: condition name -> event markers (config.CONDITIONS_DICT['feedback_locked'])
+    :param tol: max allowed abs difference (µV), raises RuntimeError above it
+    :return: max abs difference (µV), scores float64 (n_subjects, 4), scores float32 (n_subjects, 4)
+    """
+    scores = {}
+    for dtype in ('float64', 'float32'):
+        group_evokeds = {
+            subject_id: get_evoked(conditions_dict, epochs, proportiontocut=proportiontocut, verbose=False, dtype=dtype)
+            for subject_id, epochs in group_epochs.items()
+        }
+        scores[dtype], _, _ = compute_rewp_scores(group_evokeds, ch_name=ch_name, tmin=tmin, tmax=tmax)
+
+    max_diff = float(np.nanmax(np.abs(scores['float64'] - scores['float32'])))
+    log(logger, f"float32 vs float64 RewP scores: max |difference| = {max_diff:.2e} µV (tolerance {tol:.0e} µV)")
+    if max_diff > tol:
+        raise RuntimeError(f"float32 RewP scores differ from float64 by {max_diff:.2e} µV (tolerance {tol:.0e} µV).")
+    return max_diff, scores['float64'], scores['float32']
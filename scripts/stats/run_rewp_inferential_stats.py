@@ -73,7 +73,9 @@ def summarize_rewp_comparison(
         f"{label_a}: {m1:.2f} μV, 95% CI [{lo1:.2f}, {hi1:.2f}]",
         f"{label_b}: {m2:.2f} μV, 95% CI [{lo2:.2f}, {hi2:.2f}]",
         f"t({t_res['df']}) = {t_res['t']:.2f}, p {_format_p_value(t_res['p'])}, Cohen's d = {t_res['cohen_dz']:.2f}",
-        f"Exact paired permutation: p {_format_p_value(perm_res['p'])}",
+        f"Exact paired permutation: p {_format_p_value(perm_res['p'])}"
+        if perm_res['method'] == "exact_signflip" else
+        f"Paired permutation ({perm_res['method']}): p {_format_p_value(perm_res['p'])} (± {perm_res['p_error']:.1g})",
     ]
 
     return {
@@ -1,84 +1,87 @@
 import numpy as np
-import mne
 import pandas as pd
 import config
+from pipeline.s09_make_erps import get_condition_labels, get_evoked_grouped
 from pipeline.s10_rewp_calculation import rewp_calculation
 
-def binning(epochs, conditions_dict, bin_num=4):
+def _task_groups(conditions_dict):
     '''
-    This function takes in the epochs and the conditions dictionary, and returns a dictionary of binned epochs and a dataframe of trial counts per condition per bin.
+    Broad task group (low, mid, high) of every condition, for chronological slicing. Conditions outside the three
+    groups are left out.
     '''
-    
-    binned_epochs = []
-    
-    # 2. Define the broad groups for chronological slicing
-    groups = {'low': [], 'mid': [], 'high': []}
-    for condition, marker_list in conditions_dict.items():
+    groups = {}
+    for condition in conditions_dict:
         if condition in ['Low-Low Win', 'Low-Low Loss']:
-            groups['low'].extend(marker_list)
+            groups[condition] = 'low'
         elif 'Mid-' in condition:
-            groups['mid'].extend(marker_list)
+            groups[condition] = 'mid'
         elif 'High-High' in condition:
-            groups['high'].extend(marker_list)
-
-    # Loop through all the task groups (three in total)
-    for group_name, markers in groups.items():
-        #print(f'DEBUG: Processing group {group_name} with markers {markers}')
-        #available_markers = [m for m in markers if m in epochs.event_id]    #conditions in each group
-        
-        # Select epochs for this task group
-        current_epochs = epochs[markers]
-        #print(f'DEBUG: the number of trials before dropping is {len(current_epochs)}(not sure if this is before dropping or after)')
-        
-        n_group_trials = len(current_epochs)
-        
-        # Calculate chronological cut points
-        group_cut_points = np.linspace(0, n_group_trials, bin_num + 1, dtype=int)
-        #print(f'DEBUG: Cut points for group {group_name}: {group_cut_points}')
-
-        for i in range(bin_num):
-            start, end = group_cut_points[i], group_cut_points[i+1]
-            epochs_bin = current_epochs[start:end]
-            
-            binned_epochs.append({
-                'bin': i + 1, 
-                'epochs': epochs_bin,
-            })
-            #print(f'DEBUG: Created bin {i + 1} for group {group_name} with {len(epochs_bin)} trials.')
-
-    # Combine bins across groups
-    binned_epochs_combined = {}
-    for entry in binned_epochs:
-        bin_index = entry['bin']
-        if bin_index not in binned_epochs_combined:
-            # If it's the first time seeing this bin, initialize it
-            binned_epochs_combined[bin_index] = [entry['epochs']]
-        else:
-            # If the bin exists, extend the existing list with new epochs
-            binned_epochs_combined[bin_index].append(entry['epochs'])
-
-    for bin_index in binned_epochs_combined:
-        binned_epochs_combined[bin_index] = mne.concatenate_epochs(binned_epochs_combined[bin_index])
+            groups[condition] = 'high'
+    return groups
+
+
+def get_bin_labels(epochs, conditions_dict, bin_num=4):
+    '''
+    Chronological bin (1..bin_num) of every epoch: the trials of each task group (low, mid, high) are ranked in order
+    of occurrence and cut into bin_num bins of (almost) equal size.
+
+    :return: bin of every epoch (0 for the epochs of no task group), condition index of every epoch (see get_condition_labels)
+    '''
+    cond_labels = get_condition_labels(epochs, conditions_dict)
+    task_groups = _task_groups(conditions_dict)
+    group_of_condition = np.array([['low', 'mid', 'high'].index(task_groups[c]) if c in task_groups else -1
+                                   for c in conditions_dict], dtype=int)
+    group_labels = np.where(cond_labels >= 0, group_of_condition[cond_labels], -1)
+
+    bins = np.zeros(len(cond_labels), dtype=int)
+    for group in range(3):
+        members = np.flatnonzero(group_labels == group)
+        # rank within the group -> bin, same cut points as slicing the group epochs
+        cut_points = np.linspace(0, len(members), bin_num + 1, dtype=int)
+        bins[members] = np.searchsorted(cut_points, np.arange(len(members)), side='right')
+    return bins, cond_labels
+
+
+def binning(epochs, conditions_dict, bin_num=4):
+    '''
+    This function takes in the epochs and the conditions dictionary, and returns a dictionary of binned epochs and a dataframe of trial counts per condition per bin.
+    The bin of every epoch is also stored in the 'bin' column of epochs.metadata (0 for the epochs of no task group).
+    The binned epochs are index selections of epochs (in chronological order), no epochs are concatenated.
+    '''
+    bins, cond_labels = get_bin_labels(epochs, conditions_dict, bin_num=bin_num)
+
+    metadata = pd.DataFrame(index=range(len(epochs))) if epochs.metadata is None else epochs.metadata
+    metadata['bin'] = bins
+    epochs.metadata = metadata
 
+    binned_epochs_combined = {i + 1: epochs[np.flatnonzero(bins == i + 1)] for i in range(bin_num)}
 
     # Count trials per condition per bin
-    bin_trial_counts = {}
-    for bin_idx, bin_epochs in binned_epochs_combined.items():
-        bin_trial_counts[bin_idx] = {}
-        for cond, markers in conditions_dict.items():
-            # select using the raw stimulus string(s)
-            available_markers = [m for m in markers if m in bin_epochs.event_id]
-            if available_markers:
-                bin_trial_counts[bin_idx][cond] = len(bin_epochs[available_markers])
-            else:
-                bin_trial_counts[bin_idx][cond] = 0
-
-        df_counts = pd.DataFrame(bin_trial_counts).T
-        df_counts.index.name = 'bin'  
+    names = list(conditions_dict)
+    trials = pd.DataFrame({'bin': bins, 'condition': cond_labels})
+    trials = trials[(trials['bin'] > 0) & (trials['condition'] >= 0)]
+    df_counts = (
+        trials.groupby(['bin', 'condition']).size().unstack(fill_value=0)
+        .reindex(index=range(1, bin_num + 1), columns=range(len(names)), fill_value=0)
+    )
+    df_counts.columns = names
+    df_counts.index.name = 'bin'
 
     return binned_epochs_combined, df_counts
 
 
+def get_binned_evoked(epochs, conditions_dict, bin_num=4, proportiontocut=0.05, verbose=True, dtype=None):
+    '''
+    Evoked ERPs of every condition in every chronological bin, from one read of the epochs data (see
+    get_evoked_grouped) instead of one get_evoked call per binned epochs.
+
+    :return: list of bin_num dictionaries of Evoked objects for each condition, as get_evoked on each bin of binning
+    '''
+    bins, _ = get_bin_labels(epochs, conditions_dict, bin_num=bin_num)
+    return get_evoked_grouped(conditions_dict, epochs, bin_labels=bins - 1, n_bins=bin_num,
+                              proportiontocut=proportiontocut, verbose=verbose, dtype=dtype)
+
+
 
 def get_group_binned_rewp(n_bins, subjects, epoch_dict, binned_group_evokeds, learners_only=False):
     '''
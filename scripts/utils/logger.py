@@ -156,6 +156,22 @@ def log_bad_channels(logger, subject_id, bad_channels):
     )
     log(logger, msg)
 
+def log_cache_stats(logger, stats, size_bytes):
+    """
+    Log the hit/miss statistics of the preprocessing stage cache.
+
+    :param logger: preset up logger
+    :param stats: dictionary with the 'hits', 'misses' and 'evictions' counts
+    :param size_bytes: current size of the cache on disk
+    """
+    n_lookups = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / n_lookups if n_lookups else float('nan')
+    msg = (
+        f"Stage cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0%} hit rate), "
+        f"{stats['evictions']} evictions, {size_bytes / 1024 ** 3:.2f} GB on disk"
+    )
+    log(logger, msg)
+
 def setup_stats_logger(group_label, out_dir=None, repo_root=None,
                        console_level=logging.INFO, file_level=logging.DEBUG):
     return setup_rewp_logger(
@@ -0,0 +1,141 @@
+import mmap
+import tempfile
+import weakref
+from fractions import Fraction
+from pathlib import Path
+
+import mne
+import numpy as np
+import config
+
+
+DEFAULT_SCRATCH_DIR = Path(__file__).resolve().parents[2] / "output_mne" / "scratch"
+
+
+def make_scratch_dir(prefix="raw_"):
+    '''
+    Create a new scratch directory for memory-mapped recordings, under config.SCRATCH_DIR or output_mne/scratch.
+    Keep the scratch directory on a disk (not on a tmpfs, which lives in RAM).
+    '''
+    root = Path(config.SCRATCH_DIR or DEFAULT_SCRATCH_DIR)
+    root.mkdir(parents=True, exist_ok=True)
+    return Path(tempfile.mkdtemp(prefix=prefix, dir=root))
+
+
+def release_pages(data):
+    '''
+    Write a memmap to disk and drop its pages from the resident memory of the process (they are read back from the
+    page cache or the disk when accessed again). Does nothing for in-memory arrays and on platforms without madvise.
+    '''
+    if not isinstance(data, np.memmap):
+        return
+    data.flush()
+    buffer = getattr(data, '_mmap', None)
+    if buffer is not None and hasattr(mmap, 'MADV_DONTNEED'):
+        buffer.madvise(mmap.MADV_DONTNEED)
+
+
+def preload_memmap(raw, path, chunk_sec=60):
+    '''
+    Load the data of a (not preloaded) Raw object into a disk-backed memmap, chunk by chunk, instead of raw.load_data().
+
+    :param raw: Raw object reading from its file
+    :param path: file of the memmap
+    :param chunk_sec: length of the chunks read at once (in seconds)
+
+    :return: float64 memmap of shape (n_channels, n_times)
+    '''
+    n_times = raw.n_times
+    data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(len(raw.ch_names), n_times))
+    step = max(int(chunk_sec * raw.info['sfreq']), 1)
+    for start in range(0, n_times, step):
+        stop = min(start + step, n_times)
+        data[:, start:stop] = raw.get_data(start=start, stop=stop)
+        release_pages(data)
+    return data
+
+
+def run_chunked(data, info, process, halo_sec, out_dir, new_sfreq=None, chunk_sec=120, first_samp=0, annotations=None):
+    '''
+    Run a chain of preprocessing stages on a long recording chunk by chunk, with bounded memory.
+
+    Each chunk is extended by halo_sec on both sides, wrapped in a Raw object and passed to process. The halos are
+    then cut from the outputs, and the rest is written to one memmap per output in out_dir. With a halo longer than
+    the impulse response of the chain (FIR filters, polyphase resampling), the outputs are the same as running
+    process on the whole recording. Chunk borders are aligned to the resampling ratio, so a resampling step sees
+    the same sample phase as on the whole recording.
+
+    :param data: array of shape (n_channels, n_times), e.g. a memmap from preload_memmap (not modified, only read
+                 chunk by chunk)
+    :param info: measurement info of data
+    :param process: function mapping a Raw chunk to a dictionary of processed Raw objects at new_sfreq, it may
+                    modify the chunk in place
+    :param halo_sec: length of the context added on both sides of each chunk (in seconds)
+    :param out_dir: directory of the output memmaps (removed when the outputs are garbage collected)
+    :param new_sfreq: sampling frequency of the outputs of process (None if process does not resample)
+    :param chunk_sec: length of the chunks (in seconds, at least twice halo_sec is used)
+    :param first_samp: first sample of data in the original recording
+    :param annotations: annotations set on the outputs (in seconds, so they are unaffected by resampling)
+
+    :return: dictionary mapping the keys of process to Raw objects backed by memmaps
+    '''
+    out_dir = Path(out_dir)
+    sfreq = info['sfreq']
+    ratio = Fraction((new_sfreq or sfreq) / sfreq).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+    n_times = data.shape[1]
+    n_out = n_times * up // down   # down_sampling crops the samples beyond a multiple of down
+
+    # halo and chunk lengths in input samples, multiples of down so that chunk borders fall on output samples
+    halo = -(-int(np.ceil(halo_sec * sfreq)) // down) * down
+    chunk = max(-(-int(round(chunk_sec * sfreq)) // down) * down, 2 * halo)
+
+    outputs = {}
+    start = 0
+    while start < n_times:
+        stop = start + chunk
+        if n_times - stop < chunk:
+            stop = n_times  # the last chunk takes the remainder, so that it is never shorter than the filters
+        lo, hi = max(start - halo, 0), min(stop + halo, n_times)
+
+        processed = process(mne.io.RawArray(np.array(data[:, lo:hi]), info, verbose=False))
+        out_lo = lo * up // down
+        out_start = start * up // down
+        out_stop = n_out if stop == n_times else stop * up // down
+        for name, raw_out in processed.items():
+            if raw_out.info['sfreq'] != float(new_sfreq or sfreq):
+                raise ValueError(f"Output '{name}' of the chunked chain is at {raw_out.info['sfreq']} Hz, expected {new_sfreq or sfreq} Hz.")
+            if name not in outputs:
+                outputs[name] = (
+                    np.lib.format.open_memmap(out_dir / f"{name}.npy", mode='w+', dtype=np.float64,
+                                              shape=(len(raw_out.ch_names), n_out)),
+                    raw_out.info,
+                )
+            outputs[name][0][:, out_start:out_stop] = raw_out._data[:, out_start - out_lo:out_stop - out_lo]
+            release_pages(outputs[name][0])
+        del processed
+        release_pages(data)
+        start = stop
+
+    result = {}
+    for name, (out_data, out_info) in outputs.items():
+        out_data.flush()
+        raw_out = mne.io.RawArray(out_data, out_info, first_samp=int(round(first_samp * up / down)), verbose=False)
+        if annotations is not None:
+            raw_out.set_annotations(annotations)
+        # the memmap file is removed together with the Raw object it backs
+        weakref.finalize(raw_out, _remove_scratch_file, out_dir / f"{name}.npy")
+        result[name] = raw_out
+    return result
+
+
+def _remove_scratch_file(path):
+    '''
+    Remove a scratch file, and its directory once it is empty.
+    '''
+    path = Path(path)
+    path.unlink(missing_ok=True)
+    try:
+        path.parent.rmdir()
+    except OSError:
+        pass
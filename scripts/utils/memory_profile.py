@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+
+def _current_rss():
+    '''
+    Resident set size of this process in bytes (None if psutil is not installed).
+    '''
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+class MemoryTracker:
+    '''
+    Record the peak resident memory and the allocated bytes of each stage of a processing chain.
+
+    Peak RSS is sampled by a background thread while a stage runs. Allocations are measured with tracemalloc
+    (numpy buffers are reported to it): the peak of the traced memory during the stage above the traced memory
+    at its start, and the net bytes still allocated at its end.
+    '''
+
+    def __init__(self, interval=0.005):
+        '''
+        :param interval: sampling interval of the RSS in seconds
+        '''
+        self.interval = interval
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager around one stage of the chain.
+        '''
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        traced_start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+
+        rss_start = _current_rss()
+        peak_rss = [rss_start]
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(self.interval):
+                peak_rss[0] = max(peak_rss[0], _current_rss())
+
+        sampler = threading.Thread(target=sample, daemon=True) if rss_start is not None else None
+        if sampler is not None:
+            sampler.start()
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - t_start
+            if sampler is not None:
+                stop.set()
+                sampler.join()
+            traced_end, traced_peak = tracemalloc.get_traced_memory()
+            rss_end = _current_rss()
+            if started_tracing:
+                tracemalloc.stop()
+            self.records.append({
+                'stage': name,
+                'duration_sec': duration,
+                'peak_rss_mb': None if rss_end is None else max(peak_rss[0], rss_end) / 1024 ** 2,
+                'rss_end_mb': None if rss_end is None else rss_end / 1024 ** 2,
+                'peak_alloc_mb': (traced_peak - traced_start) / 1024 ** 2,
+                'net_alloc_mb': (traced_end - traced_start) / 1024 ** 2,
+            })
+
+    def report(self):
+        '''
+        :return: pandas DataFrame with one row per recorded stage
+        '''
+        return pd.DataFrame(self.records)
+
+
+def track_stage(tracker, name):
+    '''
+    tracker.stage(name) if a tracker is given, otherwise a context manager doing nothing.
+    '''
+    return nullcontext() if tracker is None else tracker.stage(name)
+
+
+def compare_memory_reports(report_copy, report_inplace):
+    '''
+    Per-stage comparison of the memory reports of the copying and the in-place execution of the same chain.
+
+    :param report_copy: MemoryTracker.report() of the copying run
+    :param report_inplace: MemoryTracker.report() of the in-place run
+
+    :return: pandas DataFrame with the peak RSS and peak allocations of both runs per stage, and an 'overall' row
+    '''
+    columns = ['stage', 'peak_rss_mb', 'peak_alloc_mb', 'duration_sec']
+    stages = list(report_copy['stage']) + [stage for stage in report_inplace['stage'] if stage not in set(report_copy['stage'])]
+    merged = (
+        report_copy[columns].merge(report_inplace[columns], on='stage', how='outer', suffixes=('_copy', '_inplace'))
+        .set_index('stage').loc[stages].reset_index()
+    )
+    overall = {'stage': 'overall'}
+    for column in columns[1:]:
+        for suffix in ('_copy', '_inplace'):
+            values = merged[column + suffix]
+            overall[column + suffix] = values.sum() if column == 'duration_sec' else values.max()
+    merged = pd.concat([merged, pd.DataFrame([overall])], ignore_index=True)
+    merged['peak_rss_reduction_mb'] = merged['peak_rss_mb_copy'] - merged['peak_rss_mb_inplace']
+    merged['peak_alloc_reduction_mb'] = merged['peak_alloc_mb_copy'] - merged['peak_alloc_mb_inplace']
+    return merged
@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import mne
+import config
+from utils.logger import log, log_cache_stats
+
+
+CACHE_VERSION = 2   # bump when a cached stage changes its behavior, invalidates all entries
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parents[2] / "output_mne" / "cache"
+
+_CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+class StageNode(NamedTuple):
+    '''
+    A lazy preprocessing stage: its cache key and how to compute its output if the key is not cached.
+    '''
+    name: str
+    key: str
+    compute: Callable
+    cache_dir: Path
+    logger: object
+
+
+def file_identity(paths):
+    '''
+    Identity of input files (path, size and modification time), used in the key of the first stage.
+
+    :param paths: file or directory paths, directories contribute all files they contain
+
+    :return: sorted list of [path, size, mtime_ns] entries
+    '''
+    files = []
+    for path in paths:
+        path = Path(path)
+        files.extend(sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path])
+    identity = []
+    for path in files:
+        stat = path.stat()
+        identity.append([str(path.resolve()), stat.st_size, stat.st_mtime_ns])
+    return sorted(identity)
+
+
+def stage_key(name, params=None, upstream_key=None, identity=None):
+    '''
+    Content-addressed key of a stage: hash of the stage name, its parameters, the upstream key
+    and (for the first stage) the identity of the input files.
+    '''
+    payload = json.dumps(
+        {
+            'version': CACHE_VERSION,
+            'stage': name,
+            'params': params or {},
+            'upstream': upstream_key,
+            'identity': identity,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def cached_stage(name, func, params=None, upstream=None, identity=None, cache_dir=None, logger=None):
+    '''
+    Declare a cached stage. Nothing is computed until `materialize` is called on the returned node
+    (or on a downstream node), which lets the chain resume from the deepest stage found in the cache.
+
+    :param name: stage name (part of the key)
+    :param func: stage function, called as func(**params) for a first stage or func(raw, **params) otherwise
+    :param params: stage parameters (part of the key), must be JSON-serializable
+    :param upstream: StageNode whose output is the input of this stage, None for a first stage
+    :param identity: identity of the input files of a first stage (see file_identity)
+    :param cache_dir: cache directory, defaults to config.STAGE_CACHE_DIR or output_mne/cache
+    :param logger: logger object for cache hit/miss messages
+
+    :return: StageNode
+    '''
+    params = dict(params or {})
+    if cache_dir is None:
+        cache_dir = config.STAGE_CACHE_DIR or DEFAULT_CACHE_DIR
+    key = stage_key(name, params, upstream_key=None if upstream is None else upstream.key, identity=identity)
+
+    def compute():
+        if upstream is None:
+            return func(**params)
+        return func(materialize(upstream), **params)
+
+    return StageNode(name, key, compute, Path(cache_dir), logger)
+
+
+def _entry_paths(cache_dir, key):
+    '''
+    Data file, annotations file and completion marker of a cache entry (the marker is written last, after the data).
+    '''
+    return cache_dir / f"{key}_raw.fif", cache_dir / f"{key}_annot.json", cache_dir / f"{key}.done"
+
+
+def _save_annotations(annotations, path):
+    '''
+    Save the annotations at full precision. FIF files store their onsets in single precision, which moves events
+    lying on a half sample (e.g. odd samples of a 500 Hz recording downsampled to 250 Hz) to the other sample.
+    '''
+    with open(path, "w") as f:
+        json.dump({
+            'onset': annotations.onset.tolist(),
+            'duration': annotations.duration.tolist(),
+            'description': annotations.description.tolist(),
+            'ch_names': [list(ch_names) for ch_names in annotations.ch_names],
+        }, f)
+
+
+def _restore_annotations(raw, path):
+    '''
+    Replace the (single precision) annotations read from a cached FIF file by the saved full precision ones.
+    '''
+    with open(path) as f:
+        saved = json.load(f)
+    raw.set_annotations(
+        mne.Annotations(saved['onset'], saved['duration'], saved['description'],
+                        orig_time=raw.annotations.orig_time, ch_names=saved['ch_names']),
+        emit_warning=False,
+    )
+    return raw
+
+
+def materialize(node):
+    '''
+    Return the output of a stage, loaded from the cache if available, otherwise computed
+    (recursively materializing its upstream stage) and stored in the cache.
+
+    :param node: StageNode returned by cached_stage
+
+    :return: mne.io.Raw output of the stage (preloaded)
+    '''
+    data_path, annot_path, done_path = _entry_paths(node.cache_dir, node.key)
+
+    if done_path.exists():
+        try:
+            raw = _restore_annotations(mne.io.read_raw_fif(data_path, preload=True, verbose="ERROR"), annot_path)
+        except (OSError, ValueError):
+            _remove_entry(node.cache_dir, node.key)   # corrupted entry, recompute it
+        else:
+            done_path.touch()   # marker mtime = last access, used for LRU eviction
+            _CACHE_STATS['hits'] += 1
+            log(node.logger, f"[stage cache] hit  {node.name} ({node.key})")
+            return raw
+
+    _CACHE_STATS['misses'] += 1
+    log(node.logger, f"[stage cache] miss {node.name} ({node.key})")
+    raw = node.compute()
+
+    # written under a temporary directory and moved in place, so that no other process sees a partial entry
+    tmp_dir = node.cache_dir / f".tmp-{node.key}-{os.getpid()}"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        raw.save(tmp_dir / data_path.name, fmt="double", overwrite=True, verbose="ERROR")
+        _save_annotations(raw.annotations, tmp_dir / annot_path.name)
+        for path in [*tmp_dir.glob(f"{node.key}_raw*.fif"), tmp_dir / annot_path.name]:
+            os.replace(path, node.cache_dir / path.name)   # split files keep their names
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    done_path.touch()
+    evict_cache(node.cache_dir, logger=node.logger)
+    return raw
+
+
+def _remove_entry(cache_dir, key):
+    '''
+    Remove all files of a cache entry (marker first, so a partially removed entry is never used).
+    '''
+    _, annot_path, done_path = _entry_paths(cache_dir, key)
+    done_path.unlink(missing_ok=True)
+    for path in cache_dir.glob(f"{key}_raw*.fif"):
+        path.unlink(missing_ok=True)
+    annot_path.unlink(missing_ok=True)
+
+
+def cache_size_bytes(cache_dir=None):
+    '''
+    Total size of the files in the cache directory.
+    '''
+    cache_dir = Path(cache_dir or config.STAGE_CACHE_DIR or DEFAULT_CACHE_DIR)
+    if not cache_dir.exists():
+        return 0
+    return sum(path.stat().st_size for path in cache_dir.glob("*_raw*.fif"))
+
+
+def _mtime(path):
+    '''
+    Modification time of a path, or +inf if it was removed meanwhile (by another process).
+    '''
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return float("inf")
+
+
+def evict_cache(cache_dir=None, max_gb=None, grace_sec=None, logger=None):
+    '''
+    Remove least recently used entries until the cache is below its size limit.
+
+    :param cache_dir: cache directory, defaults to config.STAGE_CACHE_DIR or output_mne/cache
+    :param max_gb: size limit in GB, defaults to config.STAGE_CACHE_MAX_GB
+    :param grace_sec: incomplete entries and temporary directories younger than this are left alone, since another
+                      process may still be writing them, defaults to config.STAGE_CACHE_GRACE_SEC
+
+    :return: number of evicted entries
+    '''
+    cache_dir = Path(cache_dir or config.STAGE_CACHE_DIR or DEFAULT_CACHE_DIR)
+    if max_gb is None:
+        max_gb = config.STAGE_CACHE_MAX_GB
+    if grace_sec is None:
+        grace_sec = config.STAGE_CACHE_GRACE_SEC
+    max_bytes = max_gb * 1024 ** 3
+
+    # old incomplete entries (no marker) and temporary directories are leftovers of interrupted runs
+    stale_before = time.time() - grace_sec
+    for path in cache_dir.glob(".tmp-*"):
+        if _mtime(path) < stale_before:
+            shutil.rmtree(path, ignore_errors=True)
+    for path in [*cache_dir.glob("*_raw*.fif"), *cache_dir.glob("*_annot.json")]:
+        key = path.name.split("_raw")[0].split("_annot")[0]
+        if not (cache_dir / f"{key}.done").exists() and _mtime(path) < stale_before:
+            path.unlink(missing_ok=True)
+
+    total = cache_size_bytes(cache_dir)
+    n_evicted = 0
+    for done_path in sorted(cache_dir.glob("*.done"), key=_mtime):
+        if total <= max_bytes:
+            break
+        key = done_path.stem
+        entry_size = sum(path.stat().st_size for path in cache_dir.glob(f"{key}_raw*.fif"))
+        _remove_entry(cache_dir, key)
+        total -= entry_size
+        n_evicted += 1
+
+    if n_evicted:
+        _CACHE_STATS['evictions'] += n_evicted
+        log(logger, f"[stage cache] evicted {n_evicted} entries, cache size now {total / 1024 ** 3:.2f} GB")
+    return n_evicted
+
+
+def get_cache_stats():
+    '''
+    Hit/miss/eviction counts of the stage cache in this process.
+    '''
+    return dict(_CACHE_STATS)
+
+
+def report_cache_stats(logger=None, cache_dir=None):
+    '''
+    Log the hit/miss/eviction counts and the current size of the stage cache.
+    '''
+    stats = get_cache_stats()
+    log_cache_stats(logger, stats, cache_size_bytes(cache_dir))
+    return stats
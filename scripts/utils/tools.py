@@ -1,5 +1,10 @@
 import mne
+import numpy as np
 import re
+import config
+
+
+BRAINVISION_EVENT_OFFSET = 10000   # added by MNE to the codes of non-marker descriptions of BrainVision recordings
 
 
 def _normalize_event_key(key):
@@ -33,31 +38,133 @@ def _flatten_conditions(condition_dict):
     return [condition_dict]
 
 
+class EventIndex:
+    '''
+    Events of a Raw object parsed once from its annotations: the events array and event id map (as returned by
+    mne.events_from_annotations), the normalized event key -> event id map and the event samples of each event id.
+    '''
+
+    def __init__(self, raw):
+        # MNE numbers the descriptions of read_annotations_core ('Stimulus:S  6', not BrainVision markers) from 10001
+        # on for the BrainVision recordings as read from BIDS, but from 1 on for other Raw objects, i.e. the RawArray /
+        # FIF outputs of the shared-FFT filter, the memmap chain and the stage cache: the BrainVision numbering is used
+        # for all of them, so every chain gives the same event ids
+        events, event_id = mne.events_from_annotations(raw, event_id=None, verbose=False)
+        events[:, 2] += BRAINVISION_EVENT_OFFSET
+        self.events = events
+        self.event_id = {key: code + BRAINVISION_EVENT_OFFSET for key, code in event_id.items()}
+        self.events.flags.writeable = False  # shared by all callers
+        self.sfreq = raw.info['sfreq']
+
+        # normalized lookup for the actual event keys (first key wins if several normalize to the same)
+        self.norm_to_orig = {}
+        for k in self.event_id.keys():
+            self.norm_to_orig.setdefault(_normalize_event_key(k), k)
+
+        # event samples of each event id, in order of occurrence
+        codes = self.events[:, 2]
+        order = np.argsort(codes, kind='stable')
+        unique_codes, first = np.unique(codes[order], return_index=True)
+        self.samples_by_code = {
+            int(code): samples for code, samples in zip(unique_codes, np.split(self.events[order, 0], first[1:]))
+        }
+
+    def samples(self, event_id):
+        '''
+        :return: samples of the events with the given id (empty array if there are none)
+        '''
+        return self.samples_by_code.get(int(event_id), np.empty(0, dtype=self.events.dtype))
+
+    def lookup(self, condition_dict):
+        '''
+        Event ids of the conditions in condition_dict, matched on the normalized event keys.
+
+        :return evts_dict_stim: mapping of condition -> event id for the conditions present in the recording
+        :return missing: conditions not present in the recording
+        '''
+        evts_dict_stim = {}
+        missing = []
+        for cond in _flatten_conditions(condition_dict):
+            orig_key = self.norm_to_orig.get(_normalize_event_key(cond))
+            if orig_key is None:
+                missing.append(cond)
+            else:
+                evts_dict_stim[cond] = self.event_id[orig_key]
+        return evts_dict_stim, missing
+
+
+def _annotation_state(raw):
+    '''
+    Everything events_from_annotations depends on: the annotations, the first sample and the sampling rate.
+    '''
+    annot = raw.annotations
+    return (
+        annot.onset.tobytes(), annot.duration.tobytes(), annot.description.tobytes(), annot.orig_time,
+        raw.first_samp, raw.info['sfreq'], raw.info['meas_date'],
+    )
+
+
+def get_event_index(raw):
+    '''
+    Get the EventIndex of a Raw object, built on first use and rebuilt when its annotations (or its first sample or
+    sampling rate) have changed since. Copies of the Raw object carry the index along.
+    '''
+    state = _annotation_state(raw)
+    cached = getattr(raw, '_event_index', None)
+    if cached is not None and cached[0] == state:
+        return cached[1]
+    index = EventIndex(raw)
+    # attribute of the Raw object itself (Raw hashes its data, so it can't key a cache dict cheaply)
+    raw._event_index = (state, index)
+    return index
+
+
 def get_event_dict(eeg, condition_dict):
     '''
     get the dictionary for the events under specified conditions
     '''
-    evts, evts_dict = mne.events_from_annotations(eeg)
-
-    # Build normalized lookup for actual event keys
-    norm_to_orig = {}
-    for k in evts_dict.keys():
-        nk = _normalize_event_key(k)
-        if nk not in norm_to_orig:
-            norm_to_orig[nk] = k
-
-    cond_list = _flatten_conditions(condition_dict)
-    evts_dict_stim = {}
-    missing = []
-    for cond in cond_list:
-        nk = _normalize_event_key(cond)
-        if nk in norm_to_orig:
-            orig_key = norm_to_orig[nk]
-            evts_dict_stim[cond] = evts_dict[orig_key]
-        else:
-            missing.append(cond)
+    index = get_event_index(eeg)
+    evts_dict_stim, missing = index.lookup(condition_dict)
 
     if missing:
         print(f"[get_event_dict] Warning: missing event keys: {missing}")
 
-    return evts, evts_dict_stim
\ No newline at end of file
+    return index.events, evts_dict_stim
+
+
+def get_float_dtype(dtype=None):
+    '''
+    Working precision of the intermediate arrays: the given dtype, otherwise config.FLOAT_DTYPE.
+    MNE always stores Raw/Epochs/Evoked data in float64, so this only applies to the arrays derived from them.
+    '''
+    dtype = np.dtype(config.FLOAT_DTYPE if dtype is None else dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"Unsupported float dtype: {dtype}")
+    return dtype
+
+
+def get_epochs_data(epochs, dtype=None, chunk_mb=None):
+    '''
+    Data of the epochs as an (n_epochs, n_channels, n_times) array in the precision given by dtype (defaults to config.FLOAT_DTYPE).
+    A float32 array is filled block of epochs by block of epochs, so that no float64 copy of all the epochs is made.
+
+    :param epochs: MNE Epochs object (bad epochs are dropped first)
+    :param dtype: precision of the returned array
+    :param chunk_mb: size of the float64 blocks read from the epochs, defaults to config.ARTIFACT_CHUNK_MB
+
+    :return: array of the epoch data
+    '''
+    dtype = get_float_dtype(dtype)
+    if dtype == np.float64:
+        return epochs.get_data()
+    if chunk_mb is None:
+        chunk_mb = config.ARTIFACT_CHUNK_MB
+
+    epochs.drop_bad(verbose=False)
+    n_epochs, n_channels, n_times = len(epochs), len(epochs.ch_names), len(epochs.times)
+    chunk_size = max(1, int(chunk_mb * 1024 ** 2 // (n_channels * n_times * 8)))
+    data = np.empty((n_epochs, n_channels, n_times), dtype=dtype)
+    for start in range(0, n_epochs, chunk_size):
+        stop = min(start + chunk_size, n_epochs)
+        data[start:stop] = epochs.get_data(item=slice(start, stop))
+    return data